@@ -21,6 +21,8 @@ import rioxarray as rxr
 
 from tools.general_functions import apply_root_json
 
+import downscaling.grid_store as grid_store
+
 colour_red = "\033[91m"
 colour_green = "\033[92m"
 colour_yellow = "\033[93m"
@@ -394,8 +396,8 @@ def create_GADM_region_raster(project_dir:Path, model:str="IMAGE", resolution_mi
 
     # save to netcdf and tiff
     print(f"CRS: {ds_GADM_raster.rio.crs}")
-    print(f"\nSaving GADM raster to {colour_green}netcdf {color_end}file in {dir_GADM} with region numbers...")
-    ds_GADM_raster.to_netcdf(f"{dir_GADM}/IMAGE_GADM_regions_raster_{res_min_file_end}_arcmin.nc", mode="w", engine="netcdf4")
+    print(f"\nSaving GADM raster to {colour_green}{grid_store.storage_format()} {color_end}file in {dir_GADM} with region numbers...")
+    grid_store.save_dataset(ds_GADM_raster, grid_store.store_path(Path(dir_GADM) / f"IMAGE_GADM_regions_raster_{res_min_file_end}_arcmin.nc"))
     print(f"\nSaving GADM raster to {colour_yellow}tiff {color_end}file in {dir_GADM} with region numbers...")
     data = np.stack([ds_GADM_raster["country_id_GADM"].values, ds_GADM_raster["region_number"].values])
     tiff_file = f"{dir_GADM}/IMAGE_GADM_regions_raster_{res_min_file_end}_arcmin.tif"
@@ -0,0 +1,263 @@
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from itertools import product
+from pathlib import Path
+
+import dask
+import psutil
+from tabulate import tabulate
+
+from tools.functions_logging import init_logging, deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.settings_downscaling as settings
+import downscaling.grid_store as grid_store
+import downscaling.chunk_planner as chunk_planner
+from downscaling.settings_resolution import DATASETS
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Parallel executor for a matrix of downscaling runs
+# A run is one (scenario, profile, emissions) combination, its resolution follows from the sources of the profile.
+# Runs are executed in a process pool; the number of processes is the number of runs that fit in the memory budget
+# (batch_settings), and the dask threads of the machine are divided over the processes.
+# Read-only inputs are shared: the scenario-independent grids (population, GDP (PPP), emissions and the products of
+# them) are processed once per (profile, emissions) in a shared processed directory before the runs start, every run
+# reads them from there. Inputs of the urban aggregation are read once per process.
+
+# read-only inputs of a worker process, set by the initializer of the pool
+_worker_inputs = {}
+
+def _init_worker(num_threads:int, inputs:dict|None=None, memory_budget_GB:float|None=None, track_memory:bool=False):
+    dask.config.set(num_workers=num_threads)
+    # the chunks of a run are planned for its share of the memory budget (see chunk_planner.py)
+    settings.chunk_settings["memory_budget_GB"] = memory_budget_GB
+    settings.memory_settings["enabled"] = track_memory
+    _worker_inputs.clear()
+    for name, reader in (inputs or {}).items():
+        _worker_inputs[name] = reader()
+
+def run_resolution(profile:str) -> float:
+    '''
+    Resolution (degrees) of the runs of a profile: the lowest resolution of its population, GDP and emissions sources.
+    '''
+    sources = settings.SOURCE_PROFILES[profile]
+    degrees = {(entry["source"], entry["variable"]): entry["resolution"]["degrees"] for entry in DATASETS}
+    return max(degrees[(sources["source_POP"], "Population")], degrees[(sources["source_GDP"], "GDP")], degrees[(sources["source_EM"], "Emissions")])
+
+def estimate_run_memory_GB(profile:str) -> float:
+    '''
+    Estimated peak memory of one emissions run of a profile: the (y, x) grids that are held in memory
+    (regions, base-year grids, scaling factors) and the chunks of the streamed (time, y, x) cubes.
+    '''
+    if settings.batch_settings["memory_per_run_GB"] is not None:
+        return settings.batch_settings["memory_per_run_GB"]
+    degrees = run_resolution(profile)
+    n_y, n_x = round(180 / degrees), round(360 / degrees)
+    n_cells = n_y * n_x
+    chunks = chunk_planner.plan_chunks({"time": 1, "y": n_y, "x": n_x}, n_arrays=4)
+    chunk_cells = chunks["y"] * chunks["x"]
+    return (n_cells * settings.batch_settings["grids_in_memory"] + chunk_cells * settings.batch_settings["chunks_in_memory"]) * 8 / 1e9
+
+def estimate_urban_memory_GB(path_EM:Path) -> float|None:
+    '''
+    Estimated peak memory of the urban aggregation of a harmonised emissions cube on disk: one (y, x) urban
+    classification grid per year of the cube and the (y, x) grids of a run; None if the cube does not exist.
+    '''
+    if settings.batch_settings["memory_per_run_GB"] is not None:
+        return settings.batch_settings["memory_per_run_GB"]
+    if not grid_store.exists(path_EM):
+        return None
+    with grid_store.open_dataset(path_EM) as ds_EM:
+        n_time = ds_EM.sizes.get("time", 1)
+        n_cells = ds_EM.sizes["y"] * ds_EM.sizes["x"]
+    return n_cells * (n_time + settings.batch_settings["grids_in_memory"]) * 8 / 1e9
+
+def _urban_task_memory_GB(round_:str, path_EM:Path, log: logging.Logger=local_log) -> float:
+    memory_GB = estimate_urban_memory_GB(path_EM)
+    if memory_GB is not None:
+        return memory_GB
+    if round_ in settings.SOURCE_PROFILES:
+        return estimate_run_memory_GB(round_)
+    # unknown size, the round gets the whole budget (and runs alone)
+    log.warning(f"Batch: no emissions cube at {path_EM} and no profile '{round_}', the round gets the whole memory budget")
+    return memory_budget_GB()
+
+def memory_budget_GB() -> float:
+    if settings.batch_settings["memory_budget_GB"] is not None:
+        return settings.batch_settings["memory_budget_GB"]
+    return 0.8 * psutil.virtual_memory().total / 1e9
+
+def pool_size(memory_per_task_GB:float, n_tasks:int, log: logging.Logger=local_log) -> int:
+    '''
+    Number of processes: as many tasks as fit in the memory budget, at most max_processes (default: number of cores).
+    '''
+    max_processes = settings.batch_settings["max_processes"] or os.cpu_count() or 1
+    budget = memory_budget_GB()
+    n_processes = max(1, min(max_processes, int(budget // max(memory_per_task_GB, 1e-3)), n_tasks))
+    log.info(f"Batch: {n_processes} processes for {n_tasks} tasks (memory budget {budget:,.1f} GB, {memory_per_task_GB:,.1f} GB per task)")
+    return n_processes
+
+def status_table(tasks:list, columns:list) -> str:
+    return tabulate([[task.get(column, "") for column in columns] for task in tasks], headers=columns, tablefmt="simple", floatfmt=".1f")
+
+def run_parallel(func, tasks:list, memory_per_task_GB:float, columns:list, inputs:dict|None=None,
+                 log: logging.Logger=local_log) -> list:
+    '''
+    Run func(task) for all tasks (dicts) in a process pool sized to the memory budget.
+    func must be a module-level function; it returns a dict that is added to its task.
+    inputs: {name: reader} read-only inputs, read once per process (available to func through _worker_inputs).
+    Failed tasks do not stop the others. Prints and returns the tasks with status, duration and error.
+    '''
+    n_processes = pool_size(memory_per_task_GB, len(tasks), log)
+    num_threads = max(1, (os.cpu_count() or 1) // n_processes)
+    for task in tasks:
+        task.update(status="waiting", minutes=None, error="")
+    start = time.time()
+    initargs = (num_threads, inputs, memory_budget_GB() / n_processes, settings.memory_settings["enabled"])
+    with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_worker, initargs=initargs) as executor:
+        futures = {executor.submit(_run_task, func, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # e.g. a worker that was killed (out of memory)
+                result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            traceback_task = result.pop("traceback", None)
+            task.update(result)
+            color = PRINT_COLORS["green"] if task["status"] == "done" else PRINT_COLORS["red"]
+            log.info(f"{color}Batch ({(time.time()-start)/60:,.1f} mins): {', '.join(str(task[column]) for column in columns)} {task['status']}{PRINT_COLORS['end']}")
+            if traceback_task:
+                log.error(traceback_task)
+
+    table = status_table(tasks, columns + ["status", "minutes", "error"])
+    log.info(f"\n{table}")
+    print(table)
+    return tasks
+
+def _run_task(func, task:dict) -> dict:
+    t0 = time.time()
+    try:
+        result = func(task) or {}
+        result.setdefault("status", "done")
+    except Exception as e:
+        result = {"status": "failed", "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+    result["minutes"] = (time.time() - t0) / 60
+    return result
+
+def emissions_run_matrix(scenarios:list, profiles:list, emissions:list, model:str="IMAGE") -> list:
+    '''
+    Runs of the emissions downscaling for all combinations of scenarios, profiles and emissions ("net", "gross").
+    '''
+    runs = []
+    for profile, gross_net, scenario in product(profiles, emissions, scenarios):
+        if profile not in settings.SOURCE_PROFILES:
+            raise ValueError(f"Unknown source profile '{profile}'. Available: {list(settings.SOURCE_PROFILES.keys())}")
+        if gross_net not in ["net", "gross"]:
+            raise ValueError(f"Emissions must be 'net' or 'gross', not '{gross_net}'")
+        runs.append({"scenario": scenario, "profile": profile, "emissions": gross_net, "model": model,
+                     "resolution_min": run_resolution(profile) * 60,
+                     "memory_GB": estimate_run_memory_GB(profile)})
+    return runs
+
+def dir_processed_grid(project_dir:Path, profile:str, model:str, gross_net:str) -> Path:
+    '''
+    Processed directory of the scenario-independent grids of a (profile, emissions), shared by the runs of a batch
+    (same directory as downscale_emissions_scenarios).
+    '''
+    sources = settings.SOURCE_PROFILES[profile]
+    source_version_grid = f"{sources["source_POP"]}_{sources["version_POP"]}_{sources["source_GDP"]}_{sources["version_GDP"]}_{sources["source_EM"]}_{sources["version_EM"]}_{gross_net}"
+    return project_dir / "data" / "processed" / profile / source_version_grid / model
+
+# flags of the steps that write the shared grids, these steps run once per (profile, emissions) before the runs
+grid_process_flags = ["read_process_POP", "read_process_GDP_PPP", "read_process_EM", "process_GDP_POP_grid"]
+
+def _prepare_grid(task:dict) -> dict:
+    import downscaling.downscaling as downscaling
+    dir_grid = dir_processed_grid(task["project_dir"], task["profile"], task["model"], task["emissions"])
+    dir_grid.mkdir(parents=True, exist_ok=True)
+    debug_log, results_log = init_logging(f"downscaling_grid_{task['profile']}_{task['model']}_{task['emissions']}", f"{task['project_dir']}/log/downscaling")
+    downscaling.read_process_grid_data_emissions(task["project_dir"], dir_grid, task["profile"], task["model"], "grid", task["emissions"], time.time(), debug_log)
+    return {}
+
+def _downscale_emissions_run(task:dict) -> dict:
+    import downscaling.downscaling as downscaling
+    # the shared grids were processed (and forced by their flags) before the runs, the runs only read them
+    settings.process_flags.update({flag: False for flag in grid_process_flags})
+    downscaling.downscale_emissions(task["project_dir"], task["scenario"], task["model"], task["profile"], task["emissions"] == "net",
+                                    dir_processed_grid=dir_processed_grid(task["project_dir"], task["profile"], task["model"], task["emissions"]))
+    return {}
+
+def downscale_emissions_matrix(project_dir:Path, scenarios:list, profiles:list, emissions:list|None=None, model:str="IMAGE",
+                               log: logging.Logger=local_log) -> list:
+    '''
+    Downscale emissions for all combinations of scenarios, profiles and emissions ("net", "gross") in parallel.
+    1. the shared grids of every (profile, emissions) are processed, in parallel over the profiles
+    2. the runs, in parallel, read the shared grids and write their results as downscale_emissions does
+    Returns the runs with their status; a status table is printed and logged.
+    '''
+    emissions = ["net"] if emissions is None else emissions
+    runs = emissions_run_matrix(scenarios, profiles, emissions, model)
+    for run in runs:
+        run["project_dir"] = project_dir
+    log.info(f"{PRINT_COLORS['purple']}Batch: {len(runs)} emissions runs{PRINT_COLORS['end']}")
+
+    grids = [{"profile": profile, "emissions": gross_net, "model": model, "project_dir": project_dir,
+              "memory_GB": estimate_run_memory_GB(profile)}
+             for profile, gross_net in dict.fromkeys((run["profile"], run["emissions"]) for run in runs)]
+    log.info(f"{PRINT_COLORS['green']}Batch: processing {len(grids)} shared grids{PRINT_COLORS['end']}")
+    grids = run_parallel(_prepare_grid, grids, max(grid["memory_GB"] for grid in grids), ["profile", "emissions"], log=log)
+    failed = {(grid["profile"], grid["emissions"]) for grid in grids if grid["status"] != "done"}
+
+    todo = []
+    for run in runs:
+        if (run["profile"], run["emissions"]) in failed:
+            run.update(status="skipped", minutes=None, error="shared grids failed")
+        else:
+            todo.append(run)
+    log.info(f"{PRINT_COLORS['green']}Batch: downscaling {len(todo)} runs{PRINT_COLORS['end']}")
+    if todo:
+        run_parallel(_downscale_emissions_run, todo, max(run["memory_GB"] for run in todo),
+                     ["scenario", "profile", "emissions", "resolution_min", "memory_GB"], log=log)
+
+    table = status_table(runs, ["scenario", "profile", "emissions", "resolution_min", "memory_GB", "status", "minutes", "error"])
+    log.info(f"\n{table}")
+    print(table)
+    return runs
+
+def _aggregate_urban_round(task:dict) -> dict:
+    import downscaling.downscaling as downscaling
+    varname_EM = "Emissions_CO2_Excl_shipping_aviation_AFOLU"
+    print(f"Reading emissions data from: {task['path_EM']}")
+    xr_EM = grid_store.open_dataset(task["path_EM"])
+    xr_em_urban, df_em_urban, df_em_rural = downscaling.aggregate_urban_emissions(xr_emissions=xr_EM, gdf_urban_classification=_worker_inputs["gdf_urban"],
+                                                                                 emissions_varname=varname_EM,
+                                                                                 region_varname="region_number",
+                                                                                 final_year=2050)
+    dir_urban_classification = task["project_dir"] / "data" / "output"
+    df_em_urban.to_csv(dir_urban_classification / f"Emissions_urban_classification_{task['scenario']}_{task['round']}.csv", index=False, sep=";")
+    df_em_rural.to_csv(dir_urban_classification / f"Emissions_rural_classification_{task['scenario']}_{task['round']}.csv", index=False, sep=";")
+    return {}
+
+def aggregate_urban_rounds(project_dir:Path, rounds:dict, SSP_base:str="SSP2", scenario_EM:str="IMAGE_ELV-SSP2-CP",
+                           log: logging.Logger=local_log) -> list:
+    '''
+    Aggregate the harmonised emissions of several rounds ({round: processed directory}) to urban and rural emissions,
+    in parallel over the rounds. The urban classification is read once per process.
+    '''
+    import geopandas as gpd
+    path_urban = project_dir / "data" / "processed" / "DLL" / "urban_classification_years.parquet"
+    file_EM = f"Emissions_CO2_Excl_shipping_aviation_AFOLU_harmonised_{SSP_base}.nc"
+    tasks = [{"round": round_, "scenario": scenario_EM, "project_dir": project_dir,
+              "path_EM": grid_store.store_path(project_dir / "data" / "processed" / dir_round / scenario_EM / file_EM),
+              "memory_GB": None}
+             for round_, dir_round in rounds.items()]
+    for task in tasks:
+        task["memory_GB"] = _urban_task_memory_GB(task["round"], task["path_EM"], log)
+    return run_parallel(_aggregate_urban_round, tasks, max(task["memory_GB"] for task in tasks), ["round", "scenario"],
+                        inputs={"gdf_urban": partial(gpd.read_parquet, path_urban)}, log=log)
@@ -0,0 +1,405 @@
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+import dask
+import dask.array as dask_array
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import psutil
+import rioxarray as rxr
+import xarray as xr
+from affine import Affine
+from shapely.geometry import box
+from tabulate import tabulate
+
+from tools.functions_logging import init_logging, deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.settings_downscaling as settings
+import downscaling.settings_models as settings_models
+import downscaling.chunk_planner as chunk_planner
+import downscaling.grid_store as grid_store
+import downscaling.pipeline as pipeline
+import downscaling.process_IPAT_factors as process_IPAT_factors
+import downscaling.read_process_grid_data as process_grid_data
+import downscaling.downscaling as downscaling
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Benchmarks of the downscaling hot paths on synthetic data
+# For every resolution of benchmark_settings a synthetic project is generated once in the benchmark directory:
+#   - a global IMAGE region raster (region_number, n_regions land regions, 0 for ocean)
+#   - population, GDP (PPP) and base-year emission grids (time, y, x), NaN over ocean, EPSG:4326
+#   - an IAMC workbook (data/input/models/IMAGE/SSP/<scenario>.xlsx) with the variables of the emissions downscaling
+#     and the region numbers file, consistent with the regions of the raster
+#   - urban/rural polygons with cluster_<year> columns (urban classification)
+# The values are deterministic (seeded per (y, x) block), so runs on different commits time the same work.
+# Every benchmark times one hot path including the evaluation of its (lazy) result; downscale_emissions runs
+# the emissions pipeline from the synthetic workbook and grids up to the harmonised emissions (the reading of the
+# source datasets is not included).
+# Results are appended to a JSON lines history file, one record per benchmark and resolution with the commit,
+# machine and timing, so runs can be compared across commits (benchmark_history_table).
+
+# (y, x) blocks in which the synthetic grids are generated
+_block = 1024
+
+def _git_commit(project_dir:Path) -> tuple[str|None, bool]:
+    '''
+    Commit of the code that is benchmarked and whether the working tree has uncommitted changes.
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=project_dir, capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+def _grid_shape(arcmin:float) -> tuple[int, int]:
+    degrees = arcmin / 60
+    return round(180 / degrees), round(360 / degrees)
+
+def _block_chunks(n:int) -> tuple:
+    return (_block,) * (n // _block) + ((n % _block,) if n % _block else ())
+
+def _cell_centres(block_info:dict, degrees:float) -> tuple[np.ndarray, np.ndarray]:
+    (y0, y1), (x0, x1) = block_info[None]["array-location"][-2:]
+    lat = 90 - (np.arange(y0, y1) + 0.5) * degrees
+    lon = -180 + (np.arange(x0, x1) + 0.5) * degrees
+    return np.meshgrid(lat, lon, indexing="ij")
+
+def _region_block(lat:np.ndarray, lon:np.ndarray, n_regions:int) -> np.ndarray:
+    # smooth continents (about a third of the cells), regions are bands of latitude and longitude
+    land = ((np.sin(np.radians(lon) * 3 + 1) * np.cos(np.radians(lat) * 2) + 0.5 * np.sin(np.radians(lon + lat) * 7)) > 0.35) & (np.abs(lat) < 75)
+    region = ((lat + 90) // 45 * 7 + (lon + 180) // (360 / 7)) % n_regions + 1
+    return np.where(land, region, 0).astype("float32")
+
+def _growth(years, rate:float, n_regions:int) -> np.ndarray:
+    # (year, region) growth factors relative to the base year, region 0 (ocean) is NaN
+    rates = rate * (0.5 + np.arange(n_regions + 1) / n_regions)
+    growth = (1 + rates[None, :]) ** (np.asarray(years, dtype="float64")[:, None] - settings.base_year)
+    growth[:, 0] = np.nan
+    return growth
+
+def _synthetic_block(kind:str, years:list, degrees:float, n_regions:int, seed:int, block_info=None) -> np.ndarray:
+    '''
+    One (time, y, x) block of a synthetic grid: "region" (without time), "population", "gdp" or "emissions".
+    '''
+    lat, lon = _cell_centres(block_info, degrees)
+    region = _region_block(lat, lon, n_regions)
+    if kind == "region":
+        return region
+    block_index = block_info[None]["chunk-location"][-2:]
+    rng = np.random.default_rng([seed, *block_index])
+    # the same draws for all kinds, so population, GDP and emissions are consistent
+    population = rng.lognormal(3, 1.5, region.shape) * (degrees * 60) ** 2
+    population[rng.random(region.shape) < 0.1] = 0
+    gdp_per_pop = 2e3 * (1 + region) * rng.lognormal(0, 0.3, region.shape)
+    # some cells have GDP without population (set to one person in process_factors_GDP_POP)
+    gdp = np.maximum(population, 1 * (rng.random(region.shape) < 0.02)) * gdp_per_pop
+    emissions = gdp * 1e-4 * (1 + region % 5) * rng.lognormal(0, 0.5, region.shape)
+    region_index = region.astype("int64")
+    match kind:
+        case "population":
+            values, growth = population, _growth(years, 0.005, n_regions)
+        case "gdp":
+            values, growth = gdp, _growth(years, 0.02, n_regions)
+        case "emissions":
+            values, growth = emissions, _growth(years, -0.01, n_regions)
+        case _:
+            raise ValueError(f"Unknown synthetic grid '{kind}'")
+    return growth[:, region_index] * values[None, :, :]
+
+def synthetic_grid(kind:str, varname:str, unit:str, arcmin:float, years:list|None=None) -> xr.Dataset:
+    '''
+    Lazy synthetic global grid at arcmin resolution (see _synthetic_block), georeferenced as the processed grids.
+    '''
+    n_y, n_x = _grid_shape(arcmin)
+    degrees = arcmin / 60
+    n_regions, seed = settings.benchmark_settings["n_regions"], settings.benchmark_settings["seed"]
+    if kind == "region":
+        data = dask_array.map_blocks(_synthetic_block, kind, None, degrees, n_regions, seed,
+                                     chunks=(_block_chunks(n_y), _block_chunks(n_x)), dtype="float32")
+        dims = ("y", "x")
+    else:
+        data = dask_array.map_blocks(_synthetic_block, kind, years, degrees, n_regions, seed,
+                                     chunks=((len(years),), _block_chunks(n_y), _block_chunks(n_x)), dtype="float64")
+        dims = ("time", "y", "x")
+    coords = {"y": 90 - (np.arange(n_y) + 0.5) * degrees, "x": -180 + (np.arange(n_x) + 0.5) * degrees}
+    if years is not None and kind != "region":
+        coords["time"] = list(years)
+    ds = xr.Dataset({varname: (dims, data, {"unit": unit})}, coords=coords)
+    ds = ds.rio.write_crs("EPSG:4326")
+    return ds.rio.write_transform(Affine(degrees, 0, -180, 0, -degrees, 90))
+
+def synthetic_IAM_workbook(project_dir:Path, scenario:str, model:str="IMAGE") -> pd.DataFrame:
+    '''
+    Synthetic IAMC workbook (sheet "data", one column per year) with the variables of the emissions downscaling
+    for the regions of the synthetic raster, and the region numbers file of the model. Returns the workbook table.
+    '''
+    n_regions = settings.benchmark_settings["n_regions"]
+    years = list(range(2020, 2101, 5))
+    region_codes = [f"REG{number:02d}" for number in range(1, n_regions + 1)]
+    rng = np.random.default_rng(settings.benchmark_settings["seed"])
+    population = rng.uniform(20, 1500, n_regions)  # million
+    gdp = population * rng.uniform(2, 50, n_regions)  # billion USD
+    emissions = gdp * rng.uniform(0.1, 0.6, n_regions)  # Mt CO2
+    # share of the emission variables in the total (supply, demand and its parts, industrial processes, bunkers, AFOLU)
+    shares = {"Emissions|CO2": 1.0, "Emissions|CO2|Energy|Supply": 0.4, "Emissions|CO2|Energy|Demand": 0.45,
+              "Emissions|CO2|Energy|Demand|Industry": 0.2, "Emissions|CO2|Energy|Demand|Transportation": 0.15,
+              "Emissions|CO2|Energy|Demand|Residential and Commercial": 0.07, "Emissions|CO2|Energy|Demand|Other Sector": 0.02,
+              "Emissions|CO2|Energy|Demand|AFOFI": 0.01, "Emissions|CO2|Industrial Processes": 0.08,
+              "Emissions|CO2|Energy|Demand|Bunkers|International Aviation": 0.01,
+              "Emissions|CO2|Energy|Demand|Transportation|Domestic Aviation": 0.01,
+              "Emissions|CO2|Energy|Demand|Transportation|Domestic Shipping": 0.005, "Emissions|CO2|AFOLU": 0.05,
+              "Gross Emissions|CO2|Energy|Supply": 0.42, "Gross Emissions|CO2|Energy|Demand": 0.46,
+              "Gross Emissions|CO2|Energy|Demand|Industry": 0.21}
+    rows = []
+    for i, region_code in enumerate(region_codes):
+        t = (np.asarray(years) - settings.base_year) / (2100 - settings.base_year)
+        series = {"Population": ("million", population[i] * (1 + 0.3 * t)),
+                  "GDP|PPP": ("billion USD_2010/yr", gdp[i] * (1 + 2.5 * t)),
+                  **{variable: ("Mt CO2/yr", share * emissions[i] * (1 - 0.6 * t)) for variable, share in shares.items()}}
+        for variable, (unit, values) in series.items():
+            rows.append({"Model": model, "Scenario": scenario, "Region": region_code, "Variable": variable, "Unit": unit,
+                         **dict(zip(years, values))})
+    df_workbook = pd.DataFrame(rows)
+    dir_model = project_dir / "data" / "input" / "models" / model
+    (dir_model / "SSP").mkdir(parents=True, exist_ok=True)
+    df_workbook.to_excel(dir_model / "SSP" / f"{scenario}.xlsx", sheet_name="data", index=False)
+    file_region_numbers = project_dir / settings_models.models[model]["file_IAM_model_region_numbers"]
+    file_region_numbers.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({"IMAGE number": range(1, n_regions + 1), "IMAGE region": region_codes}).to_csv(file_region_numbers, index=False)
+    return df_workbook
+
+def synthetic_urban_classification(arcmin:float, years:list) -> gpd.GeoDataFrame:
+    '''
+    Synthetic urban classification: square urban (1) and rural (0) areas of 8 x 8 cells, with one cluster_<year> column per year.
+    '''
+    rng = np.random.default_rng(settings.benchmark_settings["seed"])
+    n_areas = settings.benchmark_settings["urban_areas"]
+    size = 8 * arcmin / 60
+    lon, lat = rng.uniform(-180, 180 - size, n_areas), rng.uniform(-60, 70, n_areas)
+    urban = (rng.random(n_areas) < 0.5).astype("int64")
+    gdf = gpd.GeoDataFrame({f"cluster_{year}": urban for year in years},
+                           geometry=[box(x, y, x + size, y + size) for x, y in zip(lon, lat)], crs="EPSG:4326")
+    return gdf
+
+def synthetic_project(project_dir:Path, arcmin:float, log: logging.Logger=local_log) -> dict:
+    '''
+    Synthetic project for one resolution in the benchmark directory: grids (written once, then reopened),
+    IAM workbook and urban classification. Returns the paths, the opened grids and the workbook.
+    '''
+    dir_synthetic = project_dir / settings.benchmark_settings["dir"] / f"synthetic_{str(arcmin).replace('.', '_')}_arcmin"
+    dir_synthetic.mkdir(parents=True, exist_ok=True)
+    scenario = "SYNTH-SSP2"
+    years_grid = settings.benchmark_settings["years_grid"]
+    grids = {"regions": ("region", "region_number", "", None),
+             "population": ("population", settings.varname_POP, settings.unit_POP, years_grid),
+             "gdp": ("gdp", settings.varname_GDP, settings.unit_GDP_PPP, years_grid),
+             "emissions": ("emissions", settings.varname_EM, settings.unit_EM, [settings.base_year])}
+    project = {"dir": dir_synthetic, "arcmin": arcmin, "scenario": scenario, "cells": int(np.prod(_grid_shape(arcmin)))}
+    for name, (kind, varname, unit, years) in grids.items():
+        file_path = grid_store.store_path(dir_synthetic / f"{name}.nc")
+        if not grid_store.exists(file_path):
+            log.info(f"Generating synthetic {name} grid at {arcmin} arcmin: {file_path}")
+            grid_store.save_dataset(synthetic_grid(kind, varname, unit, arcmin, years), file_path, log=log)
+        ds = grid_store.open_dataset(file_path, decode_coords="all")
+        project[name] = ds.chunk(chunk_planner.chunks_for(ds, n_arrays=2, log=log))
+        project[name][varname].attrs["unit"] = unit
+    project["df_workbook"] = synthetic_IAM_workbook(dir_synthetic, scenario)
+    project["gdf_urban"] = synthetic_urban_classification(arcmin, sorted(set([settings.base_year, 2030, 2050])))
+    return project
+
+def _IAM_table(project:dict, variable:str, conversion:float, years:list) -> pd.DataFrame:
+    # long table (region_number, year, value) of a workbook variable in grid units, linearly interpolated to years,
+    # with zero for the ocean (region 0) as in the harmonisation of the pipeline
+    df = project["df_workbook"][project["df_workbook"]["Variable"] == variable]
+    df = df.melt(id_vars=["Model", "Scenario", "Region", "Variable", "Unit"], var_name="year", value_name="value")
+    df["region_number"] = df["Region"].str[3:].astype(int)
+    table = df.pivot(index="year", columns="region_number", values="value").astype("float64")
+    table = table.reindex(sorted(set(table.index) | set(years))).interpolate("index", limit_direction="both").loc[years] * conversion
+    table[0] = 0.0
+    df_table = table.stack().rename("value").reset_index()
+    df_table["unit"] = "benchmark"
+    return df_table
+
+def _evaluate(ds:xr.Dataset):
+    # compute a lazy result chunk by chunk (the sums are discarded)
+    dask.compute(*[ds[name].sum() for name in ds.data_vars])
+
+#************************** BENCHMARKS *******************************************
+# Every benchmark takes the synthetic project and returns the number of grid cells it processed.
+
+def bench_calc_regional_values(project:dict, log: logging.Logger=local_log) -> int:
+    years = settings.benchmark_settings["years_grid"]
+    df_IAM = _IAM_table(project, "Population", 1e6, years)
+    process_IPAT_factors.calc_regional_values(project["population"], settings.varname_POP, project["regions"], df_IAM, years, log)
+    return project["cells"] * len(years)
+
+def bench_downscale_em_per_gdp(project:dict, log: logging.Logger=local_log) -> int:
+    base_year, convergence_year = settings.base_year, settings.convergence_year
+    years = sorted(set(settings.years_downscaling + [convergence_year]))
+    df_em = _IAM_table(project, "Emissions|CO2", 1e6, years)
+    df_gdp = _IAM_table(project, "GDP|PPP", 1e9, years)
+    df_em_per_gdp = df_em.assign(value=df_em["value"] / df_gdp["value"].where(df_gdp["value"] != 0))
+    xr_gdp_by = project["gdp"][settings.varname_GDP].sel(time=base_year)
+    xr_em_per_gdp_by = project["emissions"][settings.varname_EM].sel(time=base_year) / xr_gdp_by.where(xr_gdp_by != 0)
+    xr_scaling_factor_by, regions, x_coords, y_coords = process_IPAT_factors.calc_scaling_factors_EM_per_GDP(project["regions"], base_year, xr_gdp_by,
+                                                                                                             xr_em_per_gdp_by, df_em_per_gdp)
+    xr_em_per_gdp = process_IPAT_factors.downscale_em_per_gdp(xr_scaling_factor_by, settings.varname_em_per_gdp_ppp, project["regions"], df_em_per_gdp,
+                                                              years, base_year, convergence_year, regions, x_coords, y_coords)
+    _evaluate(xr_em_per_gdp)
+    return project["cells"] * len(years)
+
+def bench_harmonisation(project:dict, log: logging.Logger=local_log) -> int:
+    years = settings.benchmark_settings["years_grid"]
+    varname = settings.varname_POP
+    df_IAM = _IAM_table(project, "Population", 1e6, years)
+    df_compare, xr_regional_sums = process_IPAT_factors.calc_regional_values(project["population"], varname, project["regions"], df_IAM, years, log)
+    xr_factors = process_IPAT_factors.calculate_harmonisation_factors_emissions(project["population"], varname, xr_regional_sums,
+                                                                                project["regions"], df_IAM, years)
+    xr_harmonised = process_IPAT_factors.apply_harmonisation_factors_emissions(xr_factors, project["population"], varname,
+                                                                               project["regions"], "IMAGE", project["scenario"])
+    _evaluate(xr_harmonised)
+    return project["cells"] * len(years)
+
+def bench_coarsen_save_rio_xarray(project:dict, log: logging.Logger=local_log) -> int:
+    varname = settings.varname_EM
+    file_path = project["dir"] / "coarsened_emissions.nc"
+    process_grid_data.coarsen_save_rio_xarray(project["emissions"], factor=2, zero_to_nan=True, save=True, save_type="netcdf",
+                                              chunks_size_save=grid_store.storage_chunks()["y"], varname=varname, filepath=file_path,
+                                              aggregation_methods={varname: "sum"}, log=log)
+    grid_store.remove(grid_store.store_path(file_path))
+    return project["cells"]
+
+def bench_aggregate_urban_emissions(project:dict, log: logging.Logger=local_log) -> int:
+    xr_em_regions = project["emissions"].copy()
+    xr_em_regions["region_number"] = project["regions"]["region_number"]
+    downscaling.aggregate_urban_emissions(xr_em_regions, project["gdf_urban"], settings.varname_EM, "region_number",
+                                          final_year=2050, log=log)
+    return project["cells"]
+
+def _benchmark_context(project:dict, debug_log:logging.Logger) -> dict:
+    # pipeline context as emissions_context, with the synthetic grids in place of the read steps (1.1, 1.3 - 1.6)
+    dir_synthetic, scenario = project["dir"], project["scenario"]
+    dir_processed = dir_synthetic / "processed"
+    dir_output = dir_synthetic / "output"
+    dir_processed.mkdir(parents=True, exist_ok=True)
+    dir_output.mkdir(parents=True, exist_ok=True)
+    varname_EM = settings.varname_EM
+    ctx = {"project_dir": dir_synthetic, "dir_processed": dir_processed, "dir_output": dir_output, "dir_urban": dir_synthetic,
+           "profile": "benchmark", "model": "IMAGE", "scenario": scenario, "net_emissions": True, "gross_net": "net",
+           "start_time": time.time(), "debug_log": debug_log,
+           "source_POP": "synthetic", "version_POP": "benchmark", "coarse_factor_POP": 1,
+           "source_GDP": "synthetic", "version_GDP": "benchmark", "coarse_factor_GDP": 1,
+           "source_EM": "synthetic", "version_EM": "benchmark", "coarse_factor_EM": 1,
+           "file_data_locations": Path(downscaling.__file__).parent / "settings_data_locations.json",
+           "file_model_grid_regions": grid_store.store_path(dir_synthetic / "regions.nc"),
+           "pop_file": grid_store.store_path(dir_synthetic / "population.nc"),
+           "gdp_ppp_file": grid_store.store_path(dir_synthetic / "gdp.nc"),
+           "em_file": grid_store.store_path(dir_synthetic / "emissions.nc")}
+    for name in ["pop_processed", "gdp_ppp_processed", "gdp_ppp_per_pop", "em_per_gdp_ppp", "em_unharmonised", "em_harmonised", "em_unharmonised_land"]:
+        ctx[f"{name}_file"] = grid_store.store_path(dir_processed / f"{name}.nc")
+    ctx.update({"xr_IAM_regions_grid": project["regions"], "arc_minutes_regions": project["arcmin"],
+                "xr_population": project["population"], "xr_gdp_ppp": project["gdp"], "xr_emissions": project["emissions"],
+                "unit_EM": project["emissions"][varname_EM].attrs["unit"], "gdf_urban": project["gdf_urban"]})
+    return ctx
+
+def bench_downscale_emissions(project:dict, log: logging.Logger=local_log) -> int:
+    '''
+    Emissions pipeline of downscale_emissions from the synthetic workbook and grids: IAM data, processed grids,
+    Kaya product and harmonisation, all steps forced (no cached intermediates). The urban aggregation is
+    timed separately (bench_aggregate_urban_emissions).
+    '''
+    flags = {"read_process_IAM": True, "process_GDP_per_POP": True, "process_df_EM_per_GDP": True,
+             "process_GDP_POP_grid": True, "process_grid_EM_per_GDP": True,
+             "save_tiffs_intermediate": False, "save_tiffs_results": False}
+    flags_saved = {name: settings.process_flags[name] for name in flags}
+    settings.process_flags.update(flags)
+    try:
+        ctx = _benchmark_context(project, log)
+        steps = downscaling.emissions_pipeline_steps(ctx)
+        ctx = pipeline.run_pipeline(steps, ctx, targets=["read_IAM"], log=log)
+        pipeline.run_pipeline(steps, ctx, targets=["harmonise_emissions"], log=log)
+    finally:
+        settings.process_flags.update(flags_saved)
+    return project["cells"] * len(settings.years_downscaling)
+
+benchmarks = {"calc_regional_values": bench_calc_regional_values,
+              "downscale_em_per_gdp": bench_downscale_em_per_gdp,
+              "harmonisation": bench_harmonisation,
+              "coarsen_save_rio_xarray": bench_coarsen_save_rio_xarray,
+              "aggregate_urban_emissions": bench_aggregate_urban_emissions,
+              "downscale_emissions": bench_downscale_emissions}
+
+def run_benchmarks(project_dir:Path, resolutions:list|None=None, names:list|None=None) -> pd.DataFrame:
+    '''
+    Run the benchmarks (default: benchmark_settings["benchmarks"]) for the resolutions in arc minutes
+    (default: benchmark_settings["resolutions_arcmin"]) on synthetic data, append the results to the history file
+    and print them. A failing benchmark is recorded with its error and does not stop the others.
+    '''
+    resolutions = settings.benchmark_settings["resolutions_arcmin"] if resolutions is None else resolutions
+    names = settings.benchmark_settings["benchmarks"] if names is None else names
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {unknown}, available: {list(benchmarks)}")
+    debug_log, results_log = init_logging("benchmarks", f"{project_dir}/log/benchmarks")
+    history_file = project_dir / settings.benchmark_settings["history_file"]
+    history_file.parent.mkdir(parents=True, exist_ok=True)
+    commit, dirty = _git_commit(project_dir)
+    machine = {"host": platform.node(), "python": platform.python_version(), "cpu_count": os.cpu_count(),
+               "memory_GB": round(psutil.virtual_memory().total / 1e9, 1), "workers": chunk_planner.n_workers(),
+               "memory_budget_GB": round(chunk_planner.memory_budget_GB(), 1)}
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    records = []
+    for arcmin in resolutions:
+        debug_log.info(f"{PRINT_COLORS['green']}Benchmarks at {arcmin} arc minutes{PRINT_COLORS['end']}")
+        project = synthetic_project(project_dir, arcmin, debug_log)
+        for name in names:
+            record = {"run": run_id, "timestamp": datetime.now().isoformat(timespec="seconds"), "commit": commit, "dirty": dirty,
+                      **machine, "benchmark": name, "arcmin": arcmin, "cells": None, "seconds": None, "status": "done", "error": ""}
+            t0 = time.perf_counter()
+            try:
+                record["cells"] = benchmarks[name](project, debug_log)
+            except Exception as e:
+                record.update(status="failed", error=f"{type(e).__name__}: {e}"[:200])
+                debug_log.error(f"Benchmark {name} at {arcmin} arc minutes failed: {e}")
+            record["seconds"] = round(time.perf_counter() - t0, 3)
+            with open(history_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            debug_log.info(f"Benchmark {name} at {arcmin} arc minutes: {record['seconds']:,.1f} s ({record['status']})")
+            records.append(record)
+
+    df_results = pd.DataFrame(records)
+    df_results["Mcells_per_s"] = df_results["cells"] / df_results["seconds"] / 1e6
+    table = tabulate(df_results[["benchmark", "arcmin", "seconds", "Mcells_per_s", "status", "error"]],
+                     headers="keys", tablefmt="github", showindex=False, floatfmt=".2f")
+    results_log.info(f"Benchmarks {run_id} (commit {commit}{', uncommitted changes' if dirty else ''}):\n{table}")
+    print(f"Benchmarks {run_id} (commit {commit}{', uncommitted changes' if dirty else ''}), history in {history_file}:\n{table}")
+    return df_results
+
+def benchmark_history_table(project_dir:Path, n_runs:int=5, host:str|None=None) -> pd.DataFrame:
+    '''
+    Seconds per benchmark and resolution for the last n_runs runs in the history file (default: of this machine),
+    one column per run labelled with its commit, and the change of the last run relative to the one before.
+    '''
+    history_file = project_dir / settings.benchmark_settings["history_file"]
+    df = pd.read_json(history_file, lines=True, dtype={"run": str, "commit": str})
+    df = df[(df["host"] == (platform.node() if host is None else host)) & (df["status"] == "done")]
+    runs = df["run"].drop_duplicates().sort_values().iloc[-n_runs:]
+    df = df[df["run"].isin(runs)]
+    df["label"] = df["run"].astype(str) + " " + df["commit"].fillna("?").astype(str) + np.where(df["dirty"], "+", "")
+    df_table = df.pivot_table(index=["benchmark", "arcmin"], columns="label", values="seconds", aggfunc="min")
+    if df_table.shape[1] > 1:
+        df_table["change_%"] = (df_table.iloc[:, -1] / df_table.iloc[:, -2] - 1) * 100
+    table = tabulate(df_table.reset_index(), headers="keys", tablefmt="github", showindex=False, floatfmt=".2f")
+    print(f"Benchmark history ({history_file}, seconds, '+': uncommitted changes):\n{table}")
+    return df_table
@@ -0,0 +1,175 @@
+import contextlib
+import logging
+import math
+import os
+import time
+import tracemalloc
+
+import dask
+import numpy as np
+import psutil
+
+from tools.functions_logging import deferred_logging
+
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Chunk layouts from a memory budget
+# The chunked steps ask the planner for their chunks instead of using fixed sizes, so the same code runs on a laptop
+# and on a large node. A layout follows from the memory budget, the number of dask workers (threads, or the threads
+# of a local cluster) and the shape and dtype of the arrays of the step (chunk_settings):
+#   bytes per chunk = budget / (workers x chunks in flight per worker x arrays per chunk x overhead)
+# The spatial dimensions get square (y, x) tiles (land_cell: the same number of cells), the other dimensions one
+# element per chunk unless a step needs them whole (full_dims, e.g. all years of a downscaled cube in one chunk).
+# Tiles are rounded to whole stored chunks (storage_settings["chunks"]) and kept small enough that every worker
+# gets at least two chunks.
+# calibrate() runs the regional sum and Kaya kernels on sample chunks: the measured peak memory per input byte
+# becomes the overhead and the smallest tile that reaches 90% of the best throughput the minimal tile.
+# Steps of the pipeline that run at the same time (see pipeline.py) share the workers and the memory budget
+# (shared_by): dask's threaded scheduler starts a pool of num_workers threads for every calling thread, so each of
+# n concurrent steps gets cores // n threads and 1/n of the budget.
+
+# (y, x) grids, or (lat, lon) as read from the source files
+spatial_dims = ["y", "x", "lat", "lon"]
+
+# number of steps that share the workers and the memory budget (shared_by)
+_concurrency = {"steps": 1}
+
+# measured by calibrate(), None: not calibrated (overhead 1, minimal tile chunk_settings["min_chunk"])
+_calibration = {"overhead": None, "min_chunk": None}
+
+def n_workers() -> int:
+    '''
+    Number of dask workers that process chunks concurrently: the threads of the cluster workers,
+    otherwise the threads of the threaded scheduler (chunk_settings["workers"], num_workers or number of cores).
+    '''
+    if settings.chunk_settings["workers"] is not None:
+        return max(1, settings.chunk_settings["workers"] // _concurrency["steps"])
+    import downscaling.dask_cluster as dask_cluster
+    client = dask_cluster.get_client()
+    if client is not None:
+        return max(1, sum(worker["nthreads"] for worker in client.scheduler_info()["workers"].values()) // _concurrency["steps"])
+    # within shared_by num_workers is already the share of the step
+    return dask.config.get("num_workers", None) or os.cpu_count() or 1
+
+def memory_budget_GB() -> float:
+    '''
+    Memory for the chunks of a step: chunk_settings["memory_budget_GB"], otherwise the memory limits of the cluster
+    workers up to their spill fraction, otherwise 80% of the memory of the machine; divided by the steps that share it.
+    '''
+    if settings.chunk_settings["memory_budget_GB"] is not None:
+        return settings.chunk_settings["memory_budget_GB"] / _concurrency["steps"]
+    import downscaling.dask_cluster as dask_cluster
+    client = dask_cluster.get_client()
+    if client is not None:
+        memory_limit = sum(worker["memory_limit"] for worker in client.scheduler_info()["workers"].values())
+        return settings.cluster_settings["memory_target"] * memory_limit / 1e9 / _concurrency["steps"]
+    return 0.8 * psutil.virtual_memory().total / 1e9 / _concurrency["steps"]
+
+@contextlib.contextmanager
+def shared_by(n_steps:int):
+    '''
+    Plans made within the block are for one of n_steps concurrent steps: the workers and the memory budget are divided
+    by n_steps, and the threaded scheduler runs cores // n_steps threads per calling thread.
+    '''
+    n_steps = max(1, n_steps)
+    cores = dask.config.get("num_workers", None) or os.cpu_count() or 1
+    previous = _concurrency["steps"]
+    _concurrency["steps"] = n_steps
+    try:
+        if n_steps > 1:
+            with dask.config.set(num_workers=max(1, cores // n_steps)):
+                yield
+        else:
+            yield
+    finally:
+        _concurrency["steps"] = previous
+
+def _align(side:int, minimum:int) -> int:
+    stored = settings.storage_settings["chunks"]["y"]
+    step = stored if side >= stored > 0 else minimum
+    return max(minimum, side // step * step)
+
+def plan_chunks(sizes:dict, dtype="float64", n_arrays:int=1, full_dims:list|None=None,
+                log: logging.Logger=local_log) -> dict:
+    '''
+    Chunks {dim: size} for arrays of the given sizes {dim: length} and dtype, of which n_arrays chunks
+    (inputs, output and temporaries of the step) are in memory per task. Dimensions in full_dims are not split.
+    '''
+    chunk_settings = settings.chunk_settings
+    if chunk_settings["calibrate"] and _calibration["overhead"] is None:
+        calibrate(log=log)
+    full_dims = full_dims or []
+    workers = n_workers()
+    overhead = _calibration["overhead"] or 1.0
+    minimum = _calibration["min_chunk"] or chunk_settings["min_chunk"]
+
+    chunks = {dim: (-1 if dim in full_dims else 1) for dim in sizes if dim not in spatial_dims + ["land_cell"]}
+    cells_other = math.prod(sizes[dim] for dim in full_dims if dim in sizes)
+    bytes_chunk = memory_budget_GB() * 1e9 / (workers * chunk_settings["chunks_in_flight"] * n_arrays * overhead)
+    side = int(math.sqrt(bytes_chunk / (np.dtype(dtype).itemsize * cells_other)))
+    if side < minimum:
+        # _align raises the tile to the minimal tile
+        log.warning(f"Chunk plan for {sizes}: tiles within the memory budget ({memory_budget_GB():,.2f} GB) have sides of {side} cells, "
+                    f"less than the minimal tile side of {minimum}; the chunks of this plan exceed the budget")
+
+    # at least two chunks per worker
+    n_cells = math.prod(sizes[dim] for dim in sizes if dim in spatial_dims) if "land_cell" not in sizes else sizes["land_cell"]
+    side = min(side, int(math.sqrt(n_cells / (2 * workers))), chunk_settings["max_chunk"])
+    side = _align(side, minimum)
+    for dim in spatial_dims:
+        if dim in sizes:
+            chunks[dim] = min(side, sizes[dim])
+    if "land_cell" in sizes:
+        chunks["land_cell"] = min(side * side, sizes["land_cell"])
+    log.info(f"Chunk plan for {sizes} ({np.dtype(dtype).name}, {n_arrays} arrays): {chunks} "
+             f"({workers} workers, budget {memory_budget_GB():,.1f} GB)")
+    return chunks
+
+def chunks_for(obj, n_arrays:int=1, full_dims:list|None=None, log: logging.Logger=local_log) -> dict:
+    '''
+    plan_chunks for an xarray DataArray or Dataset (the largest dtype of its data variables).
+    '''
+    if hasattr(obj, "data_vars"):
+        dtypes = [da.dtype for da in obj.data_vars.values()] or [np.dtype("float64")]
+    else:
+        dtypes = [obj.dtype]
+    dtype = max(dtypes, key=lambda dtype: dtype.itemsize)
+    return plan_chunks(dict(obj.sizes), dtype, n_arrays, full_dims, log)
+
+def spatial_chunks(obj, n_arrays:int=1, full_dims:list|None=None, log: logging.Logger=local_log) -> tuple:
+    '''
+    (y, x) chunks of the plan, for dask arrays of (y, x) grids.
+    '''
+    chunks = chunks_for(obj, n_arrays, full_dims, log)
+    return chunks["y"], chunks["x"]
+
+def calibrate(sides:list|None=None, n_time:int=3, log: logging.Logger=local_log) -> dict:
+    '''
+    Short calibration run of the chunk kernels (regional sums, Kaya product) on random chunks of several tile sizes.
+    Sets the memory overhead (peak allocation per input byte) and the minimal tile (smallest tile with at least
+    90% of the best throughput, smaller tiles spend their time on task overhead).
+    '''
+    import downscaling.process_IPAT_factors as process_IPAT_factors
+    sides = sides or [256, 512, 1024, 2048]
+    rng = np.random.default_rng(0)
+    results = []
+    for side in sides:
+        values = [rng.random((n_time, side, side)) for _ in range(3)]
+        region_ids = rng.integers(0, 30, (side, side))
+        input_bytes = sum(value.nbytes for value in values)
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        process_IPAT_factors._regional_sums_block(process_IPAT_factors._kaya_block(*values), region_ids, 30)
+        seconds = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({"side": side, "overhead": 1 + peak / input_bytes, "cells_per_s": n_time * side * side / seconds})
+    best = max(result["cells_per_s"] for result in results)
+    _calibration["overhead"] = max(result["overhead"] for result in results)
+    _calibration["min_chunk"] = min(result["side"] for result in results if result["cells_per_s"] >= 0.9 * best)
+    for result in results:
+        log.info(f"Chunk calibration: tile {result['side']}, overhead {result['overhead']:.2f}, {result['cells_per_s'] / 1e6:,.1f} M cells/s")
+    log.info(f"Chunk calibration: overhead {_calibration['overhead']:.2f}, minimal tile {_calibration['min_chunk']}")
+    return dict(_calibration)
@@ -0,0 +1,129 @@
+import contextlib
+import logging
+import time
+from pathlib import Path
+
+import dask
+import dask.array as dask_array
+import numpy as np
+from dask.base import tokenize
+from dask.diagnostics import ProgressBar
+
+from tools.functions_logging import deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Local dask cluster for the downscaling
+# Without a cluster the computations run on the threaded scheduler of dask, with a progress bar while main.py runs.
+# With --cluster local:N a LocalCluster with N worker processes is started (cluster_settings): every worker has a
+# memory limit and spills to disk before it is paused or restarted, and GIL-bound steps (e.g. the regional sums and
+# the urban aggregation) run in parallel processes instead of threads of one process.
+# Read-only inputs that every chunk needs (the region raster, the IAM lookup tables) are scattered once to all
+# workers (shared_array), so they are not shipped with every graph.
+
+# arrays scattered to the workers of the current client, {token: future}
+_scattered = {}
+
+def parse_cluster(spec:str) -> int:
+    '''
+    Number of workers of a cluster specification "local:N".
+    '''
+    kind, _, n_workers = spec.partition(":")
+    if kind != "local" or not n_workers.isdigit() or int(n_workers) < 1:
+        raise ValueError(f"Unknown cluster '{spec}', use local:N (N worker processes, e.g. local:4)")
+    return int(n_workers)
+
+def get_client():
+    '''
+    The active distributed client, None when computations run on the threaded scheduler.
+    '''
+    try:
+        from dask.distributed import get_client as distributed_get_client
+        return distributed_get_client()
+    except (ImportError, ValueError):
+        return None
+
+def start_cluster(spec:str, log: logging.Logger=local_log):
+    '''
+    Start a LocalCluster following cluster_settings and connect a client to it.
+    Returns the client; the dashboard link is logged.
+    '''
+    from dask.distributed import Client, LocalCluster
+    n_workers = parse_cluster(spec)
+    cluster_settings = settings.cluster_settings
+    # fractions of the memory limit of a worker at which it spills to disk, pauses and is restarted
+    dask.config.set({"distributed.worker.memory.target": cluster_settings["memory_target"],
+                     "distributed.worker.memory.spill": cluster_settings["memory_spill"],
+                     "distributed.worker.memory.pause": cluster_settings["memory_pause"],
+                     "distributed.worker.memory.terminate": cluster_settings["memory_terminate"]})
+    cluster = LocalCluster(n_workers=n_workers,
+                           threads_per_worker=cluster_settings["threads_per_worker"],
+                           memory_limit=cluster_settings["memory_limit"],
+                           local_directory=cluster_settings["local_directory"],
+                           dashboard_address=cluster_settings["dashboard_address"],
+                           processes=True)
+    client = Client(cluster)
+    _scattered.clear()
+    log.info(f"{PRINT_COLORS['green']}Dask cluster: {n_workers} workers, {cluster_settings['threads_per_worker']} threads per worker, "
+             f"memory limit {cluster_settings['memory_limit']} per worker{PRINT_COLORS['end']}")
+    log.info(f"{PRINT_COLORS['green']}Dask dashboard: {client.dashboard_link}{PRINT_COLORS['end']}")
+    print(f"Dask dashboard: {client.dashboard_link}")
+    return client
+
+def close_cluster(client, log: logging.Logger=local_log):
+    _scattered.clear()
+    cluster = client.cluster
+    client.close()
+    if cluster is not None:
+        cluster.close()
+    log.info("Dask cluster closed")
+
+def shared_array(array:np.ndarray, chunks) -> dask_array.Array:
+    '''
+    Dask array of a read-only numpy array that is used by every chunk of a computation (region raster, lookup tables).
+    With a distributed client the array is scattered once to all workers and chunked there,
+    otherwise it is a plain dask_array.from_array.
+    '''
+    client = get_client()
+    if client is None:
+        return dask_array.from_array(array, chunks=chunks)
+    token = tokenize(array)
+    if token not in _scattered:
+        _scattered[token] = client.scatter(array, broadcast=True, hash=False)
+    return dask_array.from_delayed(dask.delayed(_scattered[token]), shape=array.shape, dtype=array.dtype).rechunk(chunks)
+
+@contextlib.contextmanager
+def compute_context(cluster:str|None, project_dir:Path, label:str, log: logging.Logger=local_log):
+    '''
+    Context for the computations of a main.py command: a LocalCluster (with a performance report
+    in log/dask if cluster_settings["performance_report"] or diagnostics_settings["enabled"] is set) or the threaded
+    scheduler with a progress bar (and the diagnostics of its compute calls, see dask_diagnostics.py).
+    '''
+    if cluster is None:
+        with ProgressBar():
+            if settings.diagnostics_settings["enabled"]:
+                import downscaling.dask_diagnostics as dask_diagnostics
+                with dask_diagnostics.capture(project_dir, label, log):
+                    yield None
+            else:
+                yield None
+        return
+
+    from dask.distributed import performance_report
+    client = start_cluster(cluster, log)
+    try:
+        if settings.cluster_settings["performance_report"] or settings.diagnostics_settings["enabled"]:
+            dir_report = project_dir / "log" / "dask"
+            dir_report.mkdir(parents=True, exist_ok=True)
+            file_report = dir_report / f"performance_{label}_{time.strftime('%Y%m%d_%H%M%S')}.html"
+            with performance_report(filename=str(file_report)):
+                yield client
+            log.info(f"Dask performance report: {file_report}")
+            print(f"Dask performance report: {file_report}")
+        else:
+            yield client
+    finally:
+        close_cluster(client, log)
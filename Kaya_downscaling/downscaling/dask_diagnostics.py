@@ -0,0 +1,185 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import dask
+from dask.callbacks import Callback
+from dask.diagnostics import Profiler
+from tabulate import tabulate
+
+from tools.functions_logging import deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Diagnostics of the dask computations
+# With diagnostics_settings["enabled"] (main.py --dask_diagnostics) every compute call on the threaded scheduler is
+# recorded by a dask callback: the call site in the downscaling code, the number of tasks of its graph, the wall
+# time, the time before the first task started (graph setup) and the time spent in tasks. The scheduler overhead of
+# a compute is its wall time minus the task time spread over the workers.
+# At the end the records are written to log/dask as JSON with a table per call site, and patterns that cost time
+# without doing work are flagged: many small computes from one call site (e.g. a compute per year or per block in a
+# loop), graphs with more tasks than huge_graph_tasks and computes dominated by scheduler overhead.
+# A dask performance report (bokeh html with the CPU and memory use) is written as well. The task stream (one record
+# per task) is only added with diagnostics_settings["task_profile"], and then for the first max_task_records tasks,
+# as on long runs with millions of tasks the records and the report would grow without limit.
+# On a local cluster (--cluster) the computes run on the distributed scheduler, which does not call these callbacks;
+# there the performance report of the cluster (see dask_cluster.compute_context) is written instead.
+
+_package_dir = str(Path(__file__).resolve().parents[1])
+
+def _call_site() -> str:
+    # innermost frame of the project code that is not this module
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(_package_dir) and not frame.filename.endswith("dask_diagnostics.py"):
+            return f"{Path(frame.filename).relative_to(_package_dir).as_posix()}:{frame.lineno} ({frame.name})"
+    return "unknown"
+
+class ComputeRecorder(Callback):
+    '''
+    Dask callback that records every compute call (call site, tasks, wall, startup, task and overhead time).
+    '''
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self._current = threading.local()
+
+    def _start(self, dsk):
+        self._current.record = {"call_site": _call_site(), "tasks": len(dsk), "t0": time.perf_counter(),
+                                "first_task": None, "task_s": 0.0, "workers": None}
+        self._current.started = {}
+
+    def _start_state(self, dsk, state):
+        self._current.record["workers"] = dask.config.get("num_workers", None)
+
+    def _pretask(self, key, dsk, state):
+        now = time.perf_counter()
+        record = self._current.record
+        if record["first_task"] is None:
+            record["first_task"] = now
+        self._current.started[key] = now
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        self._current.record["task_s"] += time.perf_counter() - self._current.started.pop(key, time.perf_counter())
+
+    def _finish(self, dsk, state, errored):
+        record = self._current.record
+        end = time.perf_counter()
+        workers = record.pop("workers") or settings.chunk_settings["workers"] or dask.system.CPU_COUNT
+        t0 = record.pop("t0")
+        first_task = record.pop("first_task")
+        record["wall_s"] = end - t0
+        record["startup_s"] = (first_task or end) - t0
+        record["overhead_s"] = max(0.0, record["wall_s"] - record["task_s"] / workers)
+        record["errored"] = bool(errored)
+        self.records.append(record)
+
+class TaskProfiler(Profiler):
+    '''
+    dask Profiler that keeps at most max_records tasks (and the graphs they belong to) for the performance report.
+    '''
+    def __init__(self, max_records:int):
+        super().__init__()
+        self.max_records = max_records
+        self.dropped = 0
+
+    def _start(self, dsk):
+        if len(self.results) < self.max_records:
+            super()._start(dsk)
+
+    def _finish(self, dsk, state, failed):
+        super()._finish(dsk, state, failed)
+        if len(self.results) > self.max_records:
+            self.dropped += len(self.results) - self.max_records
+            del self.results[self.max_records:]
+            self._dsk = {record.key: self._dsk[record.key] for record in self.results if record.key in self._dsk}
+
+def summary(records:list) -> list:
+    '''
+    Records aggregated per call site: computes, tasks, wall, task and overhead time, the busiest call sites first.
+    '''
+    sites = {}
+    for record in records:
+        site = sites.setdefault(record["call_site"], {"call_site": record["call_site"], "computes": 0, "small_computes": 0,
+                                                      "tasks": 0, "max_tasks": 0, "wall_s": 0.0, "task_s": 0.0, "overhead_s": 0.0})
+        site["computes"] += 1
+        site["small_computes"] += record["wall_s"] < settings.diagnostics_settings["small_compute_s"]
+        site["tasks"] += record["tasks"]
+        site["max_tasks"] = max(site["max_tasks"], record["tasks"])
+        for column in ["wall_s", "task_s", "overhead_s"]:
+            site[column] += record[column]
+    return sorted(sites.values(), key=lambda site: site["wall_s"], reverse=True)
+
+def find_issues(records:list) -> list:
+    '''
+    Pathological patterns per call site: many small computes, huge graphs and computes dominated by scheduler overhead.
+    '''
+    diagnostics_settings = settings.diagnostics_settings
+    issues = []
+    for site in summary(records):
+        if site["small_computes"] >= diagnostics_settings["many_small_computes"]:
+            issues.append(f"{site['call_site']}: {site['small_computes']} computes shorter than {diagnostics_settings['small_compute_s']} s "
+                          f"(compute once for all iterations, e.g. build one graph and call dask.compute on it)")
+        if site["max_tasks"] >= diagnostics_settings["huge_graph_tasks"]:
+            issues.append(f"{site['call_site']}: graph of {site['max_tasks']:,} tasks (larger chunks or fewer operations per chunk)")
+        if site["wall_s"] >= diagnostics_settings["min_wall_s"] and site["overhead_s"] >= diagnostics_settings["overhead_fraction"] * site["wall_s"]:
+            issues.append(f"{site['call_site']}: {100 * site['overhead_s'] / site['wall_s']:.0f}% of {site['wall_s']:,.1f} s is scheduler overhead "
+                          f"({site['tasks'] / site['computes']:,.0f} tasks per compute)")
+    return issues
+
+def write_diagnostics(records:list, dir_report:Path, label:str, log: logging.Logger=local_log) -> Path:
+    '''
+    Write the records, the summary per call site and the issues to dir_report as JSON and log the summary and the issues.
+    '''
+    dir_report.mkdir(parents=True, exist_ok=True)
+    file_diagnostics = dir_report / f"diagnostics_{label}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    sites = summary(records)
+    issues = find_issues(records)
+    with open(file_diagnostics, "w") as f:
+        json.dump({"label": label, "computes": len(records), "call_sites": sites, "issues": issues, "records": records}, f, indent=2)
+
+    columns = ["call_site", "computes", "small_computes", "tasks", "max_tasks", "wall_s", "task_s", "overhead_s"]
+    log.info(f"\n{PRINT_COLORS['purple']}Dask diagnostics: {len(records)} computes, {sum(record['tasks'] for record in records):,} tasks{PRINT_COLORS['end']}\n"
+             + tabulate([[site[column] for column in columns] for site in sites[:settings.diagnostics_settings["table_rows"]]],
+                        headers=columns, tablefmt="simple", floatfmt=",.2f", intfmt=","))
+    for issue in issues:
+        log.warning(f"{PRINT_COLORS['red']}Dask diagnostics: {issue}{PRINT_COLORS['end']}")
+    log.info(f"Dask diagnostics written to {file_diagnostics}")
+    return file_diagnostics
+
+@contextlib.contextmanager
+def capture(project_dir:Path, label:str, log: logging.Logger=local_log):
+    '''
+    Record the compute calls of the threaded scheduler within the context (see ComputeRecorder) and write the diagnostics
+    and a dask performance report (CPU and memory use, with diagnostics_settings["task_profile"] also the task stream)
+    to log/dask at the end.
+    '''
+    from dask.diagnostics import ResourceProfiler, visualize
+    diagnostics_settings = settings.diagnostics_settings
+    dir_report = project_dir / "log" / "dask"
+    recorder = ComputeRecorder()
+    profilers = [ResourceProfiler(dt=diagnostics_settings["resource_interval_s"])]
+    if diagnostics_settings["task_profile"]:
+        profilers.insert(0, TaskProfiler(diagnostics_settings["max_task_records"]))
+    with recorder, contextlib.ExitStack() as stack:
+        for profiler in profilers:
+            stack.enter_context(profiler)
+        yield recorder
+    write_diagnostics(recorder.records, dir_report, label, log)
+    if isinstance(profilers[0], TaskProfiler) and profilers[0].dropped:
+        log.warning(f"Dask diagnostics: task stream limited to the first {diagnostics_settings['max_task_records']:,} tasks, "
+                    f"{profilers[0].dropped:,} tasks not in the performance report")
+    if recorder.records:
+        file_report = dir_report / f"performance_{label}_{time.strftime('%Y%m%d_%H%M%S')}.html"
+        try:
+            visualize(profilers, filename=str(file_report), show=False, save=True)
+            log.info(f"Dask performance report: {file_report}")
+        except (ImportError, RuntimeError) as e:
+            # the report needs bokeh
+            log.warning(f"Dask performance report not written: {e}")
@@ -1,50 +1,52 @@
-import atexit
+from __future__ import annotations
+
 import time
 import logging
 import warnings
 import json
 
 from pathlib import Path
+from typing import Tuple
 
-from dask.distributed import get_client
 from dask import base as dask_base
 
 import numpy as np
 import pandas as pd
 from tabulate import tabulate
 
-import tkinter as tk
-from tkinter import filedialog, messagebox
-
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from scipy.ndimage import distance_transform_edt
 import rasterio
 import xarray as xr
-import rioxarray as rxr
-import cartopy.crs as ccrs
-import geopandas as gpd
-from geocube.api.core import make_geocube
+import rioxarray as rxr  # .rio accessor
 
-current_dir = Path(__file__).parent
-print(f"Current directory: {current_dir}")
+from tools.functions_logging import init_logging, deferred_logging
+from tools.general_functions import PRINT_COLORS, replace_punctuation_in_filenames, round_to_half, is_int_or_half, format_factor, apply_root_json, lazy_import
 
-from tools.functions_logging import init_logging
-from tools.general_functions import PRINT_COLORS, replace_punctuation_in_filenames, round_to_half, is_int_or_half, format_factor, apply_root_json
-from tools import convert_GIS
-
-import downscaling.plot_maps as plot_maps
 import downscaling.read_process_grid_data as process_grid_data
 import downscaling.read_process_IAM_data as process_IAM_data
 import downscaling.process_IPAT_factors as process_IPAT_factors
+import downscaling.land_cells as land_cells
+import downscaling.intermediate_cache as intermediate_cache
+import downscaling.grid_store as grid_store
+import downscaling.chunk_planner as chunk_planner
+import downscaling.pipeline as pipeline
+import downscaling.run_report as run_report
+import downscaling.time_interpolation as time_interpolation
 import downscaling.settings_models as settings_models
-import downscaling.upload_results_ee as upload_results_ee
 import downscaling.settings_downscaling as settings
 from downscaling.settings_downscaling import SOURCE_PROFILES
 
+# the plotting, GIS and Earth Engine stacks are imported when a command uses them (Tk only by compare_two_raster_files)
+plt = lazy_import("matplotlib.pyplot")
+cm = lazy_import("matplotlib.cm")
+ccrs = lazy_import("cartopy.crs")
+gpd = lazy_import("geopandas")
+convert_GIS = lazy_import("tools.convert_GIS")
+plot_maps = lazy_import("downscaling.plot_maps")
+upload_results_ee = lazy_import("downscaling.upload_results_ee")
+
 project_dir = Path(__file__).parent.parent
 log_path = f"{project_dir}/log/downscaling"
-debug_tmp_log, _ = init_logging(f"log_tmp", log_path)
+debug_tmp_log, _ = deferred_logging(f"log_tmp", log_path)
 
 def cleanup_empty_logs(log_path):
 
@@ -125,9 +127,10 @@ def determine_regions_file(project_dir:Path,
     log.info(f"Lowest resolution among datasets: {lowest_resolution_minutes} minutes")
     file_regions_stem = Path(settings_models.models[model]["file_model_grid_regions"]).stem
     file_regions_suffix = Path(settings_models.models[model]["file_model_grid_regions"]).suffix
-    file_path_file_model_grid_regions = project_dir / f"data/input/models/{model}/{file_regions_stem}_{lowest_resolution_minutes}_arcmin{file_regions_suffix}"
+    # the regions grid is written by create_GADM_region_raster in the storage format (see grid_store)
+    file_path_file_model_grid_regions = grid_store.find(project_dir / f"data/input/models/{model}/{file_regions_stem}_{lowest_resolution_minutes}_arcmin{file_regions_suffix}")
     log.info(f"Looking for model grid regions file at: {file_path_file_model_grid_regions}")
-    if not Path(file_path_file_model_grid_regions).exists():
+    if not grid_store.exists(file_path_file_model_grid_regions):
         # TO DO --> coarsen existing regions grid file
         log.warning(f"Model grid regions file not found at {file_path_file_model_grid_regions}. Please create the file with create_GADM_region_raster for the appropriate resolution.")
         log.info(f"Model grid regions file not found at {file_path_file_model_grid_regions}. Please create the file with create_GADM_region_raster for the appropriate resolution.")
@@ -135,17 +138,6 @@ def determine_regions_file(project_dir:Path,
 
     return file_path_file_model_grid_regions
 
-def reindex_and_interp(group, id_cols, years_downscaling):
-    # keys are the values of the id_cols for this group
-    keys = dict(zip(id_cols, group.name if isinstance(group.name, tuple) else (group.name,)))
-
-    return (
-        group.set_index("year")
-            .reindex(years_downscaling)
-            .assign(**keys)
-            .assign(value=lambda g: g["value"].interpolate("linear", limit_area="inside"))
-            .reset_index())
-
 def aggregate_urban_emissions(xr_emissions: xr.Dataset, gdf_urban_classification: gpd.GeoDataFrame,
                               emissions_varname: str = "Emissions_CO2_Excl_shipping_aviation_AFOLU",
                               region_varname: str = "region_number",
@@ -154,8 +146,10 @@ def aggregate_urban_emissions(xr_emissions: xr.Dataset, gdf_urban_classification
     '''
     Aggregate emissions per region and year, based on urban classification.
     '''
+    from geocube.api.core import make_geocube
+
     if not xr_emissions.chunks:
-        xr_emissions = xr_emissions.chunk({"time": 1, "y": 2048, "x": 2048})
+        xr_emissions = xr_emissions.chunk(chunk_planner.chunks_for(xr_emissions, n_arrays=2, log=log))
 
     # Derive available classification years from gdf_urban_classification's column names
     cluster_years = sorted(int(col.replace("cluster_", ""))
@@ -310,8 +304,9 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
     res_min_GDP_str = f"{res_min_GDP:.2f}" if res_min_GDP is not None else "None"
     debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_GDP: {res_min_GDP_str}{PRINT_COLORS["end"]}")
 
-    se_downscaling_file = dir_processed / f"{replace_punctuation_in_filenames(varname_SE)}_downscaling_{source_SE}_{version_SE}_{SSP_base}_cf_{coarse_factor_SE}.nc"
-    se_harmonised_file = dir_processed / f"{replace_punctuation_in_filenames(varname_SE)}_harmonised_{source_SE}_{version_SE}_{SSP_base}_cf_{coarse_factor_SE}.nc"
+    se_downscaling_file = grid_store.store_path(dir_processed / f"{replace_punctuation_in_filenames(varname_SE)}_downscaling_{source_SE}_{version_SE}_{SSP_base}_cf_{coarse_factor_SE}.nc")
+    se_harmonised_file = grid_store.store_path(dir_processed / f"{replace_punctuation_in_filenames(varname_SE)}_harmonised_{source_SE}_{version_SE}_{SSP_base}_cf_{coarse_factor_SE}.nc")
+    se_downscaling_land_file = grid_store.store_path(dir_processed / f"{replace_punctuation_in_filenames(varname_SE)}_downscaling_land_{source_SE}_{version_SE}_{SSP_base}_cf_{coarse_factor_SE}.nc")
 
     # with open("downscaling/settings_models.json", "r") as f:
     #     data = json.load(f)
@@ -322,9 +317,13 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
     # override to fixed downscaling years for SE (covers full century)
     years_downscaling = [2020, 2025, 2030, 2035, 2040, 2045, 2050, 2060, 2070, 2080, 2090, 2100]
 
+    report = run_report.new_report(f"{replace_punctuation_in_filenames(varname_SE)}_{source_version_grid}_{model_scenario}", kind="downscale_SE_data",
+                                   variable=variable_SE, profile=profile, model=model, scenario=scenario)
+
     # Step 1: Data inventory and setup
     # ----------------------------------------------------------------------------------------------------------
     debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario})Step 1: Data inventory and setup...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("SE_setup")
 
     #file_IAM_model_region_numbers = settings.file_IAM_model_region_numbers
     file_IAM_model_region_numbers = settings_models.models[model]["file_IAM_model_region_numbers"]
@@ -349,13 +348,13 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
                                                                          version=version_SE, SSP_base=SSP_base, coarse_factor=coarse_factor_SE,
                                                                          unit=unit_SE, save=False, check=False, log=debug_log)
     xr_se = xr_se.astype("float32")
-    xr_se = xr_se.chunk({"time": 1, "x": "auto", "y": "auto"})
+    xr_se = xr_se.chunk(chunk_planner.chunks_for(xr_se, n_arrays=3, log=debug_log))
     xr_se = xr_se.sortby("y", ascending=False)  # north-to-south
     xr_se = xr_se.sortby("x", ascending=True)   # west-to-east
     results_log.info(f"Time steps in gridded {variable_SE} data: {np.unique(xr_se['time'].values)}")
 
     # Read IAM regions grid and align with SE grid
-    xr_IAM_regions_grid = xr.open_dataset(file_path_file_model_grid_regions)
+    xr_IAM_regions_grid = grid_store.open_dataset(file_path_file_model_grid_regions)
     xr_IAM_regions_grid = xr_IAM_regions_grid.drop_vars("band", errors="ignore")
     xr_IAM_regions_grid = xr_IAM_regions_grid.sortby("y", ascending=False)  # north-to-south
     xr_IAM_regions_grid = xr_IAM_regions_grid.sortby("x", ascending=True)   # west-to-east
@@ -364,9 +363,12 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
 
     debug_log.info(f"{PRINT_COLORS["yellow"]}Region numbers: {np.unique(xr_IAM_regions_grid_downscaling['region_number'].values)}{PRINT_COLORS["end"]}")
 
+    run_report.end_step(report, record, log=debug_log)
+
     # Step 2: Prepare grid and model datasets for harmonisation
     # ----------------------------------------------------------------------------------------------------------
     debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario})Step 2: Prepare grid and model datasets for harmonisation...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("SE_prepare")
 
     #land_mask = (xr_IAM_regions_grid_downscaling["region_number"] > 0)
 
@@ -378,10 +380,7 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
     id_cols = ["model", "scenario", "region_code", "variable", "unit", "region_number"]
     df_IAM_projection_se_downscaling["year"] = df_IAM_projection_se_downscaling["year"].astype(int)
     df_IAM_projection_se_downscaling["value"] = df_IAM_projection_se_downscaling["value"].astype(float)
-    df_IAM_projection_se_downscaling = (df_IAM_projection_se_downscaling
-                                        .groupby(id_cols, group_keys=False)
-                                        .apply(lambda g: reindex_and_interp(g, id_cols, years_downscaling))
-                                        .reset_index(drop=True))
+    df_IAM_projection_se_downscaling = time_interpolation.interp_table(df_IAM_projection_se_downscaling, id_cols, years_downscaling)
     debug_log.info(f"Downscaling years in IAM projection: {df_IAM_projection_se_downscaling['year'].unique()}")
 
     # Convert IAM units to grid units
@@ -400,37 +399,48 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
     # Align gridded SE with downscaling years by linear interpolation
     # xr_se_downscaling = xr_se.interp(time=years_downscaling, method="linear")
     # xr_se.close(
-    if process_flags["process_SE"] or not se_downscaling_file.is_file():
+    record["cache"] = "miss" if process_flags["process_SE"] or not grid_store.exists(se_downscaling_file) else "hit"
+    if record["cache"] == "miss":
         debug_log.info(f"Aligning gridded SE data with downscaling years {years_downscaling} by linear interpolation...")
-        results = []
-        for year in years_downscaling:
-            debug_log.info(f"{year}")
-            xr_se_year = xr_se.interp(time=year, method="linear").compute()
-            results.append(xr_se_year)
+        # every year is blended lazily from its two bracketing source years and streamed to the store in one write
+        grid_store.save_dataset(time_interpolation.interp_years(xr_se, years_downscaling), se_downscaling_file, log=debug_log)
         xr_se.close()
-        xr_se_downscaling = xr.concat(results, dim="time")
-        del results
-        debug_log.info(f"Saving aligned gridded SE data to {se_downscaling_file}...")
-        xr_se_downscaling.to_netcdf(se_downscaling_file, mode="w", engine="netcdf4")
-        del xr_se_downscaling # re-read again to free up memory
     else:
         debug_log.info(f"Gridded SE data already aligned with downscaling years and saved at {se_downscaling_file}, skipping interpolation.")
-    xr_se_downscaling = xr.open_dataset(se_downscaling_file)
+    xr_se_downscaling = grid_store.open_dataset(se_downscaling_file)
     debug_log.info(f"Years in gridded {variable_SE} after alignment: {xr_se_downscaling.time.values}")
 
+    run_report.end_step(report, record, xr_se_downscaling, log=debug_log)
+
     # Step 3: Calculate regional sums for gridded data
     # ----------------------------------------------------------------------------------------------------------
     debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario})Step 3: Calculate regional grid sums for gridded data...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("SE_regional_sums")
+
+    # grid and region numbers used for the regional sums and the harmonisation
+    land_index = None
+    if process_flags["land_packed"]:
+        # regional sums and harmonisation on land cells only, the harmonised grid is scattered back to (y, x) when written
+        land_index = land_cells.build_land_index(xr_IAM_regions_grid_downscaling["region_number"], log=debug_log)
+        grid_store.save_dataset(land_cells.pack_land_dataset(xr_se_downscaling[[varname_SE]].sel(time=years_downscaling), land_index), se_downscaling_land_file)
+        xr_se_harm = grid_store.open_dataset(se_downscaling_land_file)
+        xr_regions_harm = land_index["xr_region_numbers"]
+    else:
+        xr_se_harm = xr_se_downscaling
+        xr_regions_harm = xr_IAM_regions_grid_downscaling
 
-    df_se_regional_sums_compare, xr_se_regional_sums = process_IPAT_factors.calc_regional_values(xr_se_downscaling, varname_SE,
-                                                                                                 xr_IAM_regions_grid_downscaling, df_IAM_projection_se_downscaling,
+    df_se_regional_sums_compare, xr_se_regional_sums = process_IPAT_factors.calc_regional_values(xr_se_harm, varname_SE,
+                                                                                                 xr_regions_harm, df_IAM_projection_se_downscaling,
                                                                                                  years_downscaling, debug_log)
     df_se_regional_sums_compare.to_csv(f"{project_dir}/data/check/step3_{varname_SE}_{source_SE}_regional_sums_comparison_{scenario}_{model}.csv", sep=";", index=False)
     debug_log.info(f"Regional sums for gridded {variable_SE} calculated and comparison saved to {project_dir}/data/check/step3_{varname_SE}_{source_SE}_regional_sums_comparison_{scenario}_{model}.csv")
 
+    run_report.end_step(report, record, log=debug_log)
+
     # Step 4: Calculate cell-specific correction factors
     # ----------------------------------------------------------------------------------------------------------
     debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario})Step 4: Calculate cell-specific correction factors for harmonisation...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("SE_correction_factors")
 
     # Build target regional values as an xarray (time × region_number)
     debug_log.info("4.1 building target regional values from IAM projections...")
@@ -445,45 +455,40 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
     xr_correction_factors_regional = xr_correction_factors_regional.transpose("time", "region_number")
     debug_log.info(f"Unique region numbers in correction factors: {np.unique(xr_correction_factors_regional.region_number.values)}")
 
-    # Map regional correction factors to the full spatial grid via vectorized xarray indexing.
-    # xr_correction_factors_regional has dims (time, region_number); region2d has dims (y, x).
-    # sel() broadcasts to produce a (time, y, x) DataArray without any explicit loop.
-    debug_log.info("4.2 mapping regional correction factors to spatial grid...")
+    # The correction factors stay a (time, region_number) table; they are mapped to the grid
+    # through the region raster while the harmonised data is written (step 5).
+    debug_log.info("4.2 correction factors are applied per region, no spatial correction factor grid is built...")
     region2d = xr_IAM_regions_grid_downscaling["region_number"].astype("int16")
-    xr_correction_factors = (xr_correction_factors_regional
-                                .sel(region_number=region2d)
-                                .drop_vars("region_number")).compute()
 
     if check_flags["check_SE_correction_factors"]:
         debug_log.info("Checking correction factors...")
-        cf_min = float(xr_correction_factors.where(xr_correction_factors > 0).min())
-        cf_max = float(xr_correction_factors.max())
+        cf_min = float(xr_correction_factors_regional.where(xr_correction_factors_regional > 0).min())
+        cf_max = float(xr_correction_factors_regional.max())
         debug_log.info(f"Min correction factor (>0): {cf_min:.6f}, Max correction factor: {cf_max:.6f}")
         csv_file_cf = dir_processed / f"correction_factors_regional_{varname_SE}_{source_SE}_{scenario}_{model}.csv"
         xr_correction_factors_regional.name = "regional_correction_factor"
         xr_correction_factors_regional.to_dataframe().reset_index().to_csv(csv_file_cf, sep=";", index=False)
 
+    run_report.end_step(report, record, log=debug_log)
+
     # Step 5: Apply harmonisation
     # ----------------------------------------------------------------------------------------------------------
     debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario})Step 5: Applying correction factors to grid data...{PRINT_COLORS["end"]}")
-
-    land_mask_2d = xr_IAM_regions_grid_downscaling["region_number"] > 0
-    results = []
-    for year in years_downscaling:
-        debug_log.info(f"  Applying correction factors for {year}...")
-        se_year = xr_se_downscaling[varname_SE].sel(time=year).astype("float32").compute()
-        se_year = xr_se_downscaling[varname_SE].sel(time=year).compute()
-        cf_year = xr_correction_factors.sel(time=year).where(land_mask_2d).compute()
-        harmonised_year = (se_year * cf_year).expand_dims(time=[year])
-        results.append(harmonised_year)
-        del se_year, cf_year
-    xr_se_harmonised = xr.concat(results, dim="time").to_dataset(name=varname_SE)
-    del results
-    xr_se_harmonised[varname_SE].attrs["unit"] = unit_SE
+    record = run_report.start_step("SE_harmonise")
+
+    # lazy gather-multiply: grid x correction_factor[time, region], ocean cells are masked (NaN)
+    xr_se_harmonised = process_IPAT_factors.apply_regional_factors(xr_se_harm[varname_SE].sel(time=years_downscaling),
+                                                                   xr_correction_factors_regional,
+                                                                   xr_regions_harm["region_number"],
+                                                                   debug_log)
+    if land_index is not None:
+        xr_se_harmonised = land_cells.unpack_land(xr_se_harmonised, land_index)
+    xr_se_harmonised = xr_se_harmonised.to_dataset(name=varname_SE)
+    xr_se_harmonised[varname_SE].attrs = {"unit": unit_SE}
 
     # Attach region number as a 2-D coordinate (mirrors downscale_emissions convention)
     debug_log.info("5.2 Attaching region numbers as 2-D coordinate to harmonised SE data...")
-    xr_se_harmonised = xr_se_harmonised.assign_coords(region_number=(("y", "x"), region2d.values))
+    xr_se_harmonised = xr_se_harmonised.assign_coords(region_number=(("y", "x"), region2d.data))
     xr_se_harmonised.coords["region_number"].attrs.update(long_name=f"{model} region number (0=ocean, 1-{nr_regions}=land regions)")
 
     arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_se_harmonised[varname_POP])
@@ -492,176 +497,72 @@ def downscale_SE_data(project_dir:Path, variable_SE: str, scenario: str, model:
     debug_log.info("5.3 Saving harmonised SE data to NetCDF...")
     #xr_se_harmonised = xr_se_harmonised.chunk({"time": 1, "x": "auto", "y": "auto"})
 
-    t0_compute = time.time()
-    debug_log.info("Computing harmonised SE data (this may take some time depending on the dataset size and chunking strategy)...")
-    xr_se_harmonised = xr_se_harmonised.compute()
-    debug_log.info(f"Computation took {time.time() - t0_compute:.1f} seconds")
-
     t0_save_ = time.time()
-    xr_se_harmonised.to_netcdf(se_harmonised_file, mode="w", engine="netcdf4")
-    debug_log.info(f"Writing took {time.time() - t0_save_:.1f} seconds")
+    debug_log.info("Computing and writing harmonised SE data chunk by chunk (this may take some time depending on the dataset size and chunking strategy)...")
+    verify_in_write = check_flags["check_SE_harmonised"] and process_flags["verify_harmonised_in_write"]
+    if verify_in_write:
+        # regional sums for the post-harmonisation check are accumulated while writing
+        df_se_corrected_compare, xr_regional_sums_corrected = process_IPAT_factors.write_and_calc_regional_values(xr_se_harmonised, varname_SE, se_harmonised_file,
+                                                                                                                  xr_se_harmonised["region_number"], df_IAM_projection_se_downscaling,
+                                                                                                                  years_downscaling, debug_log)
+    else:
+        grid_store.save_dataset(xr_se_harmonised, se_harmonised_file)
+    debug_log.info(f"Computing and writing took {time.time() - t0_save_:.1f} seconds")
+    xr_se_harmonised = grid_store.open_dataset(se_harmonised_file)
     debug_log.info(f"Harmonised {variable_SE} saved to {se_harmonised_file}")
 
     if process_flags["save_tiffs_results"]:
         debug_log.info(f"5.4 Saving harmonised {variable_SE} to GeoTIFF files in {dir_processed}...")
         plot_maps.save_to_grid_tiff(dir_processed, xr_se_harmonised, varname_SE, "_harmonised", years_downscaling, model, scenario)
 
+    run_report.end_step(report, record, xr_se_harmonised, log=debug_log)
+
     # Step 6: Post-harmonisation checks
     # ----------------------------------------------------------------------------------------------------------
     debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario})Step 6: Performing checks on harmonised data...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("SE_checks")
 
     if check_flags["check_SE_harmonised"]:
         process_grid_data.check_values_xr_dataarray(xr_se_harmonised[varname_SE], None, False, debug_log)
-        df_se_corrected_compare, xr_regional_sums_corrected = process_IPAT_factors.calc_regional_values(
-            xr_se_harmonised, varname_SE,
-            xr_IAM_regions_grid_downscaling, df_IAM_projection_se_downscaling,
-            years_downscaling)
+        if not verify_in_write:
+            df_se_corrected_compare, xr_regional_sums_corrected = process_IPAT_factors.calc_regional_values(
+                xr_se_harmonised, varname_SE,
+                xr_IAM_regions_grid_downscaling, df_IAM_projection_se_downscaling,
+                years_downscaling)
         csv_file_check = dir_processed / f"{varname_SE}_{source_SE}_regional_sums_post_harmonisation_{scenario}_{model}.csv"
         df_se_corrected_compare.to_csv(csv_file_check, sep=";", index=False)
         debug_log.info(f"Post-harmonisation regional sums comparison saved to {csv_file_check}")
 
+    run_report.end_step(report, record, log=debug_log)
+
     xr_se_downscaling.close()
     xr_se_harmonised.close()
     xr_IAM_regions_grid_downscaling.close()
 
     elapsed_time = time.time() - start_time
     debug_log.info(f"\n{PRINT_COLORS["green"]}Total elapsed time: {elapsed_time:,.2f} seconds or ({elapsed_time/60:.2f} minutes).{PRINT_COLORS["end"]}")
+    run_report.write_report(report, project_dir, debug_log)
 
-def downscale_emissions(project_dir:Path, scenario:str, model:str="IMAGE", profile:str="default", net_emissions:bool=True):
-
-    # Make sure program stops (and not only give a warning) if divided by zero, invalid value, or overvflow
-    # Set up logging and warnings
-    warnings.filterwarnings("error", message="divide by zero", category=RuntimeWarning)
-    warnings.filterwarnings("error", message="invalid value", category=RuntimeWarning)
-    warnings.filterwarnings("error", message="overflow", category=RuntimeWarning)
-
-    # start timing
-    start_time = time.time()
-
-    # read profile
-    if profile not in settings.SOURCE_PROFILES:
-        available = list(settings.SOURCE_PROFILES.keys())
-        raise ValueError(f"Unknown source profile '{profile}'. Available: {available}")
-    else:
-        sources = settings.SOURCE_PROFILES[profile]
-
-    # settings
-    #coarse_factor_SE:int = 12 # 12 (2UP)
-    #coarse_factor_GDP:float = 1.2 # 12 (Wang), 1.2 (Murakam version_2021_1)
-    #coarse_factor_EM:int =  1 # EDGAR
-    coarse_factor_POP, coarse_factor_GDP, coarse_factor_EM, \
-    res_min_POP, res_min_GDP, res_min_EM = process_grid_data.get_coarsening_factors(
-                                                                population_source=sources["source_POP"],
-                                                                gdp_source=sources["source_GDP"],
-                                                                emissions_source=sources["source_EM"])
-
-
-    coarse_factor_POP_str = f"{format_factor(coarse_factor_POP)}"
-    coarse_factor_GDP_str = f"{format_factor(coarse_factor_GDP)}"
-    coarse_factor_EM_str = f"{format_factor(coarse_factor_EM)}"
-    print(f"Coarsening factors as string- Population: {coarse_factor_POP_str}, GDP: {coarse_factor_GDP_str}, Emissions: {coarse_factor_EM_str}")
-
-    source_POP = sources["source_POP"]
-    version_POP = sources["version_POP"]
-    source_GDP = sources["source_GDP"]
-    version_GDP = sources["version_GDP"]
-    source_EM = sources["source_EM"]
-    version_EM = sources["version_EM"]
-
-    base_year = settings.base_year
+def read_process_IAM_data_emissions(project_dir:Path, dir_processed:Path, profile:str, model:str, scenario:str, gross_net:str,
+                                    net_emissions:bool, start_time:float, debug_log:logging.Logger) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    '''
+    Read and process the IAM data of one scenario for the emissions downscaling (steps 1.2, 2.1.2 and 2.2.2).
+    Returns the processed IAM data, the IAM GDP (PPP) per capita, the IAM emissions (extended to the convergence year)
+    and the IAM emissions per GDP (PPP).
+    '''
     years_downscaling = settings.years_downscaling
     convergence_year = settings.convergence_year
     method_extension = settings.method_extension
     vars_downscaling = settings.vars_downscaling
     process_flags = settings.process_flags
-    check_flags   = settings.check_flags
 
     varname_GDP = settings.varname_GDP
     varname_POP = settings.varname_POP
     varname_EM = settings.varname_EM
     varname_gdp_per_pop = settings.varname_gdp_per_pop
-    varname_em_per_gdp_ppp = settings.varname_em_per_gdp_ppp
-
-    unit_GDP_PPP = settings.unit_GDP_PPP
-    unit_POP = settings.unit_POP
-    unit_EM = settings.unit_EM
-
-    SSP_base = settings.SSP_base
-
-    # coarse_factor_POP, coarse_factor_GDP, coarse_factor_EM = process_grid_data.get_coarsening_factors(population_source="2UP",gdp_source="Murakami",emissions_source="EDGAR")
-    # print(f"Coarsening factors - Population: {coarse_factor_POP}, GDP: {coarse_factor_GDP}, Emissions: {coarse_factor_EM}")
-
-    # create output and processed directories
-    print(f"Project directory: {project_dir}")
-    gross_net = "net" if net_emissions else "gross"
-    source_version_grid = f"{source_POP}_{version_POP}_{source_GDP}_{version_GDP}_{source_EM}_{version_EM}_{gross_net}"
-    model_scenario = f"{model}_{scenario}"
-    dir_output = project_dir / "data" / "output"
-    dir_processed = project_dir / "data" / "processed" / profile / source_version_grid / model_scenario
-    print(f"Output directory: {dir_output}")
-    print(f"Processed data directory: {dir_processed}")
-    dir_output.mkdir(parents=True, exist_ok=True)
-    dir_processed.mkdir(parents=True, exist_ok=True)
-    dir_urban = project_dir / "data" / "processed" / "DLL"
-
-    log_path = f"{project_dir}/log/downscaling"
-    debug_log, results_log = init_logging(f"downscaling_emissions_{profile}_{source_version_grid}_{model_scenario}", log_path)
-    debug_log.info(f"\n\n{PRINT_COLORS['purple']}{'|'*100}{PRINT_COLORS['end']}")
-    debug_log.info(f"{PRINT_COLORS['purple']}Logging started{PRINT_COLORS['end']}")
-    debug_log.info(f"{PRINT_COLORS['purple']}{SOURCE_PROFILES[profile]}{PRINT_COLORS['end']}")
-    #results_log.info(SOURCE_PROFILES[profile])
 
-    #-------------------------------------------------------------------------------------------------------------------------
-    debug_log.info(f"\n0. Init {"-"*25}")
-    debug_log.info(f"Project directory: {project_dir}")
-    debug_log.info(f"Output directory: {dir_output}")
-    debug_log.info(f"Processed data directory: {dir_processed}")
-    debug_log.info(f"\n{PRINT_COLORS["yellow"]}{"net emissions" if net_emissions else "gross emissions"}{PRINT_COLORS["end"]}")
-    debug_log.info(f"\n{PRINT_COLORS["green"]}coarse_factor_EM: {coarse_factor_EM:.2f}{PRINT_COLORS["end"]}")
-    res_min_POP_str = f"{res_min_POP:.2f}" if res_min_POP is not None else "None"
-    debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_POP: {res_min_POP_str}{PRINT_COLORS["end"]}")
-    res_min_GDP_str = f"{res_min_GDP:.2f}" if res_min_GDP is not None else "None"
-    debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_GDP: {res_min_GDP_str}{PRINT_COLORS["end"]}")
-    res_min_EM_str = f"{res_min_EM:.2f}" if res_min_EM is not None else "None"
-    debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_EM: {res_min_EM_str}{PRINT_COLORS["end"]}")
-
-    file_path_file_model_grid_regions = determine_regions_file(project_dir, res_min_POP, res_min_GDP, res_min_EM, model, debug_log)
     file_IAM_model_region_numbers = settings_models.models[model]["file_IAM_model_region_numbers"]
 
-    pop_file = dir_processed / f"Population_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP_str}.nc"
-    gdp_ppp_file = dir_processed / f"GDP_PPP_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP_str}.nc"
-    em_file = dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_hist_{source_EM}_{version_EM}_{SSP_base}_cf_{coarse_factor_EM_str}.nc"
-    pop_processed_file = dir_processed / f"Population_processed_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP_str}.nc"
-    gdp_ppp_processed_file = dir_processed / f"GDP_PPP_processed_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP_str}.nc"
-    gdp_ppp_per_pop_file = dir_processed / f"GDP_PPP_per_pop_{source_GDP}_{version_GDP}_{source_POP}_{version_POP}_{SSP_base}.nc"
-    em_per_gdp_ppp_file = dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_per_gdp_ppp_{source_EM}_{version_EM}_{source_GDP}_{version_GDP}_{SSP_base}.nc"
-    em_unharmonised_file = dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_unharmonised_{SSP_base}.nc"
-    em_harmonised_file = dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_harmonised_{SSP_base}.nc"
-
-    # 1. Read and process gridded data
-    debug_log.info(f"\n\n1. Read and process gridded data {"-"*25}")
-
-    # 1.1 Read in IAM regions grid
-    debug_log.info(f"\n\n1.1. Read and process in IAM data {"-"*25}")
-    debug_log.info(f"\n\n(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Reading (and processing) IAM population, gdp, and emissionsdata...{PRINT_COLORS["end"]}")
-    xr_IAM_regions_grid = xr.open_dataset(file_path_file_model_grid_regions)
-    xr_IAM_regions_grid = xr_IAM_regions_grid.drop_vars("band", errors="ignore")
-    xr_IAM_regions_grid = xr_IAM_regions_grid.sortby("y", ascending=False)  # north-to-south
-    xr_IAM_regions_grid = xr_IAM_regions_grid.sortby("x", ascending=True)  # west-to-east
-    debug_log.info(f"Variable: {xr_IAM_regions_grid.data_vars}")
-    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_IAM_regions_grid["region_number"])
-    debug_log.info(f"resolution EM grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
-
-    debug_log.info(f"{PRINT_COLORS["yellow"]}region numbers: {np.unique(xr_IAM_regions_grid["region_number"].values)}{PRINT_COLORS["end"]}")
-    if process_flags["save_tiffs_intermediate"]:
-        xr_IAM_regions_grid_save = (xr_IAM_regions_grid
-                                    .assign_coords(time=2020)
-                                    .expand_dims("time"))
-        xr_IAM_regions_grid_save = xr_IAM_regions_grid_save.rio.set_spatial_dims(x_dim="x",  y_dim="y")
-        xr_IAM_regions_grid_save = xr_IAM_regions_grid_save.rio.write_crs("EPSG:4326")
-        xr_IAM_regions_grid_save = xr_IAM_regions_grid_save.rio.write_transform()
-        plot_maps.save_to_grid_tiff(dir_processed, xr_IAM_regions_grid_save, "region_number", "", [2020], model, scenario)
-
     # 1.2 Read and process in IAM data
     debug_log.info(f"\n\n1.2. Read and process in IAM data {"-"*25}")
     if process_flags["read_process_IAM"]:
@@ -673,194 +574,7 @@ def downscale_emissions(project_dir:Path, scenario:str, model:str="IMAGE", profi
         file_path = dir_processed / f"IAM_{model}_{scenario}_processed.csv"
         df_IAM = pd.read_csv(file_path, sep=";")
 
-    # TO DO --> reindex populatoin, GDP, and emissions with xr_IAM_regions_grid to ensure alignment with the grid, especially if the grid has been modified or reprojected.
-    # Now reprojections (for GDP) givea a small error of 0.67%
-    #       CHECK: regions_grid needs to have a similar or higher resolution.
-    # tolerance = max(new_res_x, new_res_y) / 2
-    # xr_IAM_regions_coarse = xr_IAM_regions_grid.reindex_like(da_coarsened, method="nearest", tolerance=tolerance)
-
-    # 1.3 read POP data
-    debug_log.info(f"\n\n1.3. Read POP data {"-"*25}")
-    df_population = None
-    xr_population = None
-    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Reading (and processing) population data...{PRINT_COLORS["end"]}")
-    if process_flags["read_process_POP"] or pop_file.is_file()==False:
-        save_POP = True
-        # read population data
-        xr_population, f_population = process_grid_data.read_process_grid_data_socioeconomic(dir_processed=dir_processed, varname=varname_POP, source=source_POP, version=version_POP, SSP_base=SSP_base,
-                                                                                             coarse_factor=coarse_factor_POP, unit=unit_POP, save=False, check=check_flags["check_POP_data"], log=debug_log)
-        debug_log.info(f"{PRINT_COLORS["yellow"]}xr_population - [{xr_population.x.min().item()}, {xr_population.x.max().item()}{PRINT_COLORS["end"]}]")
-        if check_flags["check_POP_data"]:
-            locs_test = process_grid_data.check_data_locations(xr_population[varname_POP],2020)
-            for l in locs_test:
-                debug_log.info(f"Locations with non-zero population in 2020: {l}")
-        xr_population = xr_population.sortby("y", ascending=False)  # north-to-south
-        xr_population = xr_population.sortby("x", ascending=True)  # west-to-east
-        xr_population.to_netcdf(pop_file, mode="w", engine="netcdf4")
-        debug_log.info(f"Variable: {xr_population.data_vars})")
-        arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_population[varname_POP])
-        debug_log.info(f"resolution POP grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
-
-        debug_log.info(f"{PRINT_COLORS["blue"]}Population data nodata, CRS and transform after read/process:{PRINT_COLORS["end"]}")
-        debug_log.info(f"nodata: {PRINT_COLORS["blue"]}{xr_population[varname_POP].rio.nodata}{PRINT_COLORS["end"]}")
-        debug_log.info(f"_FillValue: {PRINT_COLORS["blue"]}{xr_population.encoding.get('_FillValue')}{PRINT_COLORS["end"]}")
-        debug_log.info(f"crs: {PRINT_COLORS["blue"]}{xr_population.rio.crs}{PRINT_COLORS["end"]}")
-        debug_log.info(f"transform:\n{PRINT_COLORS["blue"]}{xr_population.rio.transform()}{PRINT_COLORS["end"]}")
-        debug_log.info(f"unit: {PRINT_COLORS["blue"]}{xr_population[varname_POP].attrs["unit"]}{PRINT_COLORS["end"]}")
-    else:
-        if not pop_file.is_file():
-            debug_log.info(f"{PRINT_COLORS["red"]}Population file not found at {pop_file}, cannot read data. Please set process_POP to True to process and save the data.{PRINT_COLORS["end"]}")
-            exit()
-        xr_population = xr.open_dataset(pop_file)
-    if process_flags["save_tiffs_intermediate"]:
-        plot_maps.save_to_grid_tiff(dir_processed, xr_population, varname_POP, "", [2020, 2030, 2050], model, scenario, False)
-
-    debug_log.info("--------------------------------")
-
-    # 1.4 read GDP (PPP) data
-    debug_log.info(f"\n\n1.4. Read GDP (PPP) data {"-"*25}")
-    f_gdp_ppp = None
-    xr_gdp_ppp = None
-    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Reading (and processing) GDP (PPP) data...{PRINT_COLORS["end"]}")
-    #if source_GDP=="Murakami" and version_GDP=="version_2021_1":
-    #        xr_gdp_ppp = xr.open_dataset("Z:/cold_data_storage/users/roelfsemam/data_downscaling/GDP_PPP/processed\Murakami\processed_version_2021_1/SSP2/GDP_PPP_Murakami_SSP2_cf_12.nc")
-    if process_flags["read_process_GDP_PPP"] or gdp_ppp_file.is_file()==False:
-        save_GDP = True
-        # read GDP data
-        xr_gdp_ppp, f_gdp_ppp = process_grid_data.read_process_grid_data_socioeconomic(dir_processed=dir_processed, varname=varname_GDP, source=source_GDP, version=version_GDP, SSP_base=SSP_base,
-                                                                                       coarse_factor=coarse_factor_GDP, unit=unit_GDP_PPP, save=False, check=check_flags["check_GDP_data"], log=debug_log)
-        debug_log.info(f"{PRINT_COLORS["yellow"]}xr_gdp_ppp - [{xr_gdp_ppp.x.min().item()}, {xr_gdp_ppp.x.max().item()}{PRINT_COLORS["end"]}]")
-        xr_gdp_ppp = xr_gdp_ppp.sortby("y", ascending=False)  # north-to-south
-        xr_gdp_ppp = xr_gdp_ppp.sortby("x", ascending=True)  # west-to-east
-        xr_gdp_ppp.to_netcdf(gdp_ppp_file, mode="w", engine="netcdf4")
-        debug_log.info("--------------------------------")
-        debug_log.info("process_grid_data.read_process_grid_data_socioeconomic")
-        debug_log.info(f"{PRINT_COLORS["blue"]}GDP (PPP) data nodata, CRS and transform after read/process:{PRINT_COLORS["end"]}")
-        debug_log.info(f"nodata: {PRINT_COLORS["blue"]}{xr_gdp_ppp[varname_GDP].rio.nodata}{PRINT_COLORS["end"]}")
-        debug_log.info(f"_FillValue: {PRINT_COLORS["blue"]}{xr_gdp_ppp.encoding.get('_FillValue')}{PRINT_COLORS["end"]}")
-        debug_log.info(f"crs: {PRINT_COLORS["blue"]}{xr_gdp_ppp.rio.crs}{PRINT_COLORS["end"]}")
-        debug_log.info(f"transform:\n{PRINT_COLORS["blue"]}{xr_gdp_ppp.rio.transform()}{PRINT_COLORS["end"]}")
-        debug_log.info(f"unit: {PRINT_COLORS["blue"]}{xr_gdp_ppp[varname_GDP].attrs["unit"]}{PRINT_COLORS["end"]}")
-    else:
-        if not gdp_ppp_file.is_file():
-            debug_log.info(f"{PRINT_COLORS["red"]}GDP (PPP) file not found at {gdp_ppp_file}, cannot read data. Please set process_GDP to True to process and save the data.{PRINT_COLORS["end"]}")
-            exit()
-        xr_gdp_ppp = xr.open_dataset(gdp_ppp_file)
-    if process_flags["save_tiffs_intermediate"]:
-            plot_maps.save_to_grid_tiff(dir_processed, xr_gdp_ppp, varname_GDP, "", [2020, 2030, 2050], model, scenario, False)
-
-    debug_log.info("--------------------------------")
-
-    # 1.5 Read CO2 emissions data
-    debug_log.info(f"\n\n1.5. Read CO2 emissions data {"-"*25}")
-    f_emissions = None
-    xr_emissions = None
-    debug_log.info(f"\n(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Reading (and processing) emissions data...{PRINT_COLORS["end"]}")
-    if process_flags["read_process_EM"] or em_file.is_file()==False:
-        save_EM = True
-        xr_emissions, f_emissions = process_grid_data.read_process_grid_data_EM(dir_processed, varname=varname_EM, unit=unit_EM, source=source_EM, version=version_EM,
-                                                                                base_year=base_year, coarse_factor=coarse_factor_EM, save=False, log=debug_log)
-        debug_log.info(f"{PRINT_COLORS["yellow"]}xr_emissions - [{xr_emissions.x.min().item()}, {xr_emissions.x.max().item()}{PRINT_COLORS["end"]}]")
-        xr_emissions = xr_emissions.sortby("y", ascending=False)  # north-to-south
-        xr_emissions = xr_emissions.sortby("x", ascending=True)  # west-to-east
-        xr_IAM_regions_grid = xr_IAM_regions_grid.reindex_like(xr_emissions.sel(time=base_year), method="nearest", tolerance=arc_minutes/60/2) # reindex to population grid (nearest neighbor with tolerance of half a grid cell)
-        xr_emissions.to_netcdf(em_file, mode="w", engine="netcdf4")
-        debug_log.info(f"unit: {PRINT_COLORS["blue"]}{xr_emissions[varname_EM].attrs["unit"]}{PRINT_COLORS["end"]}")
-    else:
-        if not em_file.is_file():
-            debug_log.info(f"{PRINT_COLORS["red"]}Emissions file not found at {em_file}, cannot read data. Please set process_EM to True to process and save the data.{PRINT_COLORS["end"]}")
-            exit()
-        xr_emissions = xr.open_dataset(em_file)
-    unit_EM = xr_emissions[varname_EM].attrs["unit"]
-    debug_log.info("--------------------------------")
-    if process_flags["save_tiffs_intermediate"]:
-        plot_maps.save_to_grid_tiff(dir_processed, xr_emissions, varname_EM, "", [2020], model, scenario, False)
-
-    # Checks
-    # Check if data is read in successfully
-    if xr_population is None or xr_gdp_ppp is None or xr_emissions is None:
-        debug_log.info("Population, GDP (PPP) or emissions data not available. Cannot proceed further.")
-        exit()
-    # compare resolution
-    debug_log.info(f"Variable: {xr_population.data_vars})")
-    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_population[varname_POP])
-    debug_log.info(f"resolution POP grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
-    debug_log.info(f"Variable: {xr_gdp_ppp.data_vars})")
-    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_gdp_ppp[varname_GDP])
-    debug_log.info(f"resolution GDP grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
-    debug_log.info(f"Variable: {xr_emissions.data_vars})")
-    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_emissions[varname_EM])
-    debug_log.info(f"resolution EM grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
-
-    # 1.6 Read in urban classification
-    debug_log.info(f"\n\n1.6. Read urban classification data {"-"*25}")
-    debug_log.info(f"{PRINT_COLORS["green"]}Reading urban classification data from: {dir_urban / 'urban_classification_years.parquet'}{PRINT_COLORS["end"]}")
-    path_urban = dir_urban / "urban_classification_years.parquet"
-    gdf_urban = gpd.read_parquet(path_urban)
-
-    #----------------------------------------------------------------------------------------------------------------------------------------
-    # 2. Process data
-    debug_log.info(f"\n\n2. Process data {"-"*25}")
-
-    # 2.1 Calculate GDP_PPP per capita
-    debug_log.info(f"\n\n2.1. Calculate GDP_PPP per capita {"-"*25}")
-
-    # 2.1.1 Grid data
-    debug_log.info(f"\n\n2.1.1 Grid data{"-"*25}")
-    debug_log.info(f"\n(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Processing GDP and population data for downscaling...{PRINT_COLORS["end"]}")
-    if check_flags["check_IAM_grid_data"]:
-        plot_maps.plot_factors_GDP_POP(project_dir, xr_population, xr_gdp_ppp, None, year=2020, coarsen=12)
-    # align, downscale, and set pop to 1 where gdp>0
-    if process_flags["process_GDP_POP_grid"]:
-        debug_log.info(f"{PRINT_COLORS["yellow"]}CHECK:{PRINT_COLORS["end"]}")
-        debug_log.info(f"Unit population: {xr_population[varname_POP].attrs.get("unit", "N/A")}")
-        debug_log.info(f"Unit GDP (PPP): {xr_gdp_ppp[varname_GDP].attrs.get("unit", "N/A")}")
-        xr_population_processed, xr_gdp_ppp_processed = process_IPAT_factors.process_factors_GDP_POP(xr_population, xr_gdp_ppp, xr_emissions,
-                                                                                                     varname_POP, varname_GDP,
-                                                                                                     unit_POP, unit_GDP_PPP,
-                                                                                                     years_downscaling, check_flags["check_GDP_POP"])
-
-        debug_log.info(f"{PRINT_COLORS["yellow"]}xr_population_processed - [{xr_population_processed.x.min().item()}, {xr_population_processed.x.max().item()}{PRINT_COLORS["end"]}]")
-        debug_log.info(f"{PRINT_COLORS["yellow"]}xr_gdp_ppp_processed - [{xr_gdp_ppp_processed.x.min().item()}, {xr_gdp_ppp_processed.x.max().item()}{PRINT_COLORS["end"]}]")
-        process_IPAT_factors.check_POP_GDP_alignment(dir_processed, xr_population_processed, xr_gdp_ppp_processed, varname_POP, varname_GDP)
-        xr_population_processed = xr_population_processed.reindex_like(xr_emissions.sel(time=base_year), method="nearest", tolerance=1e-5)
-        xr_gdp_ppp_processed = xr_gdp_ppp_processed.reindex_like(xr_emissions.sel(time=base_year), method="nearest", tolerance=1e-5)
-        xr_population_processed.to_netcdf(pop_processed_file, mode="w", engine="netcdf4")
-        xr_gdp_ppp_processed.to_netcdf(gdp_ppp_processed_file, mode="w", engine="netcdf4")
-        debug_log.info(f"time steps pop: {xr_population_processed[varname_POP].time.values}")
-        debug_log.info(f"time steps gdp_per_pop: {xr_gdp_ppp_processed[varname_GDP].time.values}")
-        xr_gdp_ppp_per_population = process_IPAT_factors.calculate_gdp_per_pop(xr_population_processed, xr_gdp_ppp_processed,
-                                                                               varname_POP, varname_GDP, varname_gdp_per_pop,
-                                                                               unit_POP, unit_GDP_PPP)
-        xr_gdp_ppp_per_population.to_netcdf(gdp_ppp_per_pop_file, mode="w", engine="netcdf4")
-        ds_check = xr.open_dataset(gdp_ppp_per_pop_file, decode_coords="all")
-    else:
-        xr_population_processed = xr.open_dataset(pop_processed_file)
-        xr_gdp_ppp_processed = xr.open_dataset(gdp_ppp_processed_file)
-        xr_gdp_ppp_per_population = xr.open_dataset(gdp_ppp_per_pop_file, decode_coords="all")
-    if process_flags["save_tiffs_intermediate"]:
-        plot_maps.save_to_grid_tiff(dir_processed, xr_population_processed, varname_POP, "_processed", [2020, 2030, 2050], model, scenario)
-        plot_maps.save_to_grid_tiff(dir_processed, xr_gdp_ppp_processed, varname_GDP, "_processed", [2020, 2030, 2050], model, scenario)
-        plot_maps.save_to_grid_tiff(dir_processed, xr_gdp_ppp_per_population, varname_gdp_per_pop, "", [2020, 2030, 2050], model, scenario)
-
-    del xr_population, xr_gdp_ppp
-
-    if check_flags["check_grid_GDP_per_pop"]:
-        debug_log.info("--------------------------------")
-        debug_log.info("xr_gdp_ppp_per_population")
-        debug_log.info(f"varname: {varname_gdp_per_pop}")
-        debug_log.info(f"Type: {type(varname_gdp_per_pop)}")
-        debug_log.info(xr_gdp_ppp_per_population)
-        process_grid_data.count_values_rio_xarray(xr_gdp_ppp_per_population, varname_gdp_per_pop, 2020, debug_log)
-        process_IPAT_factors.check_location_for_GDP_per_pop_calculation(xr_gdp_ppp_per_population, varname_gdp_per_pop)
-
     # 2.1.2 IAM data
-    debug_log.info(f"\n\n2.1.2 IAM data{"-"*25}")
-    # reindex IAM regions grid with population and GDP grid
-    debug_log.info(f"\n(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Harmonising IAM regions grid with population and GDP grid...{PRINT_COLORS["end"]}")
-
-    xr_IAM_regions_grid_downscaling = xr_IAM_regions_grid.reindex_like(xr_emissions, method="nearest", tolerance=1e-5)
-
     # calculate model GDP per capita
     csv_file = dir_processed / f"IAM_{model}_{scenario}_projection_gdp_per_pop.csv"
     if process_flags["process_GDP_per_POP"]:
@@ -877,28 +591,6 @@ def downscale_emissions(project_dir:Path, scenario:str, model:str="IMAGE", profi
     else:
         df_IAM_projection_gdp_ppp_per_population = pd.read_csv(csv_file, sep=";")
 
-    if check_flags["check_IAM_GDP_per_pop"]:
-        # 2.1.3 compare IAM and grid data for GDP per capita
-        df_grid, df_compare = process_IPAT_factors.compare_IAM_grid_regions_GDP_per_capita(xr_gdp_ppp_per_population, varname_gdp_per_pop,
-                                                                            xr_population_processed, varname_POP,
-                                                                            df_IAM_projection_gdp_ppp_per_population,
-                                                                            xr_IAM_regions_grid_downscaling)
-        debug_log.info(df_grid.to_string(index=False))
-        debug_log.info(df_compare.to_string())
-        csv_file_grid = dir_processed / f"selection_grid_gdp_per_pop.csv"
-        csv_file_compare = dir_processed / f"compare_IAM_grid_gdp_per_pop.csv"
-        df_grid.to_csv(csv_file_grid, sep=";", index=False)
-        df_compare.to_csv(csv_file_compare, sep=";", index=True)
-
-    # 2.2 Calculate EM per GDP (PPP)
-    debug_log.info(f"\n\n2.2. Calculate EM per GDP (PPP) {"-"*25}")
-    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Calculating EM per GDP (PPP) for IAM data...{PRINT_COLORS["end"]}")
-
-    # 2.2.1 process grid data
-    debug_log.info(f"\n\n2.2.1 Process grid data {"-"*25}")
-    debug_log.info(xr_gdp_ppp_processed)
-    debug_log.info(xr_emissions)
-
     # 2.2.2 process IAM (including the column names which are made lowercase)
     debug_log.info(f"\n\n2.2.2 Process grid data {"-"*25}")
     df_IAM_GDP = pd.DataFrame(df_IAM[df_IAM["variable"]==varname_GDP])
@@ -928,104 +620,602 @@ def downscale_emissions(project_dir:Path, scenario:str, model:str="IMAGE", profi
     else:
         df_IAM_projection_em_per_gdp_ppp = pd.read_csv(csv_file_em_per_gdp_ppp, sep=";")
 
-    # 2.2.3 Pocess grid emissions per GDP (PPP)
+    return df_IAM, df_IAM_projection_gdp_ppp_per_population, df_IAM_EM, df_IAM_projection_em_per_gdp_ppp
+
+def calc_urban_emissions(xr_em:xr.Dataset, xr_em_grid_correction:xr.Dataset, xr_IAM_regions_grid_downscaling:xr.Dataset,
+                         gdf_urban:gpd.GeoDataFrame, varname_EM:str, dir_output:Path,
+                         profile:str, scenario:str, gross_net:str, start_time:float, debug_log:logging.Logger):
+    '''
+    Aggregate the unharmonised and harmonised emission grids of one scenario to urban and rural emissions per region (step 2.4)
+    and write the results to dir_output.
+    '''
+    # 2.4 Calculate urban emissions
+    debug_log.info(f"\n\n2.4.1 Calculate urban emissions {"-"*25}")
+
+    # 2.4.1 Unharmonised
+    debug_log.info(f"\n\n2.4.1 Unharmonised {"-"*25}")
+    debug_log.info(f"\n\n(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Calculating urban emissions...{PRINT_COLORS["end"]}")
+    debug_log.info(f"unharmonised emissions")
+    # add regions to xr_em
+    xr_em_regions = xr_em.copy()
+    xr_em_regions["region_number"] = xr_IAM_regions_grid_downscaling["region_number"]
+    xr_em_urban_unharmonised, df_em_urban_unharmonised, df_em_rural_unharmonised = aggregate_urban_emissions(xr_emissions=xr_em_regions, gdf_urban_classification=gdf_urban,
+                                                                                   emissions_varname=varname_EM,
+                                                                                   region_varname="region_number",
+                                                                                   final_year=2050)
+    df_em_urban_unharmonised.to_csv(dir_output / f"Emissions_urban_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
+    df_em_rural_unharmonised.to_csv(dir_output / f"Emissions_rural_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
+    # combine dataframes for urban and rural emissions into one dataset, add the sum of urban and rural as "total", and using "urban", "rural" and "total" as a column names
+    df_em_urban_unharmonised["Type"] = "urban"
+    df_em_rural_unharmonised["Type"] = "rural"
+    df_combined_unharmonised = pd.concat([df_em_urban_unharmonised, df_em_rural_unharmonised], ignore_index=True)
+    df_combined_unharmonised.to_csv(dir_output / f"Emissions_combined_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
+    # add total = urban + rural
+    df_total_unharmonised = df_combined_unharmonised.groupby(["model", "scenario", "region_code", "region_number", "year", "unit"]).agg({"value": "sum"}).reset_index()
+    df_total_unharmonised["Type"] = "total"
+    df_total_unharmonised.to_csv(dir_output / f"Emissions_total_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
+
+    try:
+        grid_store.save_dataset(xr_em_urban_unharmonised, dir_output / f"Emissions_urban_region_{scenario}_{profile}_unharmonised.nc", log=debug_log)
+    except Exception as e:
+        debug_log.error(f"Error occurred while saving urban emissions NetCDF file: {e}")
+
+    # 2.4.2 Harmonised
+    debug_log.info(f"\n\n2.4.2 Harmonised {"-"*25}")
+    xr_em_urban_harmonised, df_em_urban_harmonised, df_em_rural_harmonised = aggregate_urban_emissions(xr_emissions=xr_em_grid_correction, gdf_urban_classification=gdf_urban,
+                                                                               emissions_varname=varname_EM,
+                                                                               region_varname="region_number",
+                                                                               final_year=2050)
+    df_em_urban_harmonised.to_csv(dir_output / f"Emissions_urban_classification_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
+    df_em_rural_harmonised.to_csv(dir_output / f"Emissions_rural_classification_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
+    # combine dataframes for urban and rural emissions into one dataset, add the sum of urban and rural as "total", and using "urban", "rural" and "total" as a column names
+    df_em_urban_harmonised["Type"] = "urban"
+    df_em_rural_harmonised["Type"] = "rural"
+    df_combined_harmonised = pd.concat([df_em_urban_harmonised, df_em_rural_harmonised], ignore_index=True)
+    df_combined_harmonised.to_csv(dir_output / f"Emissions_combined_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
+    # add total = urban + rural
+    df_total_harmonised = df_combined_harmonised.groupby(["model", "scenario", "region_code", "region_number", "year", "unit"]).agg({"value": "sum"}).reset_index()
+    df_total_harmonised["Type"] = "total"
+    df_total_harmonised.to_csv(dir_output / f"Emissions_total_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
+    try:
+        grid_store.save_dataset(xr_em_urban_harmonised, dir_output / f"Emissions_urban_classification_region_{scenario}_{profile}_harmonised.nc", log=debug_log)
+    except Exception as e:
+        debug_log.error(f"Error occurred while saving urban emissions NetCDF file: {e}")
+
+#************************** EMISSIONS PIPELINE *******************************************
+# The steps of the emissions downscaling are declared as pipeline steps (see pipeline.py) that share a context dict:
+# the settings and file paths of the run (emissions_context) and the outputs of the steps (named as the variables
+# they replaced). Steps with intermediate files are skipped or only opened when the cache finds the files up to date.
+
+def _progress(ctx:dict) -> str:
+    return f"(({(time.time()-ctx['start_time'])/60:,.1f} mins): {ctx['profile']}-{ctx['scenario']}-{ctx['gross_net']}"
+
+def emissions_context(project_dir:Path, dir_processed:Path, profile:str, model:str, scenario:str, net_emissions:bool,
+                      start_time:float, debug_log:logging.Logger, dir_processed_grid:Path|None=None) -> dict:
+    '''
+    Initial pipeline context of the emissions downscaling: run settings, directories and the paths of all intermediate files.
+    dir_processed_grid: directory of the scenario-independent grids if they are shared with other runs (default: dir_processed).
+    '''
+    dir_grid = dir_processed if dir_processed_grid is None else dir_processed_grid
+    sources = settings.SOURCE_PROFILES[profile]
+    coarse_factor_POP, coarse_factor_GDP, coarse_factor_EM, \
+    res_min_POP, res_min_GDP, res_min_EM = process_grid_data.get_coarsening_factors(
+                                                                population_source=sources["source_POP"],
+                                                                gdp_source=sources["source_GDP"],
+                                                                emissions_source=sources["source_EM"])
+    coarse_factor_POP_str = f"{format_factor(coarse_factor_POP)}"
+    coarse_factor_GDP_str = f"{format_factor(coarse_factor_GDP)}"
+    coarse_factor_EM_str = f"{format_factor(coarse_factor_EM)}"
+
+    source_POP, version_POP = sources["source_POP"], sources["version_POP"]
+    source_GDP, version_GDP = sources["source_GDP"], sources["version_GDP"]
+    source_EM, version_EM = sources["source_EM"], sources["version_EM"]
+    varname_EM_file = replace_punctuation_in_filenames(settings.varname_EM)
+    SSP_base = settings.SSP_base
+
+    # processed grids and intermediates in the storage format of storage_settings (see grid_store)
+    return {"project_dir": project_dir,
+            "dir_processed": dir_processed,
+            "dir_output": project_dir / "data" / "output",
+            "dir_urban": project_dir / "data" / "processed" / "DLL",
+            "profile": profile, "model": model, "scenario": scenario,
+            "net_emissions": net_emissions, "gross_net": "net" if net_emissions else "gross",
+            "start_time": start_time, "debug_log": debug_log,
+            "source_POP": source_POP, "version_POP": version_POP, "coarse_factor_POP": coarse_factor_POP,
+            "source_GDP": source_GDP, "version_GDP": version_GDP, "coarse_factor_GDP": coarse_factor_GDP,
+            "source_EM": source_EM, "version_EM": version_EM, "coarse_factor_EM": coarse_factor_EM,
+            "file_data_locations": Path(__file__).parent / "settings_data_locations.json",
+            "file_model_grid_regions": determine_regions_file(project_dir, res_min_POP, res_min_GDP, res_min_EM, model, debug_log),
+            "pop_file": grid_store.store_path(dir_grid / f"Population_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP_str}.nc"),
+            "gdp_ppp_file": grid_store.store_path(dir_grid / f"GDP_PPP_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP_str}.nc"),
+            "em_file": grid_store.store_path(dir_grid / f"{varname_EM_file}_hist_{source_EM}_{version_EM}_{SSP_base}_cf_{coarse_factor_EM_str}.nc"),
+            "pop_processed_file": grid_store.store_path(dir_grid / f"Population_processed_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP_str}.nc"),
+            "gdp_ppp_processed_file": grid_store.store_path(dir_grid / f"GDP_PPP_processed_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP_str}.nc"),
+            "gdp_ppp_per_pop_file": grid_store.store_path(dir_grid / f"GDP_PPP_per_pop_{source_GDP}_{version_GDP}_{source_POP}_{version_POP}_{SSP_base}.nc"),
+            "em_per_gdp_ppp_file": grid_store.store_path(dir_processed / f"{varname_EM_file}_per_gdp_ppp_{source_EM}_{version_EM}_{source_GDP}_{version_GDP}_{SSP_base}.nc"),
+            "em_unharmonised_file": grid_store.store_path(dir_processed / f"{varname_EM_file}_unharmonised_{SSP_base}.nc"),
+            "em_harmonised_file": grid_store.store_path(dir_processed / f"{varname_EM_file}_harmonised_{SSP_base}.nc"),
+            "em_unharmonised_land_file": grid_store.store_path(dir_processed / f"{varname_EM_file}_unharmonised_land_{SSP_base}.nc")}
+
+# 1.2 IAM data
+def _step_read_IAM(ctx:dict) -> dict:
+    df_IAM, df_IAM_projection_gdp_ppp_per_population, df_IAM_EM, df_IAM_projection_em_per_gdp_ppp = \
+        read_process_IAM_data_emissions(ctx["project_dir"], ctx["dir_processed"], ctx["profile"], ctx["model"], ctx["scenario"], ctx["gross_net"],
+                                        ctx["net_emissions"], ctx["start_time"], ctx["debug_log"])
+    return {"df_IAM": df_IAM,
+            "df_IAM_projection_gdp_ppp_per_population": df_IAM_projection_gdp_ppp_per_population,
+            "df_IAM_EM": df_IAM_EM,
+            "df_IAM_projection_em_per_gdp_ppp": df_IAM_projection_em_per_gdp_ppp}
+
+# 1.1 IAM regions grid
+def _step_read_regions(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    debug_log.info(f"\n\n1.1. Read and process in IAM data {"-"*25}")
+    debug_log.info(f"\n\n{_progress(ctx)}: {PRINT_COLORS["green"]}Reading (and processing) IAM regions grid...{PRINT_COLORS["end"]}")
+    xr_IAM_regions_grid = grid_store.open_dataset(ctx["file_model_grid_regions"])
+    xr_IAM_regions_grid = xr_IAM_regions_grid.drop_vars("band", errors="ignore")
+    xr_IAM_regions_grid = xr_IAM_regions_grid.sortby("y", ascending=False)  # north-to-south
+    xr_IAM_regions_grid = xr_IAM_regions_grid.sortby("x", ascending=True)  # west-to-east
+    debug_log.info(f"Variable: {xr_IAM_regions_grid.data_vars}")
+    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_IAM_regions_grid["region_number"])
+    debug_log.info(f"resolution regions grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
+
+    debug_log.info(f"{PRINT_COLORS["yellow"]}region numbers: {np.unique(xr_IAM_regions_grid["region_number"].values)}{PRINT_COLORS["end"]}")
+    return {"xr_IAM_regions_grid": xr_IAM_regions_grid, "arc_minutes_regions": arc_minutes}
+
+# 1.3 population
+def _key_read_POP(ctx:dict) -> str:
+    files_source = process_grid_data.source_files_socioeconomic(settings.varname_POP, ctx["source_POP"], ctx["version_POP"], settings.SSP_base, ctx["debug_log"])
+    return intermediate_cache.cache_key("read_process_POP", inputs=[ctx["file_data_locations"], *files_source],
+                                        params={"source": ctx["source_POP"], "version": ctx["version_POP"], "SSP_base": settings.SSP_base,
+                                                "coarse_factor": ctx["coarse_factor_POP"], "unit": settings.unit_POP},
+                                        code=[process_grid_data])
+
+def _step_read_POP(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    varname_POP = settings.varname_POP
+    debug_log.info(f"\n\n1.3. Read POP data {"-"*25}")
+    debug_log.info(f"{_progress(ctx)}: {PRINT_COLORS["green"]}Reading (and processing) population data...{PRINT_COLORS["end"]}")
+    xr_population, f_population = process_grid_data.read_process_grid_data_socioeconomic(dir_processed=ctx["dir_processed"], varname=varname_POP, source=ctx["source_POP"], version=ctx["version_POP"], SSP_base=settings.SSP_base,
+                                                                                         coarse_factor=ctx["coarse_factor_POP"], unit=settings.unit_POP, save=False, check=settings.check_flags["check_POP_data"], log=debug_log)
+    debug_log.info(f"{PRINT_COLORS["yellow"]}xr_population - [{xr_population.x.min().item()}, {xr_population.x.max().item()}{PRINT_COLORS["end"]}]")
+    if settings.check_flags["check_POP_data"]:
+        locs_test = process_grid_data.check_data_locations(xr_population[varname_POP],2020)
+        for l in locs_test:
+            debug_log.info(f"Locations with non-zero population in 2020: {l}")
+    xr_population = xr_population.sortby("y", ascending=False)  # north-to-south
+    xr_population = xr_population.sortby("x", ascending=True)  # west-to-east
+    grid_store.save_dataset(xr_population, ctx["pop_file"])
+    debug_log.info(f"Variable: {xr_population.data_vars})")
+    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_population[varname_POP])
+    debug_log.info(f"resolution POP grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
+
+    debug_log.info(f"{PRINT_COLORS["blue"]}Population data nodata, CRS and transform after read/process:{PRINT_COLORS["end"]}")
+    debug_log.info(f"nodata: {PRINT_COLORS["blue"]}{xr_population[varname_POP].rio.nodata}{PRINT_COLORS["end"]}")
+    debug_log.info(f"_FillValue: {PRINT_COLORS["blue"]}{xr_population.encoding.get('_FillValue')}{PRINT_COLORS["end"]}")
+    debug_log.info(f"crs: {PRINT_COLORS["blue"]}{xr_population.rio.crs}{PRINT_COLORS["end"]}")
+    debug_log.info(f"transform:\n{PRINT_COLORS["blue"]}{xr_population.rio.transform()}{PRINT_COLORS["end"]}")
+    debug_log.info(f"unit: {PRINT_COLORS["blue"]}{xr_population[varname_POP].attrs["unit"]}{PRINT_COLORS["end"]}")
+
+    return {"xr_population": xr_population}
+
+def _load_read_POP(ctx:dict) -> dict:
+    return {"xr_population": grid_store.open_dataset(ctx["pop_file"])}
+
+# 1.4 GDP (PPP)
+def _key_read_GDP(ctx:dict) -> str:
+    files_source = process_grid_data.source_files_socioeconomic(settings.varname_GDP, ctx["source_GDP"], ctx["version_GDP"], settings.SSP_base, ctx["debug_log"])
+    return intermediate_cache.cache_key("read_process_GDP_PPP", inputs=[ctx["file_data_locations"], *files_source],
+                                        params={"source": ctx["source_GDP"], "version": ctx["version_GDP"], "SSP_base": settings.SSP_base,
+                                                "coarse_factor": ctx["coarse_factor_GDP"], "unit": settings.unit_GDP_PPP},
+                                        code=[process_grid_data])
+
+def _step_read_GDP(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    varname_GDP = settings.varname_GDP
+    debug_log.info(f"\n\n1.4. Read GDP (PPP) data {"-"*25}")
+    debug_log.info(f"{_progress(ctx)}: {PRINT_COLORS["green"]}Reading (and processing) GDP (PPP) data...{PRINT_COLORS["end"]}")
+    xr_gdp_ppp, f_gdp_ppp = process_grid_data.read_process_grid_data_socioeconomic(dir_processed=ctx["dir_processed"], varname=varname_GDP, source=ctx["source_GDP"], version=ctx["version_GDP"], SSP_base=settings.SSP_base,
+                                                                                   coarse_factor=ctx["coarse_factor_GDP"], unit=settings.unit_GDP_PPP, save=False, check=settings.check_flags["check_GDP_data"], log=debug_log)
+    debug_log.info(f"{PRINT_COLORS["yellow"]}xr_gdp_ppp - [{xr_gdp_ppp.x.min().item()}, {xr_gdp_ppp.x.max().item()}{PRINT_COLORS["end"]}]")
+    xr_gdp_ppp = xr_gdp_ppp.sortby("y", ascending=False)  # north-to-south
+    xr_gdp_ppp = xr_gdp_ppp.sortby("x", ascending=True)  # west-to-east
+    grid_store.save_dataset(xr_gdp_ppp, ctx["gdp_ppp_file"])
+    debug_log.info("--------------------------------")
+    debug_log.info("process_grid_data.read_process_grid_data_socioeconomic")
+    debug_log.info(f"{PRINT_COLORS["blue"]}GDP (PPP) data nodata, CRS and transform after read/process:{PRINT_COLORS["end"]}")
+    debug_log.info(f"nodata: {PRINT_COLORS["blue"]}{xr_gdp_ppp[varname_GDP].rio.nodata}{PRINT_COLORS["end"]}")
+    debug_log.info(f"_FillValue: {PRINT_COLORS["blue"]}{xr_gdp_ppp.encoding.get('_FillValue')}{PRINT_COLORS["end"]}")
+    debug_log.info(f"crs: {PRINT_COLORS["blue"]}{xr_gdp_ppp.rio.crs}{PRINT_COLORS["end"]}")
+    debug_log.info(f"transform:\n{PRINT_COLORS["blue"]}{xr_gdp_ppp.rio.transform()}{PRINT_COLORS["end"]}")
+    debug_log.info(f"unit: {PRINT_COLORS["blue"]}{xr_gdp_ppp[varname_GDP].attrs["unit"]}{PRINT_COLORS["end"]}")
+
+    return {"xr_gdp_ppp": xr_gdp_ppp}
+
+def _load_read_GDP(ctx:dict) -> dict:
+    return {"xr_gdp_ppp": grid_store.open_dataset(ctx["gdp_ppp_file"])}
+
+# 1.5 CO2 emissions
+def _key_read_EM(ctx:dict) -> str:
+    files_source = process_grid_data.source_files_EM(ctx["source_EM"], ctx["version_EM"])
+    return intermediate_cache.cache_key("read_process_EM", inputs=[ctx["file_data_locations"], *files_source],
+                                        params={"source": ctx["source_EM"], "version": ctx["version_EM"], "base_year": settings.base_year,
+                                                "coarse_factor": ctx["coarse_factor_EM"], "unit": settings.unit_EM},
+                                        code=[process_grid_data])
+
+def _step_read_EM(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    varname_EM = settings.varname_EM
+    debug_log.info(f"\n\n1.5. Read CO2 emissions data {"-"*25}")
+    debug_log.info(f"\n{_progress(ctx)}: {PRINT_COLORS["green"]}Reading (and processing) emissions data...{PRINT_COLORS["end"]}")
+    xr_emissions, f_emissions = process_grid_data.read_process_grid_data_EM(ctx["dir_processed"], varname=varname_EM, unit=settings.unit_EM, source=ctx["source_EM"], version=ctx["version_EM"],
+                                                                            base_year=settings.base_year, coarse_factor=ctx["coarse_factor_EM"], save=False, log=debug_log)
+    debug_log.info(f"{PRINT_COLORS["yellow"]}xr_emissions - [{xr_emissions.x.min().item()}, {xr_emissions.x.max().item()}{PRINT_COLORS["end"]}]")
+    xr_emissions = xr_emissions.sortby("y", ascending=False)  # north-to-south
+    xr_emissions = xr_emissions.sortby("x", ascending=True)  # west-to-east
+    grid_store.save_dataset(xr_emissions, ctx["em_file"])
+    debug_log.info(f"unit: {PRINT_COLORS["blue"]}{xr_emissions[varname_EM].attrs["unit"]}{PRINT_COLORS["end"]}")
+
+    return {"xr_emissions": xr_emissions, "unit_EM": xr_emissions[varname_EM].attrs["unit"]}
+
+def _load_read_EM(ctx:dict) -> dict:
+    xr_emissions = grid_store.open_dataset(ctx["em_file"])
+    return {"xr_emissions": xr_emissions, "unit_EM": xr_emissions[settings.varname_EM].attrs["unit"]}
+
+# 1.6 urban classification
+def _step_read_urban(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    path_urban = ctx["dir_urban"] / "urban_classification_years.parquet"
+    debug_log.info(f"\n\n1.6. Read urban classification data {"-"*25}")
+    debug_log.info(f"{PRINT_COLORS["green"]}Reading urban classification data from: {path_urban}{PRINT_COLORS["end"]}")
+    return {"gdf_urban": gpd.read_parquet(path_urban)}
+
+# 2.1.1 align population and GDP (PPP) grids with the emissions grid
+def _key_process_GDP_POP_grid(ctx:dict) -> str:
+    return intermediate_cache.cache_key("process_GDP_POP_grid", inputs=[ctx["pop_file"], ctx["gdp_ppp_file"], ctx["em_file"]],
+                                        params={"years_downscaling": settings.years_downscaling, "base_year": settings.base_year},
+                                        code=[process_IPAT_factors.process_factors_GDP_POP])
+
+def _step_process_GDP_POP_grid(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    xr_population, xr_gdp_ppp, xr_emissions = ctx["xr_population"], ctx["xr_gdp_ppp"], ctx["xr_emissions"]
+    varname_POP, varname_GDP, varname_EM = settings.varname_POP, settings.varname_GDP, settings.varname_EM
+    base_year = settings.base_year
+    # compare resolution
+    for xr_grid, varname in [(xr_population, varname_POP), (xr_gdp_ppp, varname_GDP), (xr_emissions, varname_EM)]:
+        arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_grid[varname])
+        debug_log.info(f"resolution {varname} grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.1f} arc degrees")
+
+    debug_log.info(f"\n\n2.1.1 Grid data{"-"*25}")
+    debug_log.info(f"\n{_progress(ctx)}: {PRINT_COLORS["green"]}Processing GDP and population data for downscaling...{PRINT_COLORS["end"]}")
+    if settings.check_flags["check_IAM_grid_data"]:
+        plot_maps.plot_factors_GDP_POP(ctx["project_dir"], xr_population, xr_gdp_ppp, None, year=2020, coarsen=12)
+    # align, downscale, and set pop to 1 where gdp>0
+    debug_log.info(f"{PRINT_COLORS["yellow"]}CHECK:{PRINT_COLORS["end"]}")
+    debug_log.info(f"Unit population: {xr_population[varname_POP].attrs.get("unit", "N/A")}")
+    debug_log.info(f"Unit GDP (PPP): {xr_gdp_ppp[varname_GDP].attrs.get("unit", "N/A")}")
+    xr_population_processed, xr_gdp_ppp_processed = process_IPAT_factors.process_factors_GDP_POP(xr_population, xr_gdp_ppp, xr_emissions,
+                                                                                                 varname_POP, varname_GDP,
+                                                                                                 settings.unit_POP, settings.unit_GDP_PPP,
+                                                                                                 settings.years_downscaling, settings.check_flags["check_GDP_POP"])
+
+    debug_log.info(f"{PRINT_COLORS["yellow"]}xr_population_processed - [{xr_population_processed.x.min().item()}, {xr_population_processed.x.max().item()}{PRINT_COLORS["end"]}]")
+    debug_log.info(f"{PRINT_COLORS["yellow"]}xr_gdp_ppp_processed - [{xr_gdp_ppp_processed.x.min().item()}, {xr_gdp_ppp_processed.x.max().item()}{PRINT_COLORS["end"]}]")
+    process_IPAT_factors.check_POP_GDP_alignment(ctx["dir_processed"], xr_population_processed, xr_gdp_ppp_processed, varname_POP, varname_GDP)
+    xr_population_processed = xr_population_processed.reindex_like(xr_emissions.sel(time=base_year), method="nearest", tolerance=1e-5)
+    xr_gdp_ppp_processed = xr_gdp_ppp_processed.reindex_like(xr_emissions.sel(time=base_year), method="nearest", tolerance=1e-5)
+    grid_store.save_dataset(xr_population_processed, ctx["pop_processed_file"])
+    grid_store.save_dataset(xr_gdp_ppp_processed, ctx["gdp_ppp_processed_file"])
+    debug_log.info(f"time steps pop: {xr_population_processed[varname_POP].time.values}")
+    debug_log.info(f"time steps gdp_per_pop: {xr_gdp_ppp_processed[varname_GDP].time.values}")
+
+    return {"xr_population_processed": xr_population_processed, "xr_gdp_ppp_processed": xr_gdp_ppp_processed}
+
+def _load_process_GDP_POP_grid(ctx:dict) -> dict:
+    return {"xr_population_processed": grid_store.open_dataset(ctx["pop_processed_file"]),
+            "xr_gdp_ppp_processed": grid_store.open_dataset(ctx["gdp_ppp_processed_file"])}
+
+# 2.1.1 GDP (PPP) per capita
+def _key_gdp_per_pop(ctx:dict) -> str:
+    return intermediate_cache.cache_key("calculate_gdp_per_pop", inputs=[ctx["pop_processed_file"], ctx["gdp_ppp_processed_file"]],
+                                        code=[process_IPAT_factors.calculate_gdp_per_pop])
+
+def _step_gdp_per_pop(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    varname_gdp_per_pop = settings.varname_gdp_per_pop
+    # lazy (chunked) division, only evaluated when written or when used in the Kaya product
+    # population and GDP chunked alike, so the division is one task per chunk
+    chunks = chunk_planner.chunks_for(ctx["xr_gdp_ppp_processed"], n_arrays=3, log=debug_log)
+    xr_gdp_ppp_per_population = process_IPAT_factors.calculate_gdp_per_pop(ctx["xr_population_processed"].chunk(chunks),
+                                                                           ctx["xr_gdp_ppp_processed"].chunk(chunks),
+                                                                           settings.varname_POP, settings.varname_GDP, varname_gdp_per_pop,
+                                                                           settings.unit_POP, settings.unit_GDP_PPP)
+    if settings.process_flags["save_IPAT_factors_intermediate"]:
+        grid_store.save_dataset(xr_gdp_ppp_per_population, ctx["gdp_ppp_per_pop_file"])
+        xr_gdp_ppp_per_population = grid_store.open_dataset(ctx["gdp_ppp_per_pop_file"], decode_coords="all")
+
+    if settings.check_flags["check_grid_GDP_per_pop"]:
+        debug_log.info("--------------------------------")
+        debug_log.info("xr_gdp_ppp_per_population")
+        debug_log.info(f"varname: {varname_gdp_per_pop}")
+        debug_log.info(xr_gdp_ppp_per_population)
+        process_grid_data.count_values_rio_xarray(xr_gdp_ppp_per_population, varname_gdp_per_pop, 2020, debug_log)
+        process_IPAT_factors.check_location_for_GDP_per_pop_calculation(xr_gdp_ppp_per_population, varname_gdp_per_pop)
+
+    return {"xr_gdp_ppp_per_population": xr_gdp_ppp_per_population}
+
+def _load_gdp_per_pop(ctx:dict) -> dict:
+    return {"xr_gdp_ppp_per_population": grid_store.open_dataset(ctx["gdp_ppp_per_pop_file"], decode_coords="all")}
+
+# 2.1.2 IAM regions on the emissions grid
+def _step_regions_downscaling(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    debug_log.info(f"\n{_progress(ctx)}: {PRINT_COLORS["green"]}Harmonising IAM regions grid with population and GDP grid...{PRINT_COLORS["end"]}")
+    # nearest neighbour with a tolerance of half a cell of the regions grid
+    xr_IAM_regions_grid_downscaling = ctx["xr_IAM_regions_grid"].reindex_like(ctx["xr_emissions"].sel(time=settings.base_year), method="nearest",
+                                                                            tolerance=ctx["arc_minutes_regions"]/60/2)
+    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_IAM_regions_grid_downscaling["region_number"])
+    debug_log.info(f"resolution region grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.2f} arc degrees")
+
+    return {"xr_IAM_regions_grid_downscaling": xr_IAM_regions_grid_downscaling}
+
+# 2.1.3 compare IAM and grid data for GDP per capita
+def _step_compare_GDP_per_pop(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    df_grid, df_compare = process_IPAT_factors.compare_IAM_grid_regions_GDP_per_capita(ctx["xr_gdp_ppp_per_population"], settings.varname_gdp_per_pop,
+                                                                                       ctx["xr_population_processed"], settings.varname_POP,
+                                                                                       ctx["df_IAM_projection_gdp_ppp_per_population"],
+                                                                                       ctx["xr_IAM_regions_grid_downscaling"])
+    debug_log.info(df_grid.to_string(index=False))
+    debug_log.info(df_compare.to_string())
+    df_grid.to_csv(ctx["dir_processed"] / "selection_grid_gdp_per_pop.csv", sep=";", index=False)
+    df_compare.to_csv(ctx["dir_processed"] / "compare_IAM_grid_gdp_per_pop.csv", sep=";", index=True)
+    return {}
+
+# 2.2.3 base-year emissions per GDP (PPP)
+def _step_em_per_gdp_by(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    varname_GDP, varname_EM = settings.varname_GDP, settings.varname_EM
+    base_year = settings.base_year
     debug_log.info(f"\n\n2.2.3 Process grid emissions per GDP (PPP) {"-"*25}")
-    xr_gdp_ppp_by = xr_gdp_ppp_processed.sel(time=base_year)
+    xr_gdp_ppp_by = ctx["xr_gdp_ppp_processed"].sel(time=base_year)
     xr_gdp_ppp_by["name"] = varname_GDP
-    xr_gdp_ppp_by = xr_gdp_ppp_by.chunk({"x": "auto", "y": "auto"})
-    xr_em_by = xr_emissions.sel(time=base_year)
-    xr_em_by = xr_em_by.chunk({"x": "auto", "y": "auto"})
+    xr_gdp_ppp_by = xr_gdp_ppp_by.chunk(chunk_planner.chunks_for(xr_gdp_ppp_by, n_arrays=3, log=debug_log))
+    xr_em_by = ctx["xr_emissions"].sel(time=base_year)
+    xr_em_by = xr_em_by.chunk(chunk_planner.chunks_for(xr_em_by, n_arrays=3, log=debug_log))
 
     # check resoltuion
-    debug_log.info(f"Variable: {xr_em_by.data_vars})")
     arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_em_by[varname_EM])
     debug_log.info(f"resolution EM grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.2f} arc degrees")
-    debug_log.info(f"Variable: {xr_gdp_ppp_by.data_vars})")
     arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_gdp_ppp_by[varname_GDP])
     debug_log.info(f"resolution GDP (PPP) grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.2f} arc degrees")
-    debug_log.info(f"Variable: {xr_IAM_regions_grid_downscaling.data_vars})")
-    arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_IAM_regions_grid_downscaling["region_number"])
-    debug_log.info(f"resolution region grid: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.2f} arc degrees")
 
     # calculate CO2/GDP (PPP) for base year
     xr_em_per_gdp_ppp_by_downscaling = xr_em_by[varname_EM] / xr_gdp_ppp_by[varname_GDP].where(xr_gdp_ppp_by[varname_GDP] != 0)  # Avoid division by zero
-
-    # # check
-    # import dask.config
-    # with dask.config.set(scheduler="single-threaded"):
-    #     _ = xr_em_per_gdp_ppp_by_downscaling.compute()
-
     debug_log.info(xr_em_by[varname_EM].attrs["unit"])
     debug_log.info(xr_gdp_ppp_by[varname_GDP].attrs["unit"])
     xr_em_per_gdp_ppp_by_downscaling.attrs["unit"] = xr_em_by[varname_EM].attrs["unit"] + "/" + xr_gdp_ppp_by[varname_GDP].attrs["unit"]
-    xr_em_per_gdp_ppp_by_downscaling["name"] = varname_em_per_gdp_ppp
-    debug_log.info(f"Type xr_em_per_gdp_ppp_by_downscaling: {type(xr_em_per_gdp_ppp_by_downscaling)}")
+    xr_em_per_gdp_ppp_by_downscaling["name"] = settings.varname_em_per_gdp_ppp
+
+    return {"xr_gdp_ppp_by": xr_gdp_ppp_by, "xr_em_per_gdp_ppp_by_downscaling": xr_em_per_gdp_ppp_by_downscaling}
+
+# intermediate grids as GeoTIFF
+def _step_tiffs_grid(ctx:dict) -> dict:
+    dir_processed, model, scenario = ctx["dir_processed"], ctx["model"], ctx["scenario"]
+    xr_IAM_regions_grid_save = (ctx["xr_IAM_regions_grid"]
+                                .assign_coords(time=2020)
+                                .expand_dims("time"))
+    xr_IAM_regions_grid_save = xr_IAM_regions_grid_save.rio.set_spatial_dims(x_dim="x",  y_dim="y")
+    xr_IAM_regions_grid_save = xr_IAM_regions_grid_save.rio.write_crs("EPSG:4326")
+    xr_IAM_regions_grid_save = xr_IAM_regions_grid_save.rio.write_transform()
+    plot_maps.save_to_grid_tiff(dir_processed, xr_IAM_regions_grid_save, "region_number", "", [2020], model, scenario)
+    plot_maps.save_to_grid_tiff(dir_processed, ctx["xr_population"], settings.varname_POP, "", [2020, 2030, 2050], model, scenario, False)
+    plot_maps.save_to_grid_tiff(dir_processed, ctx["xr_gdp_ppp"], settings.varname_GDP, "", [2020, 2030, 2050], model, scenario, False)
+    plot_maps.save_to_grid_tiff(dir_processed, ctx["xr_emissions"], settings.varname_EM, "", [2020], model, scenario, False)
+    plot_maps.save_to_grid_tiff(dir_processed, ctx["xr_population_processed"], settings.varname_POP, "_processed", [2020, 2030, 2050], model, scenario)
+    plot_maps.save_to_grid_tiff(dir_processed, ctx["xr_gdp_ppp_processed"], settings.varname_GDP, "_processed", [2020, 2030, 2050], model, scenario)
+    plot_maps.save_to_grid_tiff(dir_processed, ctx["xr_gdp_ppp_per_population"], settings.varname_gdp_per_pop, "", [2020, 2030, 2050], model, scenario)
+    return {}
+
+def grid_steps_emissions(ctx:dict) -> dict:
+    '''
+    Pipeline steps of the scenario-independent grids of the emissions downscaling (steps 1.1, 1.3-1.6, 2.1.1, 2.1.2 and 2.2.3).
+    Population, GDP (PPP) and emissions are read concurrently; the read/process flags force the steps with files to rerun.
+    '''
+    process_flags = settings.process_flags
+    return {
+        "read_regions": pipeline.step(_step_read_regions, outputs=["xr_IAM_regions_grid", "arc_minutes_regions"]),
+        "read_POP": pipeline.step(_step_read_POP, outputs=["xr_population"],
+                                  files=["pop_file"], key=_key_read_POP, load=_load_read_POP, force=process_flags["read_process_POP"]),
+        "read_GDP": pipeline.step(_step_read_GDP, outputs=["xr_gdp_ppp"],
+                                  files=["gdp_ppp_file"], key=_key_read_GDP, load=_load_read_GDP, force=process_flags["read_process_GDP_PPP"]),
+        "read_EM": pipeline.step(_step_read_EM, outputs=["xr_emissions", "unit_EM"],
+                                 files=["em_file"], key=_key_read_EM, load=_load_read_EM, force=process_flags["read_process_EM"]),
+        "read_urban": pipeline.step(_step_read_urban, outputs=["gdf_urban"]),
+        "process_GDP_POP_grid": pipeline.step(_step_process_GDP_POP_grid, inputs=["xr_population", "xr_gdp_ppp", "xr_emissions"],
+                                              outputs=["xr_population_processed", "xr_gdp_ppp_processed"],
+                                              files=["pop_processed_file", "gdp_ppp_processed_file"], key=_key_process_GDP_POP_grid,
+                                              load=_load_process_GDP_POP_grid, force=process_flags["process_GDP_POP_grid"]),
+        # without the intermediate file GDP per capita is a lazy division that is always rebuilt
+        "gdp_per_pop": pipeline.step(_step_gdp_per_pop, inputs=["xr_population_processed", "xr_gdp_ppp_processed"],
+                                     outputs=["xr_gdp_ppp_per_population"],
+                                     files=["gdp_ppp_per_pop_file"] if process_flags["save_IPAT_factors_intermediate"] else [],
+                                     key=_key_gdp_per_pop, load=_load_gdp_per_pop),
+        "regions_downscaling": pipeline.step(_step_regions_downscaling, inputs=["xr_IAM_regions_grid", "arc_minutes_regions", "xr_emissions"],
+                                             outputs=["xr_IAM_regions_grid_downscaling"]),
+        "em_per_gdp_by": pipeline.step(_step_em_per_gdp_by, inputs=["xr_gdp_ppp_processed", "xr_emissions"],
+                                       outputs=["xr_gdp_ppp_by", "xr_em_per_gdp_ppp_by_downscaling"]),
+        "tiffs_grid": pipeline.step(_step_tiffs_grid, inputs=["xr_IAM_regions_grid", "xr_population", "xr_gdp_ppp", "xr_emissions",
+                                                              "xr_population_processed", "xr_gdp_ppp_processed", "xr_gdp_ppp_per_population"]),
+    }
+
+grid_targets_emissions = ["regions_downscaling", "gdp_per_pop", "em_per_gdp_by", "read_urban"]
+grid_outputs_emissions = ["xr_IAM_regions_grid_downscaling", "xr_population_processed", "xr_gdp_ppp_processed",
+                          "xr_gdp_ppp_per_population", "xr_gdp_ppp_by", "xr_em_per_gdp_ppp_by_downscaling", "gdf_urban", "unit_EM"]
+
+def read_process_grid_data_emissions(project_dir:Path, dir_processed:Path, profile:str, model:str, scenario:str, gross_net:str,
+                                     start_time:float, debug_log:logging.Logger, report:dict|None=None) -> dict:
+    '''
+    Read and process the scenario-independent grids of the emissions downscaling by running the grid steps
+    (see grid_steps_emissions): IAM regions grid, processed population and GDP (PPP), GDP (PPP) per capita,
+    base-year emissions per GDP (PPP) and the urban classification. The processed grids are written to and read from dir_processed.
+    Returns a dict with the grids (names as in downscale_emissions), the emissions unit and the paths of the files
+    the grids were read from (inputs for the cache keys of the steps after it).
+    report: run report the records of the grid steps are added to (see run_report.py).
+    '''
+    ctx = emissions_context(project_dir, dir_processed, profile, model, scenario, gross_net == "net", start_time, debug_log)
+    ctx = pipeline.run_pipeline(grid_steps_emissions(ctx), ctx, targets=grid_targets_emissions + (["tiffs_grid"] if settings.process_flags["save_tiffs_intermediate"] else []),
+                                report=report, log=debug_log)
+    grid_data = {name: ctx[name] for name in grid_outputs_emissions}
+    grid_data["files"] = {name: ctx[name] for name in ["file_model_grid_regions", "em_file", "pop_processed_file", "gdp_ppp_processed_file", "gdp_ppp_per_pop_file"]}
+
+    return grid_data
+
+# 2.3 unharmonised CO2 emissions grid (Kaya product)
+def _key_em_per_gdp_ppp(ctx:dict) -> str:
+    years_downscaling_extended = sorted(list(set(settings.years_downscaling + [settings.convergence_year])))
+    return intermediate_cache.cache_key("downscale_em_per_gdp",
+                                        inputs=[ctx["file_model_grid_regions"], ctx["em_file"], ctx["gdp_ppp_processed_file"]],
+                                        params={"years": years_downscaling_extended, "base_year": settings.base_year, "convergence_year": settings.convergence_year,
+                                                # content of the IAM table, the csv file is rewritten in every run
+                                                "IAM_em_per_gdp_ppp": intermediate_cache.file_digest(ctx["dir_processed"] / f"IAM_{ctx['model']}_{ctx['scenario']}_em_per_gdp_ppp.csv")},
+                                        code=[process_IPAT_factors.calc_scaling_factors_EM_per_GDP, process_IPAT_factors._scaling_factor_by_block,
+                                              process_IPAT_factors.downscale_em_per_gdp, process_IPAT_factors._em_per_gdp_block])
+
+def _key_kaya_emissions(ctx:dict) -> str:
+    return intermediate_cache.cache_key("calc_kaya_emissions",
+                                        inputs=[ctx["pop_processed_file"]],
+                                        params={"key_em_per_gdp_ppp": _key_em_per_gdp_ppp(ctx), "land_packed": settings.process_flags["land_packed"]},
+                                        code=[process_IPAT_factors.calculate_gdp_per_pop, process_IPAT_factors.calc_kaya_emissions])
+
+def _step_land_index(ctx:dict) -> dict:
+    if not settings.process_flags["land_packed"]:
+        return {"land_index": None}
+    # Kaya product, regional sums and harmonisation on land cells only, (y, x) grids are only written for export
+    return {"land_index": land_cells.build_land_index(ctx["xr_IAM_regions_grid_downscaling"]["region_number"], log=ctx["debug_log"])}
+
+def _step_kaya_emissions(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    process_flags = settings.process_flags
+    varname_POP, varname_EM = settings.varname_POP, settings.varname_EM
+    varname_gdp_per_pop, varname_em_per_gdp_ppp = settings.varname_gdp_per_pop, settings.varname_em_per_gdp_ppp
+    base_year, convergence_year = settings.base_year, settings.convergence_year
+    xr_IAM_regions_grid_downscaling = ctx["xr_IAM_regions_grid_downscaling"]
+    df_IAM_projection_em_per_gdp_ppp = ctx["df_IAM_projection_em_per_gdp_ppp"]
+    land_index = ctx["land_index"]
+    unit_EM = ctx["unit_EM"]
+
+    # 2.2 Calculate EM per GDP (PPP)
+    debug_log.info(f"\n\n2.2. Calculate EM per GDP (PPP) {"-"*25}")
+    xr_em_per_gdp_ppp_by_downscaling = ctx["xr_em_per_gdp_ppp_by_downscaling"]
     xr_em_per_gdp_ppp_by_downscaling.attrs["unit"] = df_IAM_projection_em_per_gdp_ppp["unit"].iloc[0]  # Update unit attribute
 
     # 2.3 Calculate CO2 emissions grid
     debug_log.info(f"\n\n2.3 Calculate CO2 emissions grid {"-"*25}")
-    if process_flags["process_grid_EM_per_GDP"]:
-        debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]} Calculating CO2 grid emissions...{PRINT_COLORS["end"]}")
-        # calculate emissions per GDP (PPP) for years after base year
-        debug_log.info("Calculating scaling factors...")
-        xr_scaling_factor_by, regions, x_coords, y_coords = process_IPAT_factors.calc_scaling_factors_EM_per_GDP(xr_IAM_regions_grid_downscaling, base_year,
-                                                                                                                 xr_gdp_ppp_by[varname_GDP], xr_em_per_gdp_ppp_by_downscaling,
-                                                                                                                 df_IAM_projection_em_per_gdp_ppp)
-        # downscale emissions per GDP (PPP) for years after base year
-        # Extend years to include target year if not present
-        years_downscaling_extended = sorted(list(set(years_downscaling + [convergence_year])))
-        debug_log.info("Downscaling emissions per GDP (PPP) for years after base year...")
-        xr_em_per_gdp_ppp =  process_IPAT_factors.downscale_em_per_gdp(xr_scaling_factor_by, varname_em_per_gdp_ppp,
-                                                                        xr_IAM_regions_grid_downscaling,
-                                                                        df_IAM_projection_em_per_gdp_ppp,
-                                                                        years_downscaling_extended, base_year, convergence_year,
-                                                                        regions, x_coords, y_coords)
-        xr_em_per_gdp_ppp.to_netcdf(em_per_gdp_ppp_file, mode="w", engine="netcdf4")
-        if process_flags["save_tiffs_intermediate"]:
-            plot_maps.save_to_grid_tiff(dir_processed, xr_em_per_gdp_ppp, varname_em_per_gdp_ppp, "", [2020, 2030, 2050], model, scenario)
-
-        # 2.3.1 Calculate grid emissions by applying IPAT factors to population and GDP per capita grids
-        debug_log.info(f"\n\n2.3.1 Calculate grid emissions by applying IPAT factors to population and GDP per capita grids {"-"*25}")
-        xr_gdp_ppp_per_population_processed = xr_gdp_ppp_per_population.copy()
-        xr_em = (xr_population_processed[varname_POP] * xr_gdp_ppp_per_population_processed[varname_gdp_per_pop] * xr_em_per_gdp_ppp[varname_em_per_gdp_ppp])
-        xr_em = xr_em.to_dataset(name=varname_EM)
-        xr_em[varname_EM].attrs["unit"] = unit_EM
-        xr_em.to_netcdf(em_unharmonised_file, mode="w", engine="netcdf4")
-    else:
-        xr_em = xr.open_dataset(em_unharmonised_file)
+    debug_log.info(f"{_progress(ctx)}: {PRINT_COLORS["green"]} Calculating CO2 grid emissions...{PRINT_COLORS["end"]}")
+    # Extend years to include target year if not present
+    years_downscaling_extended = sorted(list(set(settings.years_downscaling + [convergence_year])))
+    # calculate emissions per GDP (PPP) for years after base year
+    debug_log.info("Calculating scaling factors...")
+    xr_scaling_factor_by, regions, x_coords, y_coords = process_IPAT_factors.calc_scaling_factors_EM_per_GDP(xr_IAM_regions_grid_downscaling, base_year,
+                                                                                                             ctx["xr_gdp_ppp_by"][settings.varname_GDP], xr_em_per_gdp_ppp_by_downscaling,
+                                                                                                             df_IAM_projection_em_per_gdp_ppp)
+    # downscale emissions per GDP (PPP) for years after base year
+    debug_log.info("Downscaling emissions per GDP (PPP) for years after base year...")
+    xr_em_per_gdp_ppp =  process_IPAT_factors.downscale_em_per_gdp(xr_scaling_factor_by, varname_em_per_gdp_ppp,
+                                                                    xr_IAM_regions_grid_downscaling,
+                                                                    df_IAM_projection_em_per_gdp_ppp,
+                                                                    years_downscaling_extended, base_year, convergence_year,
+                                                                    regions, x_coords, y_coords)
+    if process_flags["save_IPAT_factors_intermediate"]:
+        em_per_gdp_ppp_file = ctx["em_per_gdp_ppp_file"]
+        grid_store.save_dataset(xr_em_per_gdp_ppp, em_per_gdp_ppp_file)
+        intermediate_cache.register(em_per_gdp_ppp_file, _key_em_per_gdp_ppp(ctx), "downscale_em_per_gdp", debug_log)
+        # the downscaled cube is lazy, reopen the written file so it is not evaluated again below
+        xr_em_per_gdp_ppp = grid_store.open_dataset(em_per_gdp_ppp_file)
     if process_flags["save_tiffs_intermediate"]:
-        plot_maps.save_to_grid_tiff(dir_processed, xr_em, varname_EM, "_unharmonised", [2020, 2030, 2050], model, scenario)
-
-    del xr_population_processed, xr_gdp_ppp_processed, xr_gdp_ppp_per_population
+        plot_maps.save_to_grid_tiff(ctx["dir_processed"], xr_em_per_gdp_ppp, varname_em_per_gdp_ppp, "", [2020, 2030, 2050], ctx["model"], ctx["scenario"])
+
+    # 2.3.1 Calculate grid emissions by applying IPAT factors to population and GDP per capita grids
+    debug_log.info(f"\n\n2.3.1 Calculate grid emissions by applying IPAT factors to population and GDP per capita grids {"-"*25}")
+    # fused lazy Kaya product, streamed to disk chunk by chunk
+    if land_index is not None:
+        xr_em_land = process_IPAT_factors.calc_kaya_emissions(land_cells.pack_land_dataset(ctx["xr_population_processed"][[varname_POP]], land_index), varname_POP,
+                                                              land_cells.pack_land_dataset(ctx["xr_gdp_ppp_per_population"][[varname_gdp_per_pop]], land_index), varname_gdp_per_pop,
+                                                              land_cells.pack_land_dataset(xr_em_per_gdp_ppp[[varname_em_per_gdp_ppp]], land_index), varname_em_per_gdp_ppp,
+                                                              varname_EM, unit_EM, debug_log)
+        grid_store.save_dataset(xr_em_land, ctx["em_unharmonised_land_file"])
+        # export (time, y, x)
+        grid_store.save_dataset(land_cells.unpack_land_dataset(grid_store.open_dataset(ctx["em_unharmonised_land_file"]), land_index), ctx["em_unharmonised_file"])
+    else:
+        xr_em = process_IPAT_factors.calc_kaya_emissions(ctx["xr_population_processed"], varname_POP,
+                                                         ctx["xr_gdp_ppp_per_population"], varname_gdp_per_pop,
+                                                         xr_em_per_gdp_ppp, varname_em_per_gdp_ppp,
+                                                         varname_EM, unit_EM, debug_log)
+        grid_store.save_dataset(xr_em, ctx["em_unharmonised_file"])
+
+    return _load_kaya_emissions(ctx)
+
+def _load_kaya_emissions(ctx:dict) -> dict:
+    xr_em = grid_store.open_dataset(ctx["em_unharmonised_file"])
+    xr_em_land = grid_store.open_dataset(ctx["em_unharmonised_land_file"]) if settings.process_flags["land_packed"] else None
+    return {"xr_em": xr_em, "xr_em_land": xr_em_land}
+
+# 2.3.2 - 2.3.4 harmonisation
+def _step_harmonise_emissions(ctx:dict) -> dict:
+    debug_log = ctx["debug_log"]
+    process_flags = settings.process_flags
+    varname_EM = settings.varname_EM
+    years_downscaling = settings.years_downscaling
+    model, scenario, profile = ctx["model"], ctx["scenario"], ctx["profile"]
+    dir_output, dir_processed = ctx["dir_output"], ctx["dir_processed"]
+    xr_IAM_regions_grid_downscaling = ctx["xr_IAM_regions_grid_downscaling"]
+    land_index = ctx["land_index"]
+    df_IAM_EM = ctx["df_IAM_EM"]
+    unit_EM = ctx["unit_EM"]
+
+    # grid and region numbers used for the regional sums and the harmonisation
+    if land_index is not None:
+        xr_em_harm = ctx["xr_em_land"]
+        xr_regions_harm = land_index["xr_region_numbers"]
+    else:
+        xr_em_harm = ctx["xr_em"]
+        xr_regions_harm = xr_IAM_regions_grid_downscaling
 
     # 2.3.2 harmonise grid emissions per region with IAM emissions per region
     debug_log.info(f"\n\n2.3.2 Harmonise grid emissions per region with IAM emissions per region {"-"*25}")
-    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}:{PRINT_COLORS["green"]}: Harmonising grid emissions per region with IAM emissions per region...{PRINT_COLORS["end"]}")
+    debug_log.info(f"{_progress(ctx)}:{PRINT_COLORS["green"]}: Harmonising grid emissions per region with IAM emissions per region...{PRINT_COLORS["end"]}")
     years = df_IAM_EM["year"].unique()
     variable = df_IAM_EM["variable"].unique()[0]
     extra_rows = pd.DataFrame({"model": model, "scenario": scenario, "region_code":"OCEAN", "variable":variable, "year": years, "unit": unit_EM, "region_number": 0, "value": 0})
     df_IAM_EM_harm = pd.concat([df_IAM_EM, extra_rows], ignore_index=True).sort_values(["year", "region_number"]).reset_index(drop=True)
-    df_IAM_EM_compare, xr_regional_sums = process_IPAT_factors.calc_regional_values(xr_em, varname_EM,
-                                                                                    xr_IAM_regions_grid_downscaling, df_IAM_EM_harm,
+    df_IAM_EM_compare, xr_regional_sums = process_IPAT_factors.calc_regional_values(xr_em_harm, varname_EM,
+                                                                                    xr_regions_harm, df_IAM_EM_harm,
                                                                                     years_downscaling)
     csv_file_compare = dir_output / f"Emissions_region_{scenario}_{profile}_unharmonised.csv"
     df_IAM_EM_compare.to_csv(csv_file_compare, sep=";", index=False)
 
     # 2.3.3 Calculate harmonisation factor for grid emissions per region with IAM emissions per region
     debug_log.info(f"\n\n2.3.3 Calculate harmonisation factors for grid emissions per region with IAM emissions per region {"-"*25}")
-    xr_em_correction_factors = process_IPAT_factors.calculate_harmonisation_factors_emissions(xr_em, varname_EM, xr_regional_sums,
-                                                                                              xr_IAM_regions_grid_downscaling, df_IAM_EM_harm,
+    xr_em_correction_factors = process_IPAT_factors.calculate_harmonisation_factors_emissions(xr_em_harm, varname_EM, xr_regional_sums,
+                                                                                              xr_regions_harm, df_IAM_EM_harm,
                                                                                               years_downscaling)
+    csv_file_cf = dir_processed / f"correction_factors_regional_{replace_punctuation_in_filenames(varname_EM)}_{scenario}_{model}.csv"
+    xr_em_correction_factors.to_dataframe().reset_index().to_csv(csv_file_cf, sep=";", index=False)
 
     # 2.3.4 apply harmonisation factors to grid emissions
     debug_log.info(f"\n\n2.3.4 Apply harmonisation factors to grid emissions {"-"*25}")
     xr_em_grid_correction = process_IPAT_factors.apply_harmonisation_factors_emissions(xr_em_correction_factors,
-                                                                                       xr_em, varname_EM,
-                                                                                       xr_IAM_regions_grid_downscaling,
+                                                                                       xr_em_harm, varname_EM,
+                                                                                       xr_regions_harm,
                                                                                        model, scenario)
+    if land_index is not None:
+        # scatter the harmonised land cells back to (time, y, x) for export
+        long_name = xr_em_grid_correction.coords["region_number"].attrs["long_name"]
+        xr_em_grid_correction = land_cells.unpack_land_dataset(xr_em_grid_correction, land_index)
+        xr_em_grid_correction = xr_em_grid_correction.assign_coords(region_number=(("y", "x"), xr_IAM_regions_grid_downscaling["region_number"].astype("int8").data))
+        xr_em_grid_correction.coords["region_number"].attrs.update(long_name=long_name)
     xr_em_grid_correction[varname_EM].attrs["unit"] = unit_EM
-    plot_maps.save_to_grid_tiff(dir_processed, xr_em, varname_EM, "_harmonised", years_downscaling, model, scenario)
-
 
     debug_log.info(f"Variable: {xr_em_grid_correction.data_vars})")
     arc_seconds, arc_minutes, arc_degrees = process_grid_data.calculate_resolution(xr_em_grid_correction[varname_EM])
@@ -1035,89 +1225,409 @@ def downscale_emissions(project_dir:Path, scenario:str, model:str="IMAGE", profi
     y_min, y_max = float(xr_em_grid_correction[varname_EM].y.min()), float(xr_em_grid_correction[varname_EM].y.max())
     xr_em_grid_correction = xr_em_grid_correction.sortby("y", ascending=False)  # north-to-south
     xr_em_grid_correction = xr_em_grid_correction.sortby("x", ascending=True)  # west-to-east
-    xr_em_grid_correction.to_netcdf(em_harmonised_file, mode="w", engine="netcdf4")
+    em_harmonised_file = ctx["em_harmonised_file"]
+    if process_flags["verify_harmonised_in_write"]:
+        # regional sums for the harmonised emissions are accumulated while writing
+        df_IAM_EM_corrected_compare, xr_regional_sums_corrected = process_IPAT_factors.write_and_calc_regional_values(xr_em_grid_correction, varname_EM, em_harmonised_file,
+                                                                                                                      xr_em_grid_correction["region_number"], df_IAM_EM_harm,
+                                                                                                                      years_downscaling, debug_log)
+    else:
+        grid_store.save_dataset(xr_em_grid_correction, em_harmonised_file)
+    xr_em_grid_correction = grid_store.open_dataset(em_harmonised_file)
     debug_log.info(f"extent downscaled EM grid: x_min={x_min}, x_max={x_max}, y_min={y_min}, y_max={y_max}")
 
-    debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net} Downscaling complete. Processed data saved to {dir_processed} and output to {dir_output}.{PRINT_COLORS["end"]}")
+    debug_log.info(f"\n{PRINT_COLORS["green"]}{_progress(ctx)} Downscaling complete. Processed data saved to {dir_processed} and output to {dir_output}.{PRINT_COLORS["end"]}")
 
     # calculate sum per region per year for harmonised emissions
-    df_IAM_EM_corrected_compare, xr_regional_sums_corrected = process_IPAT_factors.calc_regional_values(xr_em_grid_correction, varname_EM,
-                                                                                                        xr_IAM_regions_grid_downscaling, df_IAM_EM_harm,
-                                                                                                        years_downscaling)
+    if not process_flags["verify_harmonised_in_write"]:
+        df_IAM_EM_corrected_compare, xr_regional_sums_corrected = process_IPAT_factors.calc_regional_values(xr_em_grid_correction, varname_EM,
+                                                                                                            xr_IAM_regions_grid_downscaling, df_IAM_EM_harm,
+                                                                                                            years_downscaling)
     csv_file_compare_corrected = dir_output / f"Emissions_region_{scenario}_{profile}_harmonised.csv"
     df_IAM_EM_corrected_compare.to_csv(csv_file_compare_corrected, sep=";", index=False)
 
-    # 2.4 Calculate urban emissions
-    debug_log.info(f"\n\n2.4.1 Calculate urban emissions {"-"*25}")
+    return {"xr_em_grid_correction": xr_em_grid_correction}
 
-    # 2.4.1 Unharmonised
-    debug_log.info(f"\n\n2.4.1 Unharmonised {"-"*25}")
-    debug_log.info(f"\n\n(({(time.time()-start_time)/60:,.1f} mins): {profile}-{scenario}-{gross_net}: {PRINT_COLORS["green"]}Calculating urban emissions...{PRINT_COLORS["end"]}")
-    debug_log.info(f"unharmonised emissions")
-    # add regions to xr_em
-    xr_em_regions = xr_em.copy()
-    xr_em_regions["region_number"] = xr_IAM_regions_grid_downscaling["region_number"]
-    xr_em_urban_unharmonised, df_em_urban_unharmonised, df_em_rural_unharmonised = aggregate_urban_emissions(xr_emissions=xr_em_regions, gdf_urban_classification=gdf_urban,
-                                                                                   emissions_varname=varname_EM,
-                                                                                   region_varname="region_number",
-                                                                                   final_year=2050)
-    df_em_urban_unharmonised.to_csv(dir_output / f"Emissions_urban_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
-    df_em_rural_unharmonised.to_csv(dir_output / f"Emissions_rural_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
-    # combine dataframes for urban and rural emissions into one dataset, add the sum of urban and rural as "total", and using "urban", "rural" and "total" as a column names
-    df_em_urban_unharmonised["Type"] = "urban"
-    df_em_rural_unharmonised["Type"] = "rural"
-    df_combined_unharmonised = pd.concat([df_em_urban_unharmonised, df_em_rural_unharmonised], ignore_index=True)
-    df_combined_unharmonised.to_csv(dir_output / f"Emissions_combined_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
-    # add total = urban + rural
-    df_total_unharmonised = df_combined_unharmonised.groupby(["model", "scenario", "region_code", "region_number", "year", "unit"]).agg({"value": "sum"}).reset_index()
-    df_total_unharmonised["Type"] = "total"
-    df_total_unharmonised.to_csv(dir_output / f"Emissions_total_region_{scenario}_{profile}_unharmonised.csv", index=False, sep=";")
+# 2.4 urban emissions
+def _step_urban_emissions(ctx:dict) -> dict:
+    calc_urban_emissions(ctx["xr_em"], ctx["xr_em_grid_correction"], ctx["xr_IAM_regions_grid_downscaling"],
+                         ctx["gdf_urban"], settings.varname_EM, ctx["dir_output"],
+                         ctx["profile"], ctx["scenario"], ctx["gross_net"], ctx["start_time"], ctx["debug_log"])
+    return {}
 
-    try:
-        xr_em_urban_unharmonised.to_netcdf(dir_output / f"Emissions_urban_region_{scenario}_{profile}_unharmonised.nc", engine="netcdf4")
-    except Exception as e:
-        debug_log.error(f"Error occurred while saving urban emissions NetCDF file: {e}")
+# unharmonised and harmonised emissions as GeoTIFF
+def _step_tiffs_emissions(ctx:dict) -> dict:
+    if settings.process_flags["save_tiffs_intermediate"]:
+        plot_maps.save_to_grid_tiff(ctx["dir_processed"], ctx["xr_em"], settings.varname_EM, "_unharmonised", [2020, 2030, 2050], ctx["model"], ctx["scenario"])
+    if settings.process_flags["save_tiffs_results"]:
+        plot_maps.save_to_grid_tiff(ctx["dir_processed"], ctx["xr_em_grid_correction"], settings.varname_EM, "_harmonised", settings.years_downscaling, ctx["model"], ctx["scenario"])
+    return {}
 
-    # 2.4.2 Harmonised
-    debug_log.info(f"\n\n2.4.2 Harmonised {"-"*25}")
-    xr_em_urban_harmonised, df_em_urban_harmonised, df_em_rural_harmonised = aggregate_urban_emissions(xr_emissions=xr_em_grid_correction, gdf_urban_classification=gdf_urban,
-                                                                               emissions_varname=varname_EM,
-                                                                               region_varname="region_number",
-                                                                               final_year=2050)
-    df_em_urban_harmonised.to_csv(dir_output / f"Emissions_urban_classification_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
-    df_em_rural_harmonised.to_csv(dir_output / f"Emissions_rural_classification_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
-    # combine dataframes for urban and rural emissions into one dataset, add the sum of urban and rural as "total", and using "urban", "rural" and "total" as a column names
-    df_em_urban_harmonised["Type"] = "urban"
-    df_em_rural_harmonised["Type"] = "rural"
-    df_combined_harmonised = pd.concat([df_em_urban_harmonised, df_em_rural_harmonised], ignore_index=True)
-    df_combined_harmonised.to_csv(dir_output / f"Emissions_combined_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
-    # add total = urban + rural
-    df_total_harmonised = df_combined_harmonised.groupby(["model", "scenario", "region_code", "region_number", "year", "unit"]).agg({"value": "sum"}).reset_index()
-    df_total_harmonised["Type"] = "total"
-    df_total_harmonised.to_csv(dir_output / f"Emissions_total_region_{scenario}_{profile}_harmonised.csv", index=False, sep=";")
-    try:
-        xr_em_urban_harmonised.to_netcdf(dir_output / f"Emissions_urban_classification_region_{scenario}_{profile}_harmonised.nc", engine="netcdf4")
-    except Exception as e:
-        debug_log.error(f"Error occurred while saving urban emissions NetCDF file: {e}")
+def emissions_pipeline_steps(ctx:dict) -> dict:
+    '''
+    Pipeline steps of the emissions downscaling of one scenario: the grid steps (see grid_steps_emissions) and
+    the IAM data, Kaya product, harmonisation, urban emissions and GeoTIFF export.
+    The unharmonised emissions are only recomputed when they are not up to date in the cache or process_grid_EM_per_GDP is set.
+    '''
+    steps = grid_steps_emissions(ctx)
+    steps.update({
+        "read_IAM": pipeline.step(_step_read_IAM, outputs=["df_IAM", "df_IAM_projection_gdp_ppp_per_population", "df_IAM_EM", "df_IAM_projection_em_per_gdp_ppp"]),
+        "compare_GDP_per_pop": pipeline.step(_step_compare_GDP_per_pop, inputs=["xr_gdp_ppp_per_population", "xr_population_processed",
+                                                                                "df_IAM_projection_gdp_ppp_per_population", "xr_IAM_regions_grid_downscaling"]),
+        "land_index": pipeline.step(_step_land_index, inputs=["xr_IAM_regions_grid_downscaling"], outputs=["land_index"]),
+        "kaya_emissions": pipeline.step(_step_kaya_emissions, inputs=["xr_IAM_regions_grid_downscaling", "xr_gdp_ppp_by", "xr_em_per_gdp_ppp_by_downscaling",
+                                                                      "df_IAM_projection_em_per_gdp_ppp", "xr_population_processed",
+                                                                      "xr_gdp_ppp_per_population", "unit_EM", "land_index"],
+                                        outputs=["xr_em", "xr_em_land"],
+                                        files=["em_unharmonised_file"] + (["em_unharmonised_land_file"] if settings.process_flags["land_packed"] else []),
+                                        key=_key_kaya_emissions, load=_load_kaya_emissions, force=settings.process_flags["process_grid_EM_per_GDP"]),
+        "harmonise_emissions": pipeline.step(_step_harmonise_emissions, inputs=["xr_em", "xr_em_land", "land_index", "xr_IAM_regions_grid_downscaling", "df_IAM_EM", "unit_EM"],
+                                             outputs=["xr_em_grid_correction"]),
+        "urban_emissions": pipeline.step(_step_urban_emissions, inputs=["xr_em", "xr_em_grid_correction", "xr_IAM_regions_grid_downscaling", "gdf_urban"]),
+        "tiffs_emissions": pipeline.step(_step_tiffs_emissions, inputs=["xr_em", "xr_em_grid_correction"]),
+    })
+    return steps
+
+def emissions_pipeline_targets() -> list:
+    '''
+    Default targets of the emissions pipeline, following the process and check flags.
+    '''
+    targets = ["harmonise_emissions", "urban_emissions"]
+    if settings.check_flags["check_IAM_GDP_per_pop"]:
+        targets.append("compare_GDP_per_pop")
+    if settings.process_flags["save_tiffs_intermediate"]:
+        targets.append("tiffs_grid")
+    if settings.process_flags["save_tiffs_intermediate"] or settings.process_flags["save_tiffs_results"]:
+        targets.append("tiffs_emissions")
+    return targets
+
+def downscale_emissions(project_dir:Path, scenario:str, model:str="IMAGE", profile:str="default", net_emissions:bool=True,
+                        targets:list|None=None, dir_processed_grid:Path|None=None):
+    '''
+    Downscale the emissions of one scenario (see emissions_pipeline_steps for the steps).
+    targets: pipeline steps to run (with the steps they need that are not up to date), default: the full downscaling.
+    dir_processed_grid: directory with the scenario-independent grids shared by several runs (see batch_runs.py),
+    default: the processed directory of the scenario.
+    '''
+
+    # Make sure program stops (and not only give a warning) if divided by zero, invalid value, or overvflow
+    # Set up logging and warnings
+    warnings.filterwarnings("error", message="divide by zero", category=RuntimeWarning)
+    warnings.filterwarnings("error", message="invalid value", category=RuntimeWarning)
+    warnings.filterwarnings("error", message="overflow", category=RuntimeWarning)
+
+    # start timing
+    start_time = time.time()
+
+    # read profile
+    if profile not in settings.SOURCE_PROFILES:
+        available = list(settings.SOURCE_PROFILES.keys())
+        raise ValueError(f"Unknown source profile '{profile}'. Available: {available}")
+    else:
+        sources = settings.SOURCE_PROFILES[profile]
+
+    # settings
+    #coarse_factor_SE:int = 12 # 12 (2UP)
+    #coarse_factor_GDP:float = 1.2 # 12 (Wang), 1.2 (Murakam version_2021_1)
+    #coarse_factor_EM:int =  1 # EDGAR
+    coarse_factor_POP, coarse_factor_GDP, coarse_factor_EM, \
+    res_min_POP, res_min_GDP, res_min_EM = process_grid_data.get_coarsening_factors(
+                                                                population_source=sources["source_POP"],
+                                                                gdp_source=sources["source_GDP"],
+                                                                emissions_source=sources["source_EM"])
+
+
+    coarse_factor_POP_str = f"{format_factor(coarse_factor_POP)}"
+    coarse_factor_GDP_str = f"{format_factor(coarse_factor_GDP)}"
+    coarse_factor_EM_str = f"{format_factor(coarse_factor_EM)}"
+    print(f"Coarsening factors as string- Population: {coarse_factor_POP_str}, GDP: {coarse_factor_GDP_str}, Emissions: {coarse_factor_EM_str}")
+
+    source_POP = sources["source_POP"]
+    version_POP = sources["version_POP"]
+    source_GDP = sources["source_GDP"]
+    version_GDP = sources["version_GDP"]
+    source_EM = sources["source_EM"]
+    version_EM = sources["version_EM"]
+
+    # coarse_factor_POP, coarse_factor_GDP, coarse_factor_EM = process_grid_data.get_coarsening_factors(population_source="2UP",gdp_source="Murakami",emissions_source="EDGAR")
+    # print(f"Coarsening factors - Population: {coarse_factor_POP}, GDP: {coarse_factor_GDP}, Emissions: {coarse_factor_EM}")
+
+    # create output and processed directories
+    print(f"Project directory: {project_dir}")
+    gross_net = "net" if net_emissions else "gross"
+    source_version_grid = f"{source_POP}_{version_POP}_{source_GDP}_{version_GDP}_{source_EM}_{version_EM}_{gross_net}"
+    model_scenario = f"{model}_{scenario}"
+    dir_output = project_dir / "data" / "output"
+    dir_processed = project_dir / "data" / "processed" / profile / source_version_grid / model_scenario
+    print(f"Output directory: {dir_output}")
+    print(f"Processed data directory: {dir_processed}")
+    dir_output.mkdir(parents=True, exist_ok=True)
+    dir_processed.mkdir(parents=True, exist_ok=True)
+
+    log_path = f"{project_dir}/log/downscaling"
+    debug_log, results_log = init_logging(f"downscaling_emissions_{profile}_{source_version_grid}_{model_scenario}", log_path)
+    debug_log.info(f"\n\n{PRINT_COLORS['purple']}{'|'*100}{PRINT_COLORS['end']}")
+    debug_log.info(f"{PRINT_COLORS['purple']}Logging started{PRINT_COLORS['end']}")
+    debug_log.info(f"{PRINT_COLORS['purple']}{SOURCE_PROFILES[profile]}{PRINT_COLORS['end']}")
+    #results_log.info(SOURCE_PROFILES[profile])
+
+    #-------------------------------------------------------------------------------------------------------------------------
+    debug_log.info(f"\n0. Init {"-"*25}")
+    debug_log.info(f"Project directory: {project_dir}")
+    debug_log.info(f"Output directory: {dir_output}")
+    debug_log.info(f"Processed data directory: {dir_processed}")
+    debug_log.info(f"\n{PRINT_COLORS["yellow"]}{"net emissions" if net_emissions else "gross emissions"}{PRINT_COLORS["end"]}")
+    debug_log.info(f"\n{PRINT_COLORS["green"]}coarse_factor_EM: {coarse_factor_EM:.2f}{PRINT_COLORS["end"]}")
+    res_min_POP_str = f"{res_min_POP:.2f}" if res_min_POP is not None else "None"
+    debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_POP: {res_min_POP_str}{PRINT_COLORS["end"]}")
+    res_min_GDP_str = f"{res_min_GDP:.2f}" if res_min_GDP is not None else "None"
+    debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_GDP: {res_min_GDP_str}{PRINT_COLORS["end"]}")
+    res_min_EM_str = f"{res_min_EM:.2f}" if res_min_EM is not None else "None"
+    debug_log.info(f"\n{PRINT_COLORS["green"]}res_min_EM: {res_min_EM_str}{PRINT_COLORS["end"]}")
+
+    # 1. - 2.4 Read and process IAM and gridded data, downscale, harmonise and aggregate to urban emissions
+    ctx = emissions_context(project_dir, dir_processed, profile, model, scenario, net_emissions, start_time, debug_log, dir_processed_grid)
+    steps = emissions_pipeline_steps(ctx)
+    report = run_report.new_report(f"emissions_{profile}_{model_scenario}_{gross_net}", kind="downscale_emissions",
+                                   profile=profile, model=model, scenario=scenario, emissions=gross_net)
+    # the IAM tables are read first, the cache key of the unharmonised emissions depends on their content
+    ctx = pipeline.run_pipeline(steps, ctx, targets=["read_IAM"], report=report, log=debug_log)
+    ctx = pipeline.run_pipeline(steps, ctx, targets=targets or emissions_pipeline_targets(), report=report, log=debug_log)
 
     # 2.5 End code
     debug_log.info(f"\n\n2.5 End code {"-"*25}")
 
+    # keep the cached intermediates within the size cap, the files of this run are the most recently used
+    intermediate_cache.evict(dir_processed, keep=[ctx[name] for name in ["em_unharmonised_file", "em_unharmonised_land_file", "em_per_gdp_ppp_file",
+                                                                         "file_model_grid_regions", "em_file", "pop_processed_file",
+                                                                         "gdp_ppp_processed_file", "gdp_ppp_per_pop_file"]], log=debug_log)
+
     elapsed_time = time.time() - start_time
     # diviede elapsed time into hours, minutes, and seconds
     hours, rem = divmod(elapsed_time, 3600)
     minutes, seconds = divmod(rem, 60)
     debug_log.info(f"\n{PRINT_COLORS["green"]}{profile}-{scenario}-{gross_net}) Total elapsed time: {hours:,.2f} hours, {minutes:,.2f} minutes, {seconds:,.2f} seconds{PRINT_COLORS["end"]}")
+    run_report.write_report(report, project_dir, debug_log)
 
     # cleanup temporary log files if they are empty
     cleanup_empty_logs(log_path)
 
-    # exit code
-    try:
-        client = get_client()
-        client.close()
-    except Exception:
-        pass
+def downscale_emissions_scenarios(project_dir:Path, scenarios:list, model:str="IMAGE", profile:str="default", net_emissions:bool=True):
+    '''
+    Downscale emissions for several scenarios of one model in a batch.
+    The scenario-independent grids (regions, population, GDP (PPP), GDP (PPP) per capita, base-year emissions per GDP (PPP))
+    are read and processed once, in a shared processed directory of the model. The IAM tables get a scenario dimension and
+    the Kaya product is one lazy (scenario, time, y, x) cube, so every grid chunk is read once for all scenarios:
+    - pass 1 writes the unharmonised emissions of all scenarios and accumulates their regional sums
+    - pass 2 writes the harmonised emissions of all scenarios (and their regional sums if verify_harmonised_in_write is set)
+    Per-scenario outputs (IAM csv files, NetCDF files, comparisons and urban emissions) are written to the same
+    directories and file names as downscale_emissions. The batch uses the (time, y, x) layout (land_packed is ignored)
+    and does not write the intermediate emissions per GDP (PPP) cube.
+    '''
+
+    # Make sure program stops (and not only give a warning) if divided by zero, invalid value, or overvflow
+    warnings.filterwarnings("error", message="divide by zero", category=RuntimeWarning)
+    warnings.filterwarnings("error", message="invalid value", category=RuntimeWarning)
+    warnings.filterwarnings("error", message="overflow", category=RuntimeWarning)
+
+    # start timing
+    start_time = time.time()
+
+    # read profile
+    if profile not in settings.SOURCE_PROFILES:
+        available = list(settings.SOURCE_PROFILES.keys())
+        raise ValueError(f"Unknown source profile '{profile}'. Available: {available}")
+    else:
+        sources = settings.SOURCE_PROFILES[profile]
+
+    base_year = settings.base_year
+    years_downscaling = settings.years_downscaling
+    convergence_year = settings.convergence_year
+    process_flags = settings.process_flags
+    check_flags   = settings.check_flags
+
+    varname_POP = settings.varname_POP
+    varname_EM = settings.varname_EM
+    varname_gdp_per_pop = settings.varname_gdp_per_pop
+    varname_em_per_gdp_ppp = settings.varname_em_per_gdp_ppp
+
+    SSP_base = settings.SSP_base
+
+    # create output and processed directories
+    gross_net = "net" if net_emissions else "gross"
+    source_version_grid = f"{sources["source_POP"]}_{sources["version_POP"]}_{sources["source_GDP"]}_{sources["version_GDP"]}_{sources["source_EM"]}_{sources["version_EM"]}_{gross_net}"
+    label = f"{len(scenarios)} scenarios"
+    dir_output = project_dir / "data" / "output"
+    dir_processed_grid = project_dir / "data" / "processed" / profile / source_version_grid / model
+    dict_dir_processed = {scenario: project_dir / "data" / "processed" / profile / source_version_grid / f"{model}_{scenario}" for scenario in scenarios}
+    dir_output.mkdir(parents=True, exist_ok=True)
+    for dir_processed in [dir_processed_grid] + list(dict_dir_processed.values()):
+        dir_processed.mkdir(parents=True, exist_ok=True)
+
+    log_path = f"{project_dir}/log/downscaling"
+    debug_log, results_log = init_logging(f"downscaling_emissions_{profile}_{source_version_grid}_{model}_scenarios", log_path)
+    debug_log.info(f"\n\n{PRINT_COLORS['purple']}{'|'*100}{PRINT_COLORS['end']}")
+    debug_log.info(f"{PRINT_COLORS['purple']}Logging started{PRINT_COLORS['end']}")
+    debug_log.info(f"{PRINT_COLORS['purple']}{SOURCE_PROFILES[profile]}{PRINT_COLORS['end']}")
+
+    #-------------------------------------------------------------------------------------------------------------------------
+    debug_log.info(f"\n0. Init {"-"*25}")
+    debug_log.info(f"Project directory: {project_dir}")
+    debug_log.info(f"Output directory: {dir_output}")
+    debug_log.info(f"Processed grid data directory: {dir_processed_grid}")
+    debug_log.info(f"\n{PRINT_COLORS["yellow"]}{"net emissions" if net_emissions else "gross emissions"}{PRINT_COLORS["end"]}")
+    debug_log.info(f"\n{PRINT_COLORS["green"]}scenarios: {", ".join(scenarios)}{PRINT_COLORS["end"]}")
+
+    dict_em_unharmonised_file = {scenario: grid_store.store_path(dict_dir_processed[scenario] / f"{replace_punctuation_in_filenames(varname_EM)}_unharmonised_{SSP_base}.nc")
+                                 for scenario in scenarios}
+    dict_em_harmonised_file = {scenario: grid_store.store_path(dict_dir_processed[scenario] / f"{replace_punctuation_in_filenames(varname_EM)}_harmonised_{SSP_base}.nc")
+                               for scenario in scenarios}
+
+    report = run_report.new_report(f"emissions_{profile}_{model}_{len(scenarios)}_scenarios_{gross_net}", kind="downscale_emissions_scenarios",
+                                   profile=profile, model=model, scenarios=scenarios, emissions=gross_net)
+
+    # 1. Read and process IAM data per scenario and the gridded data once
+    record = run_report.start_step("read_IAM")
+    dict_df_IAM_EM = {}
+    dict_df_IAM_projection_em_per_gdp_ppp = {}
+    dict_df_IAM_projection_gdp_ppp_per_population = {}
+    for scenario in scenarios:
+        _, dict_df_IAM_projection_gdp_ppp_per_population[scenario], dict_df_IAM_EM[scenario], dict_df_IAM_projection_em_per_gdp_ppp[scenario] = \
+            read_process_IAM_data_emissions(project_dir, dict_dir_processed[scenario], profile, model, scenario, gross_net,
+                                            net_emissions, start_time, debug_log)
+    run_report.end_step(report, record, log=debug_log)
+    grid_data = read_process_grid_data_emissions(project_dir, dir_processed_grid, profile, model, "scenarios", gross_net, start_time, debug_log, report)
+    xr_IAM_regions_grid_downscaling = grid_data["xr_IAM_regions_grid_downscaling"]
+    xr_population_processed = grid_data["xr_population_processed"]
+    xr_gdp_ppp_per_population = grid_data["xr_gdp_ppp_per_population"]
+    xr_em_per_gdp_ppp_by_downscaling = grid_data["xr_em_per_gdp_ppp_by_downscaling"]
+    gdf_urban = grid_data["gdf_urban"]
+    unit_EM = grid_data["unit_EM"]
+    grid_files = grid_data["files"]
+    del grid_data
+
+    if check_flags["check_IAM_GDP_per_pop"]:
+        # 2.1.3 compare IAM and grid data for GDP per capita
+        for scenario in scenarios:
+            df_grid, df_compare = process_IPAT_factors.compare_IAM_grid_regions_GDP_per_capita(xr_gdp_ppp_per_population, varname_gdp_per_pop,
+                                                                                               xr_population_processed, varname_POP,
+                                                                                               dict_df_IAM_projection_gdp_ppp_per_population[scenario],
+                                                                                               xr_IAM_regions_grid_downscaling)
+            df_grid.to_csv(dict_dir_processed[scenario] / "selection_grid_gdp_per_pop.csv", sep=";", index=False)
+            df_compare.to_csv(dict_dir_processed[scenario] / "compare_IAM_grid_gdp_per_pop.csv", sep=";", index=True)
+
+    xr_em_per_gdp_ppp_by_downscaling.attrs["unit"] = dict_df_IAM_projection_em_per_gdp_ppp[scenarios[0]]["unit"].iloc[0]  # Update unit attribute
+
+    # IAM emissions with the ocean (region 0) for the harmonisation
+    dict_df_IAM_EM_harm = {}
+    for scenario in scenarios:
+        df_IAM_EM = dict_df_IAM_EM[scenario]
+        years = df_IAM_EM["year"].unique()
+        variable = df_IAM_EM["variable"].unique()[0]
+        extra_rows = pd.DataFrame({"model": model, "scenario": scenario, "region_code":"OCEAN", "variable":variable, "year": years, "unit": unit_EM, "region_number": 0, "value": 0})
+        dict_df_IAM_EM_harm[scenario] = pd.concat([df_IAM_EM, extra_rows], ignore_index=True).sort_values(["year", "region_number"]).reset_index(drop=True)
+
+    # 2.3 Calculate CO2 emissions grid for all scenarios
+    debug_log.info(f"\n\n2.3 Calculate CO2 emissions grid {"-"*25}")
+    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{label}-{gross_net}: {PRINT_COLORS["green"]} Calculating CO2 grid emissions...{PRINT_COLORS["end"]}")
+    years_downscaling_extended = sorted(list(set(years_downscaling + [convergence_year])))
+    xr_em_per_gdp_ppp = process_IPAT_factors.downscale_em_per_gdp_scenarios(xr_em_per_gdp_ppp_by_downscaling, varname_em_per_gdp_ppp,
+                                                                            xr_IAM_regions_grid_downscaling,
+                                                                            dict_df_IAM_projection_em_per_gdp_ppp,
+                                                                            years_downscaling_extended, base_year, convergence_year,
+                                                                            debug_log)
+    # (scenario, time, y, x), population and GDP per capita are broadcast over the scenarios
+    xr_em_scenarios = process_IPAT_factors.calc_kaya_emissions(xr_population_processed, varname_POP,
+                                                               xr_gdp_ppp_per_population, varname_gdp_per_pop,
+                                                               xr_em_per_gdp_ppp, varname_em_per_gdp_ppp,
+                                                               varname_EM, unit_EM, debug_log)
+
+    # 2.3.2 pass 1: write the unharmonised emissions of all scenarios and determine their regional sums
+    debug_log.info(f"\n\n2.3.2 Harmonise grid emissions per region with IAM emissions per region {"-"*25}")
+    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{label}-{gross_net}:{PRINT_COLORS["green"]}: Writing unharmonised emissions and regional sums...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("unharmonised_emissions")
+    dict_xr_em = {scenario: xr_em_scenarios.sel(scenario=scenario, drop=True) for scenario in scenarios}
+    dict_regional_values = process_IPAT_factors.write_and_calc_regional_values_batch(dict_xr_em, varname_EM, dict_em_unharmonised_file,
+                                                                                     xr_IAM_regions_grid_downscaling["region_number"], dict_df_IAM_EM_harm,
+                                                                                     years_downscaling, debug_log)
+    run_report.end_step(report, record, xr_em_scenarios, log=debug_log)
+    del xr_em_per_gdp_ppp, xr_em_scenarios, dict_xr_em
+
+    # 2.3.3 and 2.3.4 harmonisation factors per scenario, applied lazily to the written unharmonised emissions
+    debug_log.info(f"\n\n2.3.3 Calculate harmonisation factors for grid emissions per region with IAM emissions per region {"-"*25}")
+    record = run_report.start_step("harmonisation_factors")
+    dict_xr_em = {}
+    dict_xr_em_grid_correction = {}
+    for scenario in scenarios:
+        df_IAM_EM_compare, xr_regional_sums = dict_regional_values[scenario]
+        df_IAM_EM_compare.to_csv(dir_output / f"Emissions_region_{scenario}_{profile}_unharmonised.csv", sep=";", index=False)
+
+        dict_xr_em[scenario] = grid_store.open_dataset(dict_em_unharmonised_file[scenario])
+        xr_em_correction_factors = process_IPAT_factors.calculate_harmonisation_factors_emissions(dict_xr_em[scenario], varname_EM, xr_regional_sums,
+                                                                                                  xr_IAM_regions_grid_downscaling, dict_df_IAM_EM_harm[scenario],
+                                                                                                  years_downscaling)
+        csv_file_cf = dict_dir_processed[scenario] / f"correction_factors_regional_{replace_punctuation_in_filenames(varname_EM)}_{scenario}_{model}.csv"
+        xr_em_correction_factors.to_dataframe().reset_index().to_csv(csv_file_cf, sep=";", index=False)
+
+        xr_em_grid_correction = process_IPAT_factors.apply_harmonisation_factors_emissions(xr_em_correction_factors,
+                                                                                           dict_xr_em[scenario], varname_EM,
+                                                                                           xr_IAM_regions_grid_downscaling,
+                                                                                           model, scenario)
+        xr_em_grid_correction[varname_EM].attrs["unit"] = unit_EM
+        xr_em_grid_correction = xr_em_grid_correction.sortby("y", ascending=False)  # north-to-south
+        xr_em_grid_correction = xr_em_grid_correction.sortby("x", ascending=True)  # west-to-east
+        dict_xr_em_grid_correction[scenario] = xr_em_grid_correction
+    run_report.end_step(report, record, log=debug_log)
+
+    # 2.3.4 pass 2: write the harmonised emissions of all scenarios
+    debug_log.info(f"\n\n2.3.4 Apply harmonisation factors to grid emissions {"-"*25}")
+    debug_log.info(f"(({(time.time()-start_time)/60:,.1f} mins): {profile}-{label}-{gross_net}:{PRINT_COLORS["green"]}: Writing harmonised emissions...{PRINT_COLORS["end"]}")
+    record = run_report.start_step("harmonise_emissions")
+    if process_flags["verify_harmonised_in_write"]:
+        # regional sums for the harmonised emissions are accumulated while writing
+        dict_regional_values_corrected = process_IPAT_factors.write_and_calc_regional_values_batch(dict_xr_em_grid_correction, varname_EM, dict_em_harmonised_file,
+                                                                                                   xr_IAM_regions_grid_downscaling["region_number"], dict_df_IAM_EM_harm,
+                                                                                                   years_downscaling, debug_log)
+    else:
+        dask_base.compute(*[grid_store.save_dataset(dict_xr_em_grid_correction[scenario], dict_em_harmonised_file[scenario], compute=False)
+                            for scenario in scenarios])
+    run_report.end_step(report, record, n_cells=sum(run_report.cells(dict_xr_em_grid_correction[scenario]) for scenario in scenarios), log=debug_log)
+    debug_log.info(f"\n{PRINT_COLORS["green"]}(({(time.time()-start_time)/60:,.1f} mins): {profile}-{label}-{gross_net} Downscaling complete. Processed data saved to {dir_processed_grid.parent} and output to {dir_output}.{PRINT_COLORS["end"]}")
+
+    record = run_report.start_step("urban_emissions")
+    for scenario in scenarios:
+        xr_em_grid_correction = grid_store.open_dataset(dict_em_harmonised_file[scenario])
+
+        # calculate sum per region per year for harmonised emissions
+        if process_flags["verify_harmonised_in_write"]:
+            df_IAM_EM_corrected_compare, _ = dict_regional_values_corrected[scenario]
+        else:
+            df_IAM_EM_corrected_compare, _ = process_IPAT_factors.calc_regional_values(xr_em_grid_correction, varname_EM,
+                                                                                       xr_IAM_regions_grid_downscaling, dict_df_IAM_EM_harm[scenario],
+                                                                                       years_downscaling)
+        df_IAM_EM_corrected_compare.to_csv(dir_output / f"Emissions_region_{scenario}_{profile}_harmonised.csv", sep=";", index=False)
+
+        # 2.4 Calculate urban emissions
+        calc_urban_emissions(dict_xr_em[scenario], xr_em_grid_correction, xr_IAM_regions_grid_downscaling,
+                             gdf_urban, varname_EM, dir_output,
+                             profile, scenario, gross_net, start_time, debug_log)
+    run_report.end_step(report, record, log=debug_log)
+
+    # 2.5 End code
+    debug_log.info(f"\n\n2.5 End code {"-"*25}")
+
+    # keep the cached intermediates of the shared grids within the size cap
+    intermediate_cache.evict(dir_processed_grid, keep=list(grid_files.values()), log=debug_log)
+
+    elapsed_time = time.time() - start_time
+    # diviede elapsed time into hours, minutes, and seconds
+    hours, rem = divmod(elapsed_time, 3600)
+    minutes, seconds = divmod(rem, 60)
+    debug_log.info(f"\n{PRINT_COLORS["green"]}{profile}-{label}-{gross_net}) Total elapsed time: {hours:,.2f} hours, {minutes:,.2f} minutes, {seconds:,.2f} seconds{PRINT_COLORS["end"]}")
+    run_report.write_report(report, project_dir, debug_log)
+
+    # cleanup temporary log files if they are empty
+    cleanup_empty_logs(log_path)
 
 def plot_results(scenario:str = "ELV-SSP2-CP", model:str="IMAGE", profile:str = "default", net_emissions:bool=True, global_min:float|None=None, global_max:float|None=None):
     from shapely.ops import unary_union  # add alongside the other imports
@@ -1161,25 +1671,25 @@ def plot_results(scenario:str = "ELV-SSP2-CP", model:str="IMAGE", profile:str =
     print(f"Coarsening factors - Population: {coarse_factor_POP}, GDP: {coarse_factor_GDP}, Emissions: {coarse_factor_EM}")
 
     # files for processed grid data
-    pop_file = dir_processed / f"Population_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP}.nc"
-    gdp_ppp_file = dir_processed / f"GDP_PPP_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP}.nc"
-    em_file = dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_hist_{source_EM}_{version_EM}_{SSP_base}_cf_{coarse_factor_EM}.nc"
-    pop_processed_file = dir_processed / f"Population_processed_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP}.nc"
-    gdp_ppp_processed_file = dir_processed / f"GDP_PPP_processed_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP}.nc"
-    em_harmonised_file = dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_harmonised_{SSP_base}.nc"
+    pop_file = grid_store.store_path(dir_processed / f"Population_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP}.nc")
+    gdp_ppp_file = grid_store.store_path(dir_processed / f"GDP_PPP_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP}.nc")
+    em_file = grid_store.store_path(dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_hist_{source_EM}_{version_EM}_{SSP_base}_cf_{coarse_factor_EM}.nc")
+    pop_processed_file = grid_store.store_path(dir_processed / f"Population_processed_{source_POP}_{version_POP}_{SSP_base}_cf_{coarse_factor_POP}.nc")
+    gdp_ppp_processed_file = grid_store.store_path(dir_processed / f"GDP_PPP_processed_{source_GDP}_{version_GDP}_{SSP_base}_cf_{coarse_factor_GDP}.nc")
+    em_harmonised_file = grid_store.store_path(dir_processed / f"{replace_punctuation_in_filenames(varname_EM)}_harmonised_{SSP_base}.nc")
     #file_path_file_model_grid_regions = project_dir / f"data/input/models/{model}/{file_model_grid_regions}"
     file_path_file_model_grid_regions = determine_regions_file(project_dir, res_min_POP, res_min_GDP, res_min_EM, model, debug_log)
 
     figures_dir = dir_processed / "figures"
     figures_dir.mkdir(parents=True, exist_ok=True)
 
-    xr_population_hist = xr.open_dataset(pop_file)
-    xr_gdp_ppp_hist = xr.open_dataset(gdp_ppp_file)
-    xr_emissions_hist = xr.open_dataset(em_file)
-    xr_population_proj = xr.open_dataset(pop_processed_file)
-    xr_gdp_ppp_proj = xr.open_dataset(gdp_ppp_processed_file)
-    xr_emissions_proj = xr.open_dataset(em_harmonised_file)
-    xr_IAM_regions_grid = xr.open_dataset(file_path_file_model_grid_regions)
+    xr_population_hist = grid_store.open_dataset(pop_file)
+    xr_gdp_ppp_hist = grid_store.open_dataset(gdp_ppp_file)
+    xr_emissions_hist = grid_store.open_dataset(em_file)
+    xr_population_proj = grid_store.open_dataset(pop_processed_file)
+    xr_gdp_ppp_proj = grid_store.open_dataset(gdp_ppp_processed_file)
+    xr_emissions_proj = grid_store.open_dataset(em_harmonised_file)
+    xr_IAM_regions_grid = grid_store.open_dataset(file_path_file_model_grid_regions)
 
     arc_seconds_pop, arc_minutes_pop, arc_degrees_pop = process_grid_data.calculate_resolution(xr_population_proj[varname_POP])
     print(f"{PRINT_COLORS["green"]}Resolution: degrees-{arc_degrees_pop:.2f},  minutes-{arc_minutes_pop:.2f}, seconds-{arc_seconds_pop:.2f}{PRINT_COLORS["end"]}")
@@ -1464,6 +1974,8 @@ def upload_to_GEE(scenario:str = "ELV-SSP2-CP", model:str="IMAGE", profile:str =
     print(f"\n{PRINT_COLORS['green']}Upload to Google Earth Engine complete. Total elapsed time: {elapsed_time:,.2f} seconds ({elapsed_time/60:.2f} minutes).{PRINT_COLORS['end']}")
 
 def compare_two_raster_files():
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
 
     project_dir = Path(__file__).parent
     root = tk.Tk()
@@ -114,6 +114,8 @@ import functions_processing_hist_data as pdf
 import functions_read_process_IAM_data as rpd
 import functions_logging as log
 import downscaling.settings_models as settings_models
+import downscaling.chunk_planner as chunk_planner
+import downscaling.grid_store as grid_store
 
 pd.set_option('display.max_rows', 25)
 
@@ -230,7 +232,7 @@ df_IAM_projection_se_indicator[df_IAM_projection_se_indicator["Year"].isin([2020
 xr_SE_grid = None
 if Path(SE_grid_file).exists():
     xr_SE_grid = dsf.read_netcf_rio_file(filename=SE_grid_file)
-    xr_SE_grid = xr_SE_grid.chunk({"time": -1, "y": "auto", "x": "auto"})
+    xr_SE_grid = xr_SE_grid.chunk(chunk_planner.chunks_for(xr_SE_grid, full_dims=["time"]))
 
     # check time steps
     time_steps_se_indicator = np.unique(xr_SE_grid["time"].values)
@@ -638,7 +640,7 @@ if save_netcdf:
     xr_SE_grid_corrected = xr_SE_grid_corrected.drop_vars(["correction_factor", "region_number", varname])
     xr_SE_grid_corrected = xr_SE_grid_corrected.rename({varname_corrected: varname})
     xr_SE_grid_corrected = xr_SE_grid_corrected.transpose("y", "x", "time")
-    xr_SE_grid_corrected.to_netcdf(file_path, encoding={varname: {'zlib': True, 'complevel': 4}})
+    grid_store.save_dataset(xr_SE_grid_corrected, grid_store.store_path(file_path))
     xr_SE_grid_corrected.close()
 
 # plot histogram of correction factors
@@ -0,0 +1,259 @@
+import logging
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tabulate import tabulate
+
+from tools.functions_logging import deferred_logging
+
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Storage of the processed grids and the downscaling intermediates
+# The processed POP, GDP and EM grids and the intermediate cubes are written and reopened through this module, in the
+# format of storage_settings["format"]:
+#   - "netcdf": one .nc file per grid, written by one process (the dask chunks are computed in parallel, but written one by one)
+#   - "zarr": one .zarr directory per grid with one file per chunk and consolidated metadata; the chunks are written
+#     in parallel by the threads or worker processes of dask (see dask_cluster.py), and a store can be filled
+#     piecewise: appended along time (append_dataset, e.g. one year per source file) or block by block into an
+#     existing store (save_region, blocks aligned with the zarr chunks)
+# The paths of the intermediates are given with .nc, store_path() gives the path in the configured format and
+# find() the path of a grid that was written in either format (e.g. before the format was changed).
+# Every write uses the same encoding policy (storage_settings["encoding"], encoding_policies): codec, compression
+# level, byte shuffle and dtype of the data variables, and chunks aligned with the chunks used to read the grids.
+# compare_encoding_policies() writes and reads a grid with every policy and reports size and speed.
+
+# encoding keys that are understood by both netcdf4 and zarr, the others (zlib, complevel, chunksizes, ...) are netcdf only
+_portable_encoding = {"dtype", "_FillValue", "scale_factor", "add_offset", "units", "calendar"}
+
+def store_path(file_path:Path, storage_format:str|None=None) -> Path:
+    '''
+    Path of a grid in the storage format (default storage_settings["format"]): .nc for netcdf, .zarr for zarr.
+    '''
+    storage_format = settings.storage_settings["format"] if storage_format is None else storage_format
+    match storage_format:
+        case "netcdf":
+            return Path(file_path).with_suffix(".nc")
+        case "zarr":
+            return Path(file_path).with_suffix(".zarr")
+        case _:
+            raise ValueError(f"Unknown storage format '{storage_format}', use 'netcdf' or 'zarr'")
+
+def storage_format() -> str:
+    '''
+    Storage format of the processed grids and intermediates (storage_settings["format"]): "netcdf" or "zarr".
+    '''
+    return settings.storage_settings["format"]
+
+def storage_chunks() -> dict:
+    '''
+    Chunks of the stored grids per dimension (storage_settings["chunks"]).
+    '''
+    return dict(settings.storage_settings["chunks"])
+
+def is_zarr(file_path:Path) -> bool:
+    return Path(file_path).suffix == ".zarr"
+
+def exists(file_path:Path) -> bool:
+    '''
+    True if a complete grid is stored at file_path: a netcdf file, or a zarr store with (consolidated) metadata.
+    A zarr store without metadata is an interrupted write.
+    '''
+    file_path = Path(file_path)
+    if is_zarr(file_path):
+        return file_path.is_dir() and ((file_path / ".zmetadata").is_file() or (file_path / "zarr.json").is_file())
+    return file_path.is_file()
+
+def find(file_path:Path) -> Path:
+    '''
+    Path of the grid file_path in the storage format, or in the other format if only that one exists;
+    the path in the storage format if neither exists.
+    '''
+    file_path = store_path(file_path)
+    file_other = store_path(file_path, "netcdf" if is_zarr(file_path) else "zarr")
+    return file_other if not exists(file_path) and exists(file_other) else file_path
+
+def size(file_path:Path) -> int:
+    '''
+    Size in bytes of a netcdf file or of all files of a zarr store.
+    '''
+    file_path = Path(file_path)
+    if file_path.is_dir():
+        return sum(f.stat().st_size for f in file_path.rglob("*") if f.is_file())
+    return file_path.stat().st_size
+
+def modified_ns(file_path:Path) -> int:
+    '''
+    Latest modification time (ns) of a netcdf file or of the files of a zarr store.
+    '''
+    file_path = Path(file_path)
+    if file_path.is_dir():
+        return max([f.stat().st_mtime_ns for f in file_path.rglob("*") if f.is_file()], default=file_path.stat().st_mtime_ns)
+    return file_path.stat().st_mtime_ns
+
+def remove(file_path:Path):
+    file_path = Path(file_path)
+    if file_path.is_dir():
+        shutil.rmtree(file_path)
+    elif file_path.is_file():
+        file_path.unlink()
+
+def _netcdf_codec(policy:dict) -> dict:
+    match policy["codec"]:
+        case None:
+            return {"zlib": False}
+        case "zlib":
+            return {"zlib": True, "complevel": policy["complevel"], "shuffle": policy["shuffle"]}
+        case "zstd":
+            return {"compression": "zstd", "complevel": policy["complevel"], "shuffle": policy["shuffle"]}
+        case "lz4":
+            return {"compression": "blosc_lz4", "complevel": policy["complevel"], "blosc_shuffle": 1 if policy["shuffle"] else 0}
+        case _:
+            raise ValueError(f"Unknown codec '{policy['codec']}', use None, 'zlib', 'zstd' or 'lz4'")
+
+def _zarr_codec(policy:dict) -> dict:
+    if policy["codec"] is None:
+        return {"compressors": None}
+    from zarr.codecs import BloscCodec
+    return {"compressors": (BloscCodec(cname=policy["codec"], clevel=policy["complevel"],
+                                       shuffle="shuffle" if policy["shuffle"] else "noshuffle"),)}
+
+def encoding_policy(ds:xr.Dataset, file_path:Path, policy:str|None=None, encoding:dict|None=None) -> dict:
+    '''
+    Encoding of the data variables of ds for a write to file_path (netcdf or zarr) following an encoding policy
+    (default storage_settings["encoding"]): codec, compression level, shuffle, dtype of floating point variables and,
+    for netcdf, chunksizes of storage_settings["chunks"]. The portable encoding of the variables (e.g. _FillValue)
+    is kept, entries in encoding (per variable) take precedence over the policy.
+    '''
+    policy = settings.storage_settings["encoding"] if policy is None else policy
+    if policy not in settings.encoding_policies:
+        raise ValueError(f"Unknown encoding policy '{policy}', available: {list(settings.encoding_policies)}")
+    policy_settings = settings.encoding_policies[policy]
+    chunks = settings.storage_settings["chunks"]
+    codec = _zarr_codec(policy_settings) if is_zarr(file_path) else _netcdf_codec(policy_settings)
+    encoding = encoding or {}
+    result = {name: dict(var_encoding) for name, var_encoding in encoding.items()}
+    for name, da in ds.data_vars.items():
+        if da.ndim == 0 or not np.issubdtype(da.dtype, np.number):
+            continue
+        var_encoding = {key: value for key, value in da.encoding.items() if key in _portable_encoding}
+        var_encoding.update(codec)
+        if policy_settings["dtype"] is not None and np.issubdtype(da.dtype, np.floating):
+            var_encoding["dtype"] = policy_settings["dtype"]
+        if not is_zarr(file_path):
+            var_encoding["chunksizes"] = tuple(da.sizes[dim] if chunks.get(dim, -1) == -1 else min(chunks[dim], da.sizes[dim])
+                                               for dim in da.dims)
+        var_encoding.update(encoding.get(name, {}))
+        result[name] = var_encoding
+    return result
+
+def _zarr_dataset(ds:xr.Dataset) -> xr.Dataset:
+    '''
+    Dataset for to_zarr: the data variables are chunked uniformly (storage_settings["chunks"], one zarr chunk
+    per dask chunk) and netcdf-only encoding of the source file is dropped.
+    '''
+    ds = ds.chunk({dim: chunk for dim, chunk in settings.storage_settings["chunks"].items() if dim in ds.dims})
+    for name in ds.variables:
+        ds[name].encoding = {key: value for key, value in ds[name].encoding.items() if key in _portable_encoding}
+    return ds
+
+def save_dataset(ds:xr.Dataset, file_path:Path, encoding:dict|None=None, compute:bool=True, policy:str|None=None,
+                 log: logging.Logger=local_log):
+    '''
+    Write a (lazy) dataset to a netcdf file or a zarr store, following the suffix of file_path, with the encoding
+    policy (see encoding_policy; encoding overrides it per variable).
+    An existing grid is replaced. With compute=False the delayed write is returned (as to_netcdf/to_zarr do),
+    so it can be computed together with other results.
+    '''
+    file_path = Path(file_path)
+    if is_zarr(file_path):
+        ds = _zarr_dataset(ds)
+        encoding = encoding_policy(ds, file_path, policy, encoding)
+        log.info(f"Writing zarr store {file_path}")
+        return ds.to_zarr(file_path, mode="w", encoding=encoding, consolidated=True, compute=compute)
+    encoding = encoding_policy(ds, file_path, policy, encoding)
+    log.info(f"Writing netcdf {file_path}")
+    return ds.to_netcdf(file_path, mode="w", engine="netcdf4", encoding=encoding, compute=compute)
+
+def append_dataset(ds:xr.Dataset, file_path:Path, dim:str="time", log: logging.Logger=local_log):
+    '''
+    Append a dataset along dim (e.g. one year) to a zarr store; the store is created by the first append.
+    '''
+    file_path = Path(file_path)
+    if not is_zarr(file_path):
+        raise ValueError(f"Appending is only supported for zarr stores, not {file_path}")
+    ds = _zarr_dataset(ds)
+    if exists(file_path):
+        for name in ds.variables:
+            # the encoding of the store applies to the appended values
+            ds[name].encoding = {}
+        ds.to_zarr(file_path, append_dim=dim, consolidated=True)
+    else:
+        ds.to_zarr(file_path, mode="w", encoding=encoding_policy(ds, file_path), consolidated=True)
+    log.info(f"Appended {dim}={ds[dim].values.tolist()} to {file_path}")
+
+def save_region(ds:xr.Dataset, file_path:Path, region:dict, log: logging.Logger=local_log):
+    '''
+    Write a block of a grid ({dim: slice}, aligned with the zarr chunks) into an existing zarr store (e.g. created
+    with save_dataset(..., compute=False)). Variables without the region dimensions are not written again.
+    '''
+    file_path = Path(file_path)
+    if not is_zarr(file_path):
+        raise ValueError(f"Region writes are only supported for zarr stores, not {file_path}")
+    ds = ds.drop_vars([name for name in ds.variables if not set(region).issubset(ds[name].dims)])
+    for name in ds.variables:
+        ds[name].encoding = {}
+    ds.to_zarr(file_path, region=region, mode="r+", consolidated=True)
+    log.info(f"Wrote region {region} to {file_path}")
+
+def open_dataset(file_path:Path, **kwargs) -> xr.Dataset:
+    '''
+    Open a grid written by save_dataset; zarr stores are opened lazily (dask, one chunk per zarr chunk)
+    from their consolidated metadata. kwargs are passed to xr.open_dataset (e.g. decode_coords).
+    '''
+    file_path = Path(file_path)
+    if is_zarr(file_path):
+        kwargs.setdefault("chunks", {})
+        return xr.open_dataset(file_path, engine="zarr", consolidated=True, **kwargs)
+    return xr.open_dataset(file_path, **kwargs)
+
+def compare_encoding_policies(file_path:Path, policies:list|None=None, storage_format:str="netcdf",
+                              log: logging.Logger=local_log) -> pd.DataFrame:
+    '''
+    Write a grid with every encoding policy (default: all of encoding_policies) next to file_path, read it back
+    chunk-wise (storage_settings["chunks"]) and report size and write/read time per policy.
+    A policy whose codec is not available (e.g. zstd without the netCDF-C filter) is reported with its error.
+    '''
+    file_path = Path(file_path)
+    policies = list(settings.encoding_policies) if policies is None else policies
+    ds = open_dataset(file_path).load()
+    size_input = size(file_path)
+    rows = []
+    with tempfile.TemporaryDirectory(dir=file_path.parent) as dir_tmp:
+        for policy in policies:
+            file_policy = store_path(Path(dir_tmp) / f"{file_path.stem}_{policy}.nc", storage_format)
+            try:
+                t0 = time.time()
+                save_dataset(ds, file_policy, policy=policy, log=log)
+                seconds_write = time.time() - t0
+                t0 = time.time()
+                with open_dataset(file_policy, chunks={dim: chunk for dim, chunk in settings.storage_settings["chunks"].items() if dim in ds.dims}) as ds_read:
+                    for name in ds_read.data_vars:
+                        ds_read[name].sum().compute()
+                seconds_read = time.time() - t0
+                size_policy = size(file_policy)
+                rows.append({"policy": policy, "size_MB": size_policy / 1e6, "ratio": size_policy / size_input,
+                             "write_s": seconds_write, "read_s": seconds_read, "error": ""})
+            except Exception as e:
+                rows.append({"policy": policy, "size_MB": None, "ratio": None, "write_s": None, "read_s": None, "error": str(e)[:80]})
+    df_policies = pd.DataFrame(rows)
+    table = tabulate(df_policies, headers="keys", tablefmt="github", showindex=False, floatfmt=".2f")
+    log.info(f"Encoding policies for {file_path} ({size_input / 1e6:,.1f} MB):\n{table}")
+    print(f"Encoding policies for {file_path} ({size_input / 1e6:,.1f} MB, {storage_format}):\n{table}")
+    return df_policies
@@ -0,0 +1,169 @@
+import contextlib
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from types import ModuleType
+
+from tools.functions_logging import deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.grid_store as grid_store
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Content-addressed cache of the intermediate files in a processed directory
+# Every intermediate (e.g. Population_processed_*.nc, GDP_PPP_per_pop_*.nc, *_per_gdp_ppp_*.nc) is registered in
+# a manifest (cache_manifest.json) in its directory, together with a key: a hash of the step name, the files it was
+# computed from (path, size and modification time), its parameters and the source code of the functions that made it.
+# A step is skipped when its file exists and the key in the manifest equals the key of the current run, so a changed
+# input, setting or code version reruns the step (and, through the modification time of its output, all steps after it).
+# Files that are not in the manifest (e.g. written by an older version) are recomputed once.
+# Zarr stores (see grid_store) are registered like files, with the size and modification time of all their chunks.
+# The size of the registered files per directory is capped (cache_settings["max_size_GB"]), the least recently
+# used files are removed first.
+# Runs in parallel (see batch_runs.py) share the processed directories and the IAM cache, so every read-modify-write
+# of a manifest holds a lock file next to it (cache_manifest.json.lock, created exclusively); a lock that is older than
+# cache_settings["lock_timeout_s"] is left over from a crashed run and is taken over.
+
+manifest_name = "cache_manifest.json"
+
+def _code_source(obj) -> str:
+    if isinstance(obj, ModuleType):
+        return Path(obj.__file__).read_text(encoding="utf-8")
+    return inspect.getsource(obj)
+
+def _file_signature(file_path:Path) -> list:
+    file_path = Path(file_path)
+    if not grid_store.exists(file_path):
+        return [str(file_path), None, None]
+    return [str(file_path), grid_store.size(file_path), grid_store.modified_ns(file_path)]
+
+def file_digest(file_path:Path) -> str|None:
+    '''
+    sha256 of the content of a file (None if it does not exist), for inputs that are rewritten with the same content.
+    '''
+    file_path = Path(file_path)
+    if not file_path.is_file():
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(step:str, inputs:list|None=None, params:dict|None=None, code:list|None=None) -> str:
+    '''
+    Key of an intermediate: sha256 of the step name, the signature (path, size, modification time) of the input files,
+    the parameters (JSON, sorted keys) and the source code of the functions or modules in code.
+    '''
+    content = {"step": step,
+               "inputs": [_file_signature(file_path) for file_path in (inputs or [])],
+               "params": params or {},
+               "code": [hashlib.sha256(_code_source(obj).encode("utf-8")).hexdigest() for obj in (code or [])]}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def load_manifest(dir_cache:Path) -> dict:
+    file_manifest = Path(dir_cache) / manifest_name
+    if not file_manifest.is_file():
+        return {}
+    try:
+        with open(file_manifest, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        # a corrupt manifest only costs a recompute
+        return {}
+
+def save_manifest(dir_cache:Path, manifest:dict):
+    file_manifest = Path(dir_cache) / manifest_name
+    # one temporary file per process and thread, runs in parallel (see batch_runs.py) can share a directory
+    file_tmp = file_manifest.with_suffix(f".{os.getpid()}_{threading.get_ident()}.tmp")
+    with open(file_tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(file_tmp, file_manifest)
+
+@contextlib.contextmanager
+def locked_manifest(dir_cache:Path):
+    '''
+    Yields the manifest of dir_cache while holding its lock; the (changed) manifest is saved when the block ends.
+    '''
+    file_lock = Path(dir_cache) / f"{manifest_name}.lock"
+    timeout = settings.cache_settings["lock_timeout_s"]
+    while True:
+        try:
+            fd = os.open(file_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - file_lock.stat().st_mtime > timeout:
+                    local_log.warning(f"Cache: removing stale lock {file_lock}")
+                    file_lock.unlink(missing_ok=True)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.05)
+    try:
+        os.write(fd, f"{os.getpid()}\n".encode("utf-8"))
+        os.close(fd)
+        manifest = load_manifest(dir_cache)
+        yield manifest
+        save_manifest(dir_cache, manifest)
+    finally:
+        file_lock.unlink(missing_ok=True)
+
+def is_valid(file_path:Path, key:str, log: logging.Logger=local_log) -> bool:
+    '''
+    True if file_path exists and was registered with the same key; marks the file as used.
+    With the cache disabled, only the existence of the file is checked (as with the process_flags).
+    '''
+    file_path = Path(file_path)
+    if not grid_store.exists(file_path):
+        return False
+    if not settings.cache_settings["enabled"]:
+        return True
+    with locked_manifest(file_path.parent) as manifest:
+        entry = manifest.get(file_path.name)
+        if entry is None or entry["key"] != key or entry["size"] != grid_store.size(file_path):
+            log.info(f"{PRINT_COLORS['yellow']}Cache: {file_path.name} is missing or out of date, recomputing{PRINT_COLORS['end']}")
+            return False
+        entry["last_used"] = time.time()
+    log.info(f"{PRINT_COLORS['green']}Cache: using {file_path.name} (step {entry['step']}){PRINT_COLORS['end']}")
+    return True
+
+def register(file_path:Path, key:str, step:str, log: logging.Logger=local_log):
+    '''
+    Register a written intermediate with its key in the manifest of its directory.
+    '''
+    file_path = Path(file_path)
+    now = time.time()
+    with locked_manifest(file_path.parent) as manifest:
+        manifest[file_path.name] = {"key": key, "step": step, "size": grid_store.size(file_path),
+                                    "created": now, "last_used": now}
+    log.info(f"Cache: registered {file_path.name} (step {step})")
+
+def evict(dir_cache:Path, max_size_GB:float|None=None, keep:list|None=None, log: logging.Logger=local_log):
+    '''
+    Remove the least recently used registered intermediates of dir_cache until their total size is below max_size_GB.
+    Files in keep (e.g. the files of the current run) and files that are not registered are never removed.
+    '''
+    max_size_GB = settings.cache_settings["max_size_GB"] if max_size_GB is None else max_size_GB
+    keep_names = {Path(file_path).name for file_path in (keep or [])}
+    with locked_manifest(dir_cache) as manifest:
+        # drop entries of files that were removed by hand
+        for name in [name for name in manifest if not grid_store.exists(Path(dir_cache) / name)]:
+            del manifest[name]
+        total_size = sum(entry["size"] for entry in manifest.values())
+        for name, entry in sorted(manifest.items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= max_size_GB * 1e9:
+                break
+            if name in keep_names:
+                continue
+            grid_store.remove(Path(dir_cache) / name)
+            del manifest[name]
+            total_size -= entry["size"]
+            log.info(f"Cache: removed {name} ({entry['size'] / 1e9:,.2f} GB, last used {time.ctime(entry['last_used'])})")
@@ -0,0 +1,164 @@
+import logging
+
+import dask.array as dask_array
+import numpy as np
+import xarray as xr
+
+from tools.functions_logging import deferred_logging
+
+import downscaling.dask_cluster as dask_cluster
+import downscaling.chunk_planner as chunk_planner
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Land-only packed layout of (time, y, x) grids
+# About 70% of a global grid is ocean (region 0). Cubes can be packed to (time, land_cell) with only the
+# land cells (region_number > 0), processed in that layout (Kaya product, regional reductions, harmonisation)
+# and scattered back to (time, y, x) when they are exported.
+# The land cells are ordered block by block: packed chunk k holds the land cells of (y, x) block k of the
+# region raster (row-major over the block grid). Packing and unpacking therefore work per block and no
+# global index array is needed, the land index only holds the number of land cells per block.
+
+# (y, x) blocks of the land index: planned for the packed Kaya product (four cubes per block, see chunk_planner.py)
+
+def _land_mask(region_ids:np.ndarray) -> np.ndarray:
+    return np.isfinite(region_ids) & (region_ids > 0)
+
+def _count_land_block(region_ids:np.ndarray) -> np.ndarray:
+    return np.array([[_land_mask(region_ids).sum()]], dtype="int64")
+
+def _pack_block(values:np.ndarray, region_ids:np.ndarray) -> np.ndarray:
+    # (.., y, x) chunk -> (.., land_cell) chunk
+    return values[..., _land_mask(region_ids)]
+
+def _unpack_block(values:np.ndarray, region_ids:np.ndarray, fill_value) -> np.ndarray:
+    # (.., land_cell) chunk -> (.., y, x) chunk, fill_value outside land
+    mask = _land_mask(region_ids)
+    grid = np.full(values.shape[:-1] + mask.shape, fill_value, dtype=values.dtype)
+    grid[..., mask] = values
+    return grid
+
+def build_land_index(xr_region_numbers:xr.DataArray, chunks:dict|None=None,
+                     log: logging.Logger=local_log) -> dict:
+    '''
+    Build the land index of a (y, x) region raster.
+    Returns a dict with the chunked region raster, the land cell counts per (y, x) block,
+    the grid coordinates and the packed region numbers (Dataset with region_number over land_cell,
+    usable wherever the region raster is passed to the regional reductions and harmonisation).
+    '''
+    xr_region_numbers = xr_region_numbers.transpose("y", "x")
+    chunks = chunk_planner.chunks_for(xr_region_numbers, n_arrays=4, log=log) if chunks is None else chunks
+    region_ids = xr_region_numbers.data
+    if isinstance(region_ids, dask_array.Array):
+        region_ids = region_ids.rechunk((chunks["y"], chunks["x"]))
+    else:
+        region_ids = dask_cluster.shared_array(np.asarray(region_ids), chunks=(chunks["y"], chunks["x"]))
+
+    counts = dask_array.map_blocks(_count_land_block, region_ids,
+                                   chunks=((1,) * region_ids.numblocks[0], (1,) * region_ids.numblocks[1]),
+                                   dtype="int64").compute()
+    land_index = {"region_ids": region_ids,
+                  "counts": counts,
+                  "n_land": int(counts.sum()),
+                  "y": xr_region_numbers["y"],
+                  "x": xr_region_numbers["x"]}
+
+    # packed region numbers, ordered like the packed cubes
+    np_region_packed = _pack(region_ids[np.newaxis], land_index)[0]
+    land_index["xr_region_numbers"] = xr.Dataset({"region_number": (("land_cell",), np_region_packed)},
+                                                 coords={"land_cell": np.arange(land_index["n_land"])})
+
+    n_cells = region_ids.shape[0] * region_ids.shape[1]
+    log.info(f"Land index: {land_index['n_land']:,} land cells of {n_cells:,} grid cells ({100 * land_index['n_land'] / n_cells:.1f}%) in {counts.size} blocks")
+
+    return land_index
+
+def _pack(data:dask_array.Array, land_index:dict) -> dask_array.Array:
+    region_ids = land_index["region_ids"]
+    data = data.rechunk({data.ndim - 2: region_ids.chunks[0], data.ndim - 1: region_ids.chunks[1]})
+    index_lead = "".join(chr(ord("a") + i) for i in range(data.ndim - 2))
+    pieces = []
+    for i in range(region_ids.numblocks[0]):
+        for j in range(region_ids.numblocks[1]):
+            pieces.append(dask_array.blockwise(_pack_block, index_lead + "l",
+                                               data.blocks[..., i, j], index_lead + "yx",
+                                               region_ids.blocks[i, j], "yx",
+                                               new_axes={"l": int(land_index["counts"][i, j])},
+                                               concatenate=True,
+                                               dtype=data.dtype,
+                                               meta=np.empty((0,) * (data.ndim - 1), dtype=data.dtype)))
+    return dask_array.concatenate(pieces, axis=-1)
+
+def pack_land(da_grid:xr.DataArray, land_index:dict) -> xr.DataArray:
+    '''
+    Pack a (.., y, x) DataArray to (.., land_cell), lazily.
+    The grid must have the same (y, x) shape and order as the region raster of the land index.
+    Scalar coordinates (e.g. spatial_ref) and attributes are kept, region_number is added as land_cell coordinate.
+    '''
+    lead_dims = [dim for dim in da_grid.dims if dim not in ("y", "x")]
+    da_grid = da_grid.transpose(*lead_dims, "y", "x")
+    if da_grid.chunks is None:
+        # numpy or lazily opened: read one (y, x) block of the land index at a time
+        da_grid = da_grid.chunk({**{dim: 1 for dim in lead_dims}, "y": land_index["region_ids"].chunksize[0], "x": land_index["region_ids"].chunksize[1]})
+    data = da_grid.data
+
+    coords = {dim: da_grid[dim] for dim in lead_dims}
+    coords.update({name: coord for name, coord in da_grid.coords.items() if coord.ndim == 0})
+    coords["land_cell"] = land_index["xr_region_numbers"]["land_cell"]
+    coords["region_number"] = land_index["xr_region_numbers"]["region_number"]
+
+    return xr.DataArray(_pack(data, land_index), dims=lead_dims + ["land_cell"], coords=coords,
+                        attrs=da_grid.attrs, name=da_grid.name)
+
+def unpack_land(da_packed:xr.DataArray, land_index:dict, fill_value=np.nan) -> xr.DataArray:
+    '''
+    Scatter a (.., land_cell) DataArray back to (.., y, x), lazily; cells outside land get fill_value.
+    '''
+    lead_dims = [dim for dim in da_packed.dims if dim != "land_cell"]
+    da_packed = da_packed.transpose(*lead_dims, "land_cell")
+    if da_packed.chunks is None:
+        da_packed = da_packed.chunk({dim: 1 for dim in lead_dims})
+    data = da_packed.data
+    counts = land_index["counts"]
+    # one land_cell chunk per (y, x) block
+    data = data.rechunk({data.ndim - 1: tuple(int(n) for n in counts.ravel())})
+
+    region_ids = land_index["region_ids"]
+    index_lead = "".join(chr(ord("a") + i) for i in range(len(lead_dims)))
+    rows = []
+    for i in range(region_ids.numblocks[0]):
+        row = []
+        for j in range(region_ids.numblocks[1]):
+            k = i * region_ids.numblocks[1] + j
+            row.append(dask_array.blockwise(_unpack_block, index_lead + "yx",
+                                            data.blocks[..., k], index_lead + "l",
+                                            region_ids.blocks[i, j], "yx",
+                                            concatenate=True,
+                                            fill_value=fill_value,
+                                            dtype=data.dtype,
+                                            meta=np.empty((0,) * (len(lead_dims) + 2), dtype=data.dtype)))
+        rows.append(row)
+    # dask_array.block concatenates the inner lists along x and the outer list along y
+    grid = dask_array.block(rows)
+
+    coords = {dim: da_packed[dim] for dim in lead_dims}
+    coords.update({name: coord for name, coord in da_packed.coords.items() if coord.ndim == 0})
+    coords["y"] = land_index["y"]
+    coords["x"] = land_index["x"]
+
+    return xr.DataArray(grid, dims=lead_dims + ["y", "x"], coords=coords,
+                        attrs=da_packed.attrs, name=da_packed.name)
+
+def pack_land_dataset(ds:xr.Dataset, land_index:dict) -> xr.Dataset:
+    '''
+    Pack all (.., y, x) variables of a Dataset to (.., land_cell).
+    '''
+    return xr.Dataset({name: pack_land(da, land_index) for name, da in ds.data_vars.items() if {"y", "x"} <= set(da.dims)},
+                      attrs=ds.attrs)
+
+def unpack_land_dataset(ds_packed:xr.Dataset, land_index:dict, fill_value=np.nan) -> xr.Dataset:
+    '''
+    Scatter all (.., land_cell) variables of a Dataset back to (.., y, x).
+    '''
+    return xr.Dataset({name: unpack_land(da, land_index, fill_value) for name, da in ds_packed.data_vars.items() if "land_cell" in da.dims},
+                      attrs=ds_packed.attrs)
@@ -0,0 +1,138 @@
+import itertools
+import logging
+import threading
+import time
+
+import psutil
+
+from tools.functions_logging import deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Peak memory per step
+# With memory_settings["enabled"] the steps of the run report (see run_report.py) also record their peak memory.
+# A sampler thread measures every memory_settings["interval_s"] seconds the resident memory (RSS) of the process and,
+# when a dask cluster is used (see dask_cluster.py), the memory of its workers as reported to the scheduler; every
+# step that is running keeps the highest values seen between its start and end. Steps that run concurrently in the
+# pipeline share the process, so their peaks include each other's memory.
+# At the end of a step the largest arrays among its outputs are recorded (largest_output_arrays: in memory or, for dask
+# arrays, the largest chunk). These are the arrays the step returns, not its temporaries: an intermediate array that
+# is freed before the step ends counts in the peak memory but is not listed. A warning is logged when the peak
+# exceeds the budget of the step (step_budget_GB, otherwise default_budget_GB, otherwise the memory budget of the
+# chunk planner).
+
+_lock = threading.Lock()
+_active = {}
+_sampler = {"thread": None}
+_tokens = itertools.count()
+
+def _workers_memory() -> list:
+    import downscaling.dask_cluster as dask_cluster
+    client = dask_cluster.get_client()
+    if client is None:
+        return []
+    return [worker["metrics"]["memory"] for worker in client.scheduler_info()["workers"].values()]
+
+def _sample():
+    rss = psutil.Process().memory_info().rss
+    try:
+        workers = _workers_memory()
+    except Exception:
+        workers = []
+    with _lock:
+        for peaks in _active.values():
+            peaks["rss"] = max(peaks["rss"], rss)
+            peaks["workers"] = max(peaks["workers"], sum(workers))
+            peaks["worker"] = max([peaks["worker"]] + workers)
+
+def _run_sampler():
+    while True:
+        with _lock:
+            if not _active:
+                _sampler["thread"] = None
+                return
+        _sample()
+        time.sleep(settings.memory_settings["interval_s"])
+
+def start(name:str) -> int:
+    '''
+    Start tracking the peak memory of a step; returns the token for stop().
+    '''
+    with _lock:
+        token = next(_tokens)
+        _active[token] = {"step": name, "rss": 0, "workers": 0, "worker": 0}
+        if _sampler["thread"] is None:
+            _sampler["thread"] = threading.Thread(target=_run_sampler, name="memory_monitor", daemon=True)
+            _sampler["thread"].start()
+    _sample()
+    return token
+
+def stop(token:int) -> dict:
+    '''
+    Stop tracking a step; returns its peak RSS of the process and, with a dask cluster, the peak memory of all
+    workers and of the largest worker (GB, None without a cluster).
+    '''
+    _sample()
+    with _lock:
+        peaks = _active.pop(token)
+    return {"peak_rss_GB": peaks["rss"] / 1e9,
+            "peak_workers_GB": peaks["workers"] / 1e9 if peaks["worker"] else None,
+            "peak_worker_GB": peaks["worker"] / 1e9 if peaks["worker"] else None}
+
+def largest_output_arrays(outputs, n:int|None=None) -> list:
+    '''
+    The n largest arrays (xarray DataArrays, data variables of Datasets, numpy arrays) among the outputs of a step
+    (not its temporaries):
+    name, shape, dtype, GB in memory (dask arrays: 0) and GB of the largest chunk (numpy arrays: the whole array).
+    '''
+    n = settings.memory_settings["largest_output_arrays"] if n is None else n
+    values = outputs.items() if isinstance(outputs, dict) else [("output", outputs)]
+    arrays = []
+    for name, value in values:
+        if hasattr(value, "data_vars"):
+            arrays.extend((f"{name}.{var}", value[var].data) for var in value.data_vars)
+        elif hasattr(value, "dims") and hasattr(value, "data"):
+            arrays.append((name, value.data))
+        elif hasattr(value, "nbytes") and hasattr(value, "shape"):
+            arrays.append((name, value))
+    records = []
+    for name, data in arrays:
+        chunks = getattr(data, "chunks", None)
+        if chunks is not None and hasattr(data, "dask"):
+            chunk_bytes = data.dtype.itemsize
+            for dim_chunks in chunks:
+                chunk_bytes *= max(dim_chunks) if dim_chunks else 0
+            in_memory = 0
+        else:
+            chunk_bytes = in_memory = data.nbytes
+        records.append({"array": name, "shape": list(data.shape), "dtype": str(data.dtype),
+                        "in_memory_GB": in_memory / 1e9, "largest_chunk_GB": chunk_bytes / 1e9})
+    return sorted(records, key=lambda record: (record["in_memory_GB"], record["largest_chunk_GB"]), reverse=True)[:n]
+
+def step_budget_GB(name:str) -> float:
+    '''
+    Memory budget of a step: memory_settings["step_budget_GB"][name], otherwise default_budget_GB,
+    otherwise the memory budget of the chunk planner.
+    '''
+    memory_settings = settings.memory_settings
+    if name in memory_settings["step_budget_GB"]:
+        return memory_settings["step_budget_GB"][name]
+    if memory_settings["default_budget_GB"] is not None:
+        return memory_settings["default_budget_GB"]
+    import downscaling.chunk_planner as chunk_planner
+    return chunk_planner.memory_budget_GB()
+
+def check_budget(name:str, memory:dict, log: logging.Logger=local_log) -> bool:
+    '''
+    Warn when the peak memory of a step (the process, or all workers of a cluster) exceeds its budget.
+    Returns True if the step stayed within the budget.
+    '''
+    budget = step_budget_GB(name)
+    peak = max(memory["peak_rss_GB"], memory["peak_workers_GB"] or 0)
+    if peak > budget:
+        log.warning(f"{PRINT_COLORS['red']}Memory: step {name} peaked at {peak:,.2f} GB, over its budget of {budget:,.2f} GB{PRINT_COLORS['end']}")
+        return False
+    return True
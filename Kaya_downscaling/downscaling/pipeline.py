@@ -0,0 +1,177 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from tools.functions_logging import deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.chunk_planner as chunk_planner
+import downscaling.grid_store as grid_store
+import downscaling.intermediate_cache as intermediate_cache
+import downscaling.run_report as run_report
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Dependency-graph scheduler for the downscaling steps
+# A pipeline is a dict of steps (see step()). Steps share state through a context dict: a step reads the context
+# entries named in its inputs and returns a dict with the entries named in its outputs. The step that produces an
+# input is a dependency, so the graph follows from the names.
+# Steps with files (paths in the context) and a cache key are fresh when all their files are registered with the
+# current key (see intermediate_cache); a fresh step with a load function only opens its files and does not need
+# its dependencies. A step is stale when it is forced, not fresh, or when one of its dependencies is stale.
+# Steps whose outputs are already in the context (e.g. computed by an earlier run_pipeline call or shared by the
+# caller) are not run again unless they are forced.
+# run_pipeline runs the targets and the steps they need, independent steps concurrently in a thread pool. The steps
+# that can run at the same time share the dask threads and the memory budget of the chunk plans (chunk_planner.shared_by).
+# Every step that runs or is loaded adds a record (wall and CPU time, I/O, cells per second, cache hit/miss and,
+# optionally, peak memory) to the run report passed to run_pipeline (see run_report.py).
+
+def step(func, inputs:list|None=None, outputs:list|None=None,
+         files:list|None=None, key=None, load=None, force:bool=False) -> dict:
+    '''
+    Declare a pipeline step.
+    func(context) -> dict with the outputs; inputs and outputs are context names.
+    files: context names of the paths written by the step, key(context) -> cache key of these files,
+    load(context) -> dict with the outputs read from the files (used instead of func when the step is fresh).
+    force: always run func (e.g. a process flag).
+    '''
+    return {"func": func, "inputs": list(inputs or []), "outputs": list(outputs or []),
+            "files": list(files or []), "key": key, "load": load, "force": force}
+
+def _dependencies(steps:dict) -> dict:
+    producers = {}
+    for name, node in steps.items():
+        for output in node["outputs"]:
+            if output in producers:
+                raise ValueError(f"Output '{output}' is produced by steps '{producers[output]}' and '{name}'")
+            producers[output] = name
+    return {name: sorted({producers[i] for i in node["inputs"] if i in producers}) for name, node in steps.items()}
+
+def _topological_order(steps:dict, dependencies:dict) -> list:
+    order = []
+    state = {}
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Cycle in pipeline: {' -> '.join(path + [name])}")
+        state[name] = "visiting"
+        for dependency in dependencies[name]:
+            visit(dependency, path + [name])
+        state[name] = "done"
+        order.append(name)
+    for name in steps:
+        visit(name, [])
+    return order
+
+def _is_fresh(node:dict, context:dict) -> bool:
+    if not node["files"] or node["key"] is None:
+        return False
+    key = node["key"](context)
+    return all(intermediate_cache.is_valid(context[file], key) for file in node["files"])
+
+def plan_pipeline(steps:dict, context:dict, targets:list|None=None, force:list|None=None) -> dict:
+    '''
+    Determine what run_pipeline does for every step: "run", "load" or "skip".
+    Returns {step: action} in topological order.
+    '''
+    dependencies = _dependencies(steps)
+    order = _topological_order(steps, dependencies)
+    force = set(force or [])
+    missing = [name for name in (targets or []) if name not in steps]
+    if missing:
+        raise ValueError(f"Unknown pipeline targets {missing}, available: {list(steps)}")
+
+    # staleness follows the dependencies: a step is stale if it is forced, not fresh, or one of its dependencies is stale
+    stale = {}
+    available = set()
+    for name in order:
+        node = steps[name]
+        forced = node["force"] or name in force
+        if not forced and node["outputs"] and all(output in context for output in node["outputs"]):
+            available.add(name)
+            stale[name] = False
+            continue
+        stale[name] = (forced or any(stale[d] for d in dependencies[name])
+                       or (bool(node["files"]) and not _is_fresh(node, context)))
+
+    # walk back from the targets; a fresh step that can be loaded does not need its dependencies
+    actions = {name: "skip" for name in order}
+    needed = list(targets) if targets else list(order)
+    while needed:
+        name = needed.pop()
+        if actions[name] != "skip" or name in available:
+            continue
+        node = steps[name]
+        if not stale[name] and node["load"] is not None:
+            actions[name] = "load"
+        else:
+            actions[name] = "run"
+            needed.extend(dependencies[name])
+
+    return {name: actions[name] for name in order}
+
+def run_pipeline(steps:dict, context:dict, targets:list|None=None, force:list|None=None, max_workers:int|None=None,
+                 report:dict|None=None, log: logging.Logger=local_log) -> dict:
+    '''
+    Run a pipeline: the targets (default: all steps) and the stale steps they need, loading fresh steps from their files.
+    Steps whose dependencies are done are submitted to a thread pool, so independent branches run concurrently.
+    After a step with files has run, its files are registered in the cache with the step's key.
+    report: run report (run_report.new_report) the records of the steps are added to.
+    Returns the context with the outputs of all steps that ran or were loaded.
+    '''
+    max_workers = settings.pipeline_settings["max_workers"] if max_workers is None else max_workers
+    dependencies = _dependencies(steps)
+    actions = plan_pipeline(steps, context, targets, force)
+    log.info(f"{PRINT_COLORS['purple']}Pipeline: " + ", ".join(f"{name} ({action})" for name, action in actions.items() if action != "skip") + f"{PRINT_COLORS['end']}")
+
+    def execute(name):
+        node = steps[name]
+        cached = bool(node["files"]) and node["key"] is not None
+        record = run_report.start_step(name, actions[name], ("hit" if actions[name] == "load" else "miss") if cached else "n/a")
+        if actions[name] == "load":
+            outputs = node["load"](context)
+        else:
+            outputs = node["func"](context) or {}
+        missing_outputs = [output for output in node["outputs"] if output not in outputs]
+        if missing_outputs:
+            raise ValueError(f"Step '{name}' did not return outputs {missing_outputs}")
+        record = run_report.end_step(report, record, {output: outputs[output] for output in node["outputs"]}, log=log)
+        return outputs, record["wall_s"]
+
+    pending = {name for name, action in actions.items() if action != "skip"}
+    done = set()
+    running = {}
+    n_concurrent = max(1, min(max_workers, len(pending)))
+    with chunk_planner.shared_by(n_concurrent), ThreadPoolExecutor(max_workers=n_concurrent) as executor:
+        while pending or running:
+            # steps that are loaded do not wait for their dependencies
+            ready = [name for name in pending
+                     if actions[name] == "load" or all(d in done or actions[d] == "skip" for d in dependencies[name])]
+            for name in sorted(ready):
+                pending.discard(name)
+                log.info(f"Pipeline: {actions[name]} {name}")
+                running[executor.submit(execute, name)] = name
+            if not running:
+                raise RuntimeError(f"Pipeline cannot continue, steps {sorted(pending)} wait for steps that did not run")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    outputs, seconds = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    log.error(f"{PRINT_COLORS['red']}Pipeline: step {name} failed{PRINT_COLORS['end']}")
+                    raise
+                context.update(outputs)
+                node = steps[name]
+                if actions[name] == "run" and node["files"] and node["key"] is not None:
+                    key = node["key"](context)
+                    for file in node["files"]:
+                        if grid_store.exists(context[file]):
+                            intermediate_cache.register(context[file], key, name, log)
+                done.add(name)
+                log.info(f"Pipeline: {name} done ({actions[name]}, {seconds / 60:,.1f} mins)")
+
+    return context
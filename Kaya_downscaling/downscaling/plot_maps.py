@@ -1,10 +1,8 @@
 from pathlib import Path
 
-import matplotlib
-matplotlib.use('TkAgg')
-
 import numpy as np
 import pandas as pd
+# no fixed backend: matplotlib uses an interactive backend when a display is available and Agg on headless servers
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import matplotlib.patches as mpatches
@@ -24,6 +22,8 @@ from rasterio.transform import from_bounds
 from tools.general_functions import replace_punctuation_in_filenames
 import downscaling.read_process_IAM_data as process_IAM_data
 import downscaling.process_IPAT_factors as process_IPAT_factors
+import downscaling.chunk_planner as chunk_planner
+import downscaling.grid_store as grid_store
 
 def plot_tiff(tiff_file:Path) -> None:
 
@@ -133,7 +133,8 @@ def plot_coast_checks(gadm_tif_path: Path, output_path: Path, add_text:str="", r
 
     print(f"Reading GADM raster: {gadm_tif_path}")
     # Open lazily — only clip regions are loaded into memory
-    ds = rxr.open_rasterio(gadm_tif_path, chunks="auto", lock=False)
+    ds = rxr.open_rasterio(gadm_tif_path, lock=False)
+    ds = ds.chunk(chunk_planner.chunks_for(ds))
 
     for region_name, (min_lon, max_lon, min_lat, max_lat) in CHECK_REGIONS.items():
         print(f"Plotting {region_name} ...")
@@ -259,7 +260,7 @@ def plot_IPAT_summary(dir_processed:Path, add_txt:str,
                             .sel(time=years)
                             .where(da > 0)
                             .coarsen(x=coarse_factor, y=coarse_factor, boundary="trim").sum())
-            da_coarsened = da_coarsened.chunk({"y": "auto", "x": "auto"})
+            da_coarsened = da_coarsened.chunk(chunk_planner.chunks_for(da_coarsened))
             das_coarsened[varname] = da_coarsened
 
         fig, ax = plt.subplots(
@@ -324,7 +325,7 @@ def plot_map(dir_processed:str, da:xr.DataArray, varname:str, add_txt:str, years
                             .sel(time=years)
                             .where(da > 0)
                             .coarsen(x=coarse_factor, y=coarse_factor, boundary="trim").sum())
-    da_plot_coarsened_plot = da_plot_coarsened_plot.chunk({"y": "auto", "x": "auto"})
+    da_plot_coarsened_plot = da_plot_coarsened_plot.chunk(chunk_planner.chunks_for(da_plot_coarsened_plot))
 
     # Plot the map
     n_years = len(years)
@@ -474,15 +475,15 @@ def plot_comparison_IAM_grid(project_dir:Path, dir_processed:Path, read_processe
     plot_dir = dir_processed / "figures"
     plot_dir.mkdir(parents=True, exist_ok=True)
     file_process_emissions_IAM = plot_dir / f"IAM_{model}_{scenario}_emissions_IAM.csv"
-    file_processed_emissions_grid = plot_dir / f"regional_sums_emissions_{model}_{scenario}.nc"
+    file_processed_emissions_grid = grid_store.store_path(plot_dir / f"regional_sums_emissions_{model}_{scenario}.nc")
 
     if read_processed_emissions or not file_process_emissions_IAM.exists():
         df_emissions, xr_emissions_regional_sums = process_IPAT_factors.calc_urban_regional_emissions(xr_grid, varname, df_IAM, years_downscaling)
         df_emissions.to_csv(file_process_emissions_IAM, sep=";", index=False)
-        xr_emissions_regional_sums.to_netcdf(file_processed_emissions_grid, mode="w", engine="h5netcdf")
+        grid_store.save_dataset(xr_emissions_regional_sums, file_processed_emissions_grid)
     else:
         df_emissions = pd.read_csv(file_process_emissions_IAM, sep=";")
-        xr_emissions_regional_sums = xr.open_dataset(file_processed_emissions_grid)
+        xr_emissions_regional_sums = grid_store.open_dataset(file_processed_emissions_grid)
 
     varname_IAM = f"{varname}_IAM"
     varname_grid = f"{varname}_grid_summed"
@@ -2,20 +2,26 @@ from pathlib import Path
 from typing import Tuple
 import logging
 
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-
+import dask
 from dask.diagnostics import ProgressBar
+import dask.array as dask_array
 import numpy as np
 import pandas as pd
 from affine import Affine
 import xarray as xr
 
-from tools.functions_logging import init_logging
-from tools.general_functions import replace_punctuation_in_filenames
+from tools.functions_logging import deferred_logging
+from tools.general_functions import replace_punctuation_in_filenames, lazy_import
 from downscaling.read_process_grid_data import calculate_resolution
+import downscaling.dask_cluster as dask_cluster
+import downscaling.grid_store as grid_store
+import downscaling.chunk_planner as chunk_planner
+import downscaling.time_interpolation as time_interpolation
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
 
-local_log, dummy_log = init_logging("log", "log/reading_data/local")
+# only the check plots use matplotlib
+plt = lazy_import("matplotlib.pyplot")
 
 DIR = Path(__file__).parent
 
@@ -30,6 +36,115 @@ DIR = Path(__file__).parent
 # 3. EM per GDP (PPP)
 
 #**************************GENERAL*******************************************
+# chunks of the regional reductions and the Kaya product follow from the memory budget (see chunk_planner.py)
+
+def _regional_sums_block(values:np.ndarray, region_ids:np.ndarray, n_regions:int) -> np.ndarray:
+    # values is one (time, y, x) chunk, region_ids the matching (y, x) chunk of the region raster
+    ids = region_ids.ravel()
+    values_flat = values.reshape(values.shape[0], -1)
+    sums = np.empty((values_flat.shape[0], n_regions), dtype="float64")
+    for t in range(values_flat.shape[0]):
+        sums[t] = np.bincount(ids, weights=np.nan_to_num(values_flat[t], nan=0.0), minlength=n_regions)
+
+    # one partial sum per chunk: keep a length-1 axis for every spatial dimension
+    return sums.reshape((values.shape[0],) + (1,) * (values.ndim - 1) + (n_regions,))
+
+def calc_regional_sums_chunked(da_grid:xr.DataArray, xr_region_numbers:xr.DataArray, n_regions:int|None=None,
+                               compute:bool=True, log: logging.Logger=local_log) -> xr.DataArray:
+    '''
+    Sum a (time, y, x) cube per region in a single pass over its dask chunks.
+    Each chunk is reduced with np.bincount to a (time, n_regions) partial sum and the partial sums
+    are added in a tree reduction, so peak memory is bounded by one chunk instead of one global year slice.
+    The region raster is matched by position, it must have the same (y, x) shape as the cube.
+    Returns a DataArray (time, region_number); with compute=False the result stays lazy.
+    '''
+    spatial_dims = [dim for dim in da_grid.dims if dim != "time"]
+    da_grid = da_grid.transpose("time", *spatial_dims)
+    if da_grid.chunks is None:
+        # lazily backed (e.g. opened without chunks): chunk so that only one block is read at a time
+        da_grid = da_grid.chunk(chunk_planner.chunks_for(da_grid, n_arrays=2, log=log))
+    data = da_grid.data
+
+    region_ids = xr_region_numbers.transpose(*spatial_dims).data
+    if n_regions is None:
+        n_regions = int(region_ids.max()) + 1
+    if isinstance(region_ids, dask_array.Array):
+        region_ids = region_ids.astype("int64").rechunk(data.chunks[1:])
+    else:
+        region_ids = dask_cluster.shared_array(np.asarray(region_ids).astype("int64"), chunks=data.chunks[1:])
+    log.info(f"Regional reduction over {data.npartitions} chunks (chunk shape {data.chunksize}) for {n_regions} region numbers")
+
+    index_spatial = "".join(chr(ord("a") + i) for i in range(len(spatial_dims)))
+    partial_sums = dask_array.blockwise(_regional_sums_block, "t" + index_spatial + "r",
+                                        data, "t" + index_spatial,
+                                        region_ids, index_spatial,
+                                        new_axes={"r": n_regions},
+                                        adjust_chunks={i: 1 for i in index_spatial},
+                                        n_regions=n_regions,
+                                        dtype="float64",
+                                        meta=np.empty((0,) * (len(spatial_dims) + 2), dtype="float64"))
+    sums = partial_sums.sum(axis=tuple(range(1, len(spatial_dims) + 1)))
+    if compute:
+        sums = sums.compute()
+
+    return xr.DataArray(sums,
+                        dims=["time", "region_number"],
+                        coords={"time": da_grid["time"].values,
+                                "region_number": np.arange(n_regions)},
+                        name=da_grid.name)
+
+def _region_index(region_ids:np.ndarray, n_regions:int) -> np.ndarray:
+    # region raster chunk -> integer column index into a (.., n_regions) lookup table
+    # cells without a valid region (ocean, NaN, unknown ids) point to column 0, which is kept NaN
+    valid = np.isfinite(region_ids) & (region_ids > 0) & (region_ids < n_regions)
+    return np.where(valid, region_ids, 0).astype("int64")
+
+def _regional_factors_block(values:np.ndarray, region_ids:np.ndarray, table:np.ndarray) -> np.ndarray:
+    # values is one (time, y, x) chunk, table the matching (time, n_regions) rows of the factor table
+    return values * table[:, _region_index(region_ids, table.shape[1])]
+
+def apply_regional_factors(da_grid:xr.DataArray, xr_factors_regional:xr.DataArray, xr_region_numbers:xr.DataArray,
+                           log: logging.Logger=local_log) -> xr.DataArray:
+    '''
+    Multiply a (time, y, x) grid by factors that only vary per (time, region_number), lazily.
+    The factors are kept as a small (time, region) table and gathered through the region raster
+    chunk by chunk, the (time, y, x) factor cube is never built.
+    Cells outside the IAM regions (region_number 0 or missing) become NaN, regions without a factor get 0.
+    '''
+    spatial_dims = [dim for dim in da_grid.dims if dim != "time"]
+    da_grid = da_grid.transpose("time", *spatial_dims)
+    if da_grid.chunks is None:
+        da_grid = da_grid.chunk(chunk_planner.chunks_for(da_grid, n_arrays=3, log=log))
+    data = da_grid.data
+
+    xr_factors_regional = xr_factors_regional.transpose("time", "region_number")
+    if not np.array_equal(da_grid.time.values, xr_factors_regional.time.values):
+        log.info("Aligning time coordinates between grid and regional factors...")
+        xr_factors_regional = xr_factors_regional.interp(time=da_grid.time)
+    region_numbers = xr_factors_regional.region_number.values.astype("int64")
+    table = np.zeros((len(da_grid.time), int(region_numbers.max()) + 1), dtype="float64")
+    table[:, region_numbers] = xr_factors_regional.values
+    table[:, 0] = np.nan  # ocean
+    table = dask_cluster.shared_array(table, chunks=(data.chunks[0], table.shape[1]))
+
+    region_ids = xr_region_numbers.transpose(*spatial_dims).data
+    if isinstance(region_ids, dask_array.Array):
+        region_ids = region_ids.rechunk(data.chunks[1:])
+    else:
+        region_ids = dask_cluster.shared_array(np.asarray(region_ids), chunks=data.chunks[1:])
+    log.info(f"Applying regional factors ({table.shape[0]} time steps x {table.shape[1]} region numbers) over {data.npartitions} chunks")
+
+    index_spatial = "".join(chr(ord("a") + i) for i in range(len(spatial_dims)))
+    data_factored = dask_array.blockwise(_regional_factors_block, "t" + index_spatial,
+                                         data, "t" + index_spatial,
+                                         region_ids, index_spatial,
+                                         table, "tr",
+                                         concatenate=True,
+                                         dtype=np.result_type(data.dtype, table.dtype),
+                                         meta=np.empty((0,) * (len(spatial_dims) + 1), dtype=np.result_type(data.dtype, table.dtype)))
+
+    return xr.DataArray(data_factored, dims=da_grid.dims, coords=da_grid.coords, attrs=da_grid.attrs, name=da_grid.name)
+
 def sum_grid_to_IAM_regions(xr_main:xr.DataArray, xr_weight:xr.DataArray, xr_regions):
     """
     Calculate weighted sum for each region and each time step using full vectorization.
@@ -38,7 +153,8 @@ def sum_grid_to_IAM_regions(xr_main:xr.DataArray, xr_weight:xr.DataArray, xr_reg
     varname_main = xr_main.name
     varname_weight = xr_weight.name
 
-    xr_main = xr_main.chunk({"time": 1, "y": 1024, "x": 1024})
+    # main, weight and weighted product per chunk
+    xr_main = xr_main.chunk(chunk_planner.chunks_for(xr_main, n_arrays=3))
 
     # Reindex weight data to match main data grid
     #xr_weight_reindex = xr_weight.reindex_like(xr_main, method="nearest")
@@ -260,9 +376,9 @@ def process_factors_GDP_POP(ds_population:xr.Dataset, ds_gdp_ppp:xr.Dataset, rxr
     #ds_population_aligned = ds_population.copy()
     #ds_gdp_aligned = ds_gdp_ppp.copy()
 
-    ds_population_downscaling = ds_population.interp(time=years_downscaling, method="linear")
+    ds_population_downscaling = time_interpolation.interp_years(ds_population, years_downscaling)
     print(f"(process_factors_GDP_POP) Years in population grid aligned with downscaling years: {ds_population_downscaling.time.values}")
-    ds_gdp_ppp_downscaling = ds_gdp_ppp.interp(time=years_downscaling, method="linear")
+    ds_gdp_ppp_downscaling = time_interpolation.interp_years(ds_gdp_ppp, years_downscaling)
     print(f"(process_factors_GDP_POP) Years in GDP (PPP) grid aligned with downscaling years: {ds_gdp_ppp_downscaling.time.values}")
     # check
     total_pop_2020 = ds_population_downscaling[varname_population].sel(time=2020).sum().compute().item()
@@ -360,6 +476,46 @@ def calculate_gdp_per_pop(ds_population, ds_gdp,
 
 #**************************EM per GDP (PPP) *******************************************
 
+def _regional_lookup_table(df:pd.DataFrame, years, regions) -> np.ndarray:
+    '''
+    Build a (year, region_number) table from an IAM long-format DataFrame.
+    Column i holds region_number i, columns of regions not in `regions` (and region 0) are NaN.
+    Raises a ValueError if a land region (number > 0) has no row for one of the years.
+    '''
+    n_regions = int(np.max(regions)) + 1
+    df_sel = df[df["year"].isin(years) & df["region_number"].isin(regions)].drop_duplicates(["year", "region_number"], keep="first")
+    df_table = df_sel.pivot(index="year", columns="region_number", values="value").reindex(index=list(years))
+
+    # a missing (year, region) would be a NaN column, i.e. no downscaled emissions in the region
+    expected = pd.MultiIndex.from_product([list(years), [int(region) for region in regions if region > 0]], names=["year", "region_number"])
+    present = pd.MultiIndex.from_arrays([df_sel["year"], df_sel["region_number"].astype("int64")], names=["year", "region_number"])
+    missing = expected.difference(present)
+    if len(missing) > 0:
+        raise ValueError(f"No IAM value for {len(missing)} (year, region_number) pairs, e.g. {missing[:10].tolist()}")
+
+    table = np.full((len(years), n_regions), np.nan)
+    table[:, df_table.columns.astype("int64")] = df_table.to_numpy(dtype="float64")
+    return table
+
+def _em_per_gdp_block(scaling_factor_by:np.ndarray, region_ids:np.ndarray,
+                      table:np.ndarray, weights:np.ndarray) -> np.ndarray:
+    # scaling_factor_by and region_ids are one (y, x) chunk, table is (year, region), weights is (year,)
+    sf = scaling_factor_by[np.newaxis, :, :]
+    w = weights[:, np.newaxis, np.newaxis]
+    with np.errstate(invalid="ignore", over="ignore"):
+        # w == 0: base-year factor, w == 1: converged (1.0 also where the base-year factor is not finite)
+        sf_year = np.where(w >= 1, 1.0, np.where(w <= 0, sf, sf + (1 - sf) * w))
+        values = sf_year * table[:, _region_index(region_ids, table.shape[1])]
+    return np.where(np.isfinite(values), values, np.nan)
+
+def _scaling_factor_by_block(em_per_gdp_by:np.ndarray, region_ids:np.ndarray, divisor:np.ndarray) -> np.ndarray:
+    # em_per_gdp_by and region_ids are one (y, x) chunk, divisor is the base-year IAM value per region_number
+    index = _region_index(region_ids, divisor.shape[0])
+    divisor_grid = divisor[index]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaling_factor_by = np.where(divisor_grid != 0, em_per_gdp_by / divisor_grid, 1.0)
+    return np.where(index > 0, scaling_factor_by, np.nan)
+
 def calc_scaling_factors_EM_per_GDP(xr_IAM_regions_grid_downscaling:xr.Dataset,
                                     base_year:int,
                                     xr_gdp_ppp_by_downscaling:xr.DataArray,
@@ -368,29 +524,35 @@ def calc_scaling_factors_EM_per_GDP(xr_IAM_regions_grid_downscaling:xr.Dataset,
     """
     Calculate scaling factors for each grid cell based on the ratio of
     emissions per GDP in the base year (2020) between the grid cell and the
+    IAM region the cell belongs to.
+    The base-year IAM values are collected in a divisor vector indexed by region_number and applied
+    through the region raster in one blockwise operation, so the grid is never loaded as a whole.
 
     Parameters:
     -----------
-    em_per_gdp_by : xarray.DataArray
-        Grid of emissions per GDP for 2020 (dimensions: x, y, time)
-    region_grid : xarray.DataArray
-        Grid indicating region ID for each cell (dimensions: x, y)
-    df_regional : pandas.DataFrame
-        Regional emissions per GDP with columns for each year
-        (index: region IDs, columns: years)
-    years_downscaling : list
-        Years available in df_regional
-    target_year : int
-        Final year to interpolate to (default: 2150)
+    xr_IAM_regions_grid_downscaling : xarray.Dataset
+        Grid indicating region ID for each cell (variable region_number, dimensions: y, x)
+    base_year : int
+        Base year of the scaling factors
+    xr_gdp_ppp_by_downscaling : xarray.DataArray
+        GDP (PPP) grid for the base year, used for the grid coordinates
+    xr_em_per_gdp_ppp_by_downscaling : xarray.DataArray
+        Grid of emissions per GDP for the base year (dimensions: y, x)
+    df_IAM_projection_em_per_GDP_PPP_downscaling_extended : pandas.DataFrame
+        Regional emissions per GDP (columns: region_number, year, value)
 
     Returns:
     --------
-    xarray.Dataset with emissions per GDP for all years
+    xarray.DataArray with the base-year scaling factors (dask-backed, NaN outside IAM regions),
+    the region numbers and the x and y coordinates of the grid
     """
 
     # Get unique regions
-    vals = xr_IAM_regions_grid_downscaling["region_number"].values
-    regions = np.unique(vals[(vals > 0) & np.isfinite(vals)])
+    vals = xr_IAM_regions_grid_downscaling["region_number"].data
+    if isinstance(vals, dask_array.Array):
+        regions = dask_array.unique(vals[(vals > 0) & dask_array.isfinite(vals)]).compute()
+    else:
+        regions = np.unique(vals[(vals > 0) & np.isfinite(vals)])
     print(f"Regions: {regions}")
 
     # Get grid dimensions
@@ -398,24 +560,31 @@ def calc_scaling_factors_EM_per_GDP(xr_IAM_regions_grid_downscaling:xr.Dataset,
     y_coords = xr_gdp_ppp_by_downscaling.y
     print(f"Grid dimensions: x={len(x_coords)}, y={len(y_coords)}")
 
-    # Get baseline (2020) grid values
-    # baseline_grid = em_per_gdp_by.sel(time=2020).values
-
     # Calculate initial scaling factor for each grid cell (2020)
-    # scaling_factor_by = CO2perGDP_grid(by) / CO2perGDP_region_IAM(by)
-    np_scaling_factor_by = np.full((len(y_coords), len(x_coords)), np.nan)
-    #convert = one_unit_IMAGE_GDP_PPP / one_unit_IMAGE_em
-    for region_id in regions:
-        region_mask_xr = (xr_IAM_regions_grid_downscaling["region_number"].values == region_id)
-
-        region_mask_df = (df_IAM_projection_em_per_GDP_PPP_downscaling_extended["region_number"] == region_id) & (df_IAM_projection_em_per_GDP_PPP_downscaling_extended["year"] == base_year)
-        baseline_regional_IAM = df_IAM_projection_em_per_GDP_PPP_downscaling_extended.loc[region_mask_df, "value"].iloc[0]
+    # scaling_factor_by = CO2perGDP_grid(by) / CO2perGDP_region_IAM(by), 1.0 where the regional value is 0
+    # Both in grid units now - no conversion needed
+    divisor = _regional_lookup_table(df_IAM_projection_em_per_GDP_PPP_downscaling_extended, [base_year], regions)[0]
+    missing_regions = regions[np.isnan(divisor[regions.astype("int64")])]
+    if len(missing_regions) > 0:
+        raise ValueError(f"No IAM emissions per GDP (PPP) in {base_year} for regions {missing_regions}")
+
+    em_per_gdp_by = xr_em_per_gdp_ppp_by_downscaling.transpose("y", "x").data
+    if not isinstance(em_per_gdp_by, dask_array.Array):
+        em_per_gdp_by = dask_array.from_array(em_per_gdp_by,
+                                              chunks=chunk_planner.spatial_chunks(xr_em_per_gdp_ppp_by_downscaling, n_arrays=3))
+    if isinstance(vals, dask_array.Array):
+        region_ids = vals.rechunk(em_per_gdp_by.chunks)
+    else:
+        region_ids = dask_cluster.shared_array(np.asarray(vals), chunks=em_per_gdp_by.chunks)
 
-        if baseline_regional_IAM != 0:
-            # Both in grid units now - no conversion needed
-            np_scaling_factor_by[region_mask_xr] = xr_em_per_gdp_ppp_by_downscaling.values[region_mask_xr] / baseline_regional_IAM
-        else:
-            np_scaling_factor_by[region_mask_xr] = 1.0
+    # the IAM table is one chunk, shared by all (y, x) chunks
+    np_scaling_factor_by = dask_array.blockwise(_scaling_factor_by_block, "yx",
+                                                em_per_gdp_by, "yx",
+                                                region_ids, "yx",
+                                                dask_cluster.shared_array(divisor, chunks=divisor.shape), "r",
+                                                concatenate=True,
+                                                dtype="float64",
+                                                meta=np.empty((0, 0), dtype="float64"))
 
     # Scaling factor in 2150 is 1 for all grid cells
     scaling_factor_2150 = 1.0
@@ -447,18 +616,15 @@ def downscale_em_per_gdp(xr_scaling_factor_by:xr.DataArray, varname_em_per_gdp_p
     enabling the representation of convergence in regional emission intensities.
 
     Steps:
-    1. For each year in the downscaling period:
-       - Determine the appropriate scaling factor based on temporal interpolation:
-         * Before base year: use base-year scaling factors
-         * After convergence year: use scaling factor of 1.0 (full convergence)
-         * Between years: linearly interpolate scaling factors between base and convergence
-       - For each IAM region:
-         * Retrieve the regional emissions per GDP value for the given year
-         * Identify grid cells belonging to the region
-         * Apply the scaling factor: downscaled_value = scaling_factor × regional_value
-       - Store the resulting gridded data for the year
-    2. Combine all yearly grids into a single xarray DataArray with time dimension
-    3. Mask invalid (non-finite) values
+    1. Build a (year, region) lookup table of the regional emissions per GDP values
+    2. Determine the convergence weight for each year:
+         * Before base year: 0, use base-year scaling factors
+         * After convergence year: 1, use scaling factor of 1.0 (full convergence)
+         * Between years: linear, interpolate scaling factors between base and convergence
+    3. In a single pass over the (y, x) chunks of the grid:
+         * Gather the regional values of all years through the region raster
+         * Apply the weighted scaling factor: downscaled_value = scaling_factor(year) × regional_value(year)
+         * Mask invalid (non-finite) values
     4. Convert to xarray Dataset and attach geospatial metadata (CRS, transform)
     5. Assign unit metadata from the input DataFrame
 
@@ -481,53 +647,40 @@ def downscale_em_per_gdp(xr_scaling_factor_by:xr.DataArray, varname_em_per_gdp_p
                     - Dimensions: (time, y, x)
                     - Coordinates: time, y, x
                     - Attributes: unit, CRS, and geospatial transform
+                    The data is dask-backed and evaluated when it is written or computed.
     """
 
-    result_list = []
-
-    for year in years_downscaling_extended:
-        print(f"Processing year {year} ...")
-
-        # Linearly interpolate scaling factor between 2020 and 2150
-        if year <= base_year:
-            scaling_factor_year = xr_scaling_factor_by.values  # at by year, scalig factor is the same as in the base year
-        elif year >= convergence_year:
-            scaling_factor_year = np.ones_like(xr_scaling_factor_by.values)  # after convergence year, scaling factor is 1
-        else: # Linear interpolation between by scalign and 1
-            #weight of scaling factor
-            weight = (year - base_year) / (convergence_year - base_year)
-            scaling_factor_year = np.full_like(xr_scaling_factor_by.values, np.nan) # create empty array with np.nan with same shape as xr_scaling_factor_by
-            finite_mask = np.isfinite(xr_scaling_factor_by.values)
-            # check for infs
-            scaling_factor_year[finite_mask] = (xr_scaling_factor_by.values[finite_mask] + (1 - xr_scaling_factor_by.values[finite_mask]) * weight)
-
-        # Create empty grid for this year
-        year_grid = np.full((len(y_coords), len(x_coords)), np.nan)
-
-        # For each region, multiply scaling factor with regional CO2perGDP
-        print(f"Processing region_id: ", end="")
-        for region_id in regions:
-            print(f"{region_id}...", end="")
-            region_mask = (xr_IAM_regions_grid_downscaling["region_number"].values == region_id)
-
-            # Get regional value for this year (should exist in df_regional)
-            regional_mask = (df_IAM_projection_em_per_GDP_PPP_downscaling["region_number"] == region_id) & (df_IAM_projection_em_per_GDP_PPP_downscaling["year"] == year)
-            regional_value = df_IAM_projection_em_per_GDP_PPP_downscaling.loc[regional_mask, "value"].iloc[0]  # Add .iloc[0] to get scalar
-
-            # Apply: CO2perGDP_grid(year) = scaling_factor(year) * CO2perGDP_region(year)
-            year_grid[region_mask] = scaling_factor_year[region_mask] * regional_value
-        print()
-        # Create DataArray for this year
-        year_da = xr.DataArray(
-            year_grid,
-            coords={"y": y_coords, "x": x_coords, "time": year},
-            dims=["y", "x"]
-        )
-        result_list.append(year_da)
-
-    # Combine all years into a single DataArray
-    xr_em_per_gdp_ppp = xr.concat(result_list, dim="time")
-    xr_em_per_gdp_ppp = xr_em_per_gdp_ppp.where(np.isfinite(xr_em_per_gdp_ppp))
+    years = list(years_downscaling_extended)
+    table = _regional_lookup_table(df_IAM_projection_em_per_GDP_PPP_downscaling, years, regions)
+    weights = np.clip((np.asarray(years, dtype="float64") - base_year) / (convergence_year - base_year), 0.0, 1.0)
+    print(f"Downscaling emissions per GDP (PPP) for {len(years)} years and {len(regions)} regions in one pass")
+
+    scaling_factor_by = xr_scaling_factor_by.transpose("y", "x").data
+    if not isinstance(scaling_factor_by, dask_array.Array):
+        # every (y, x) chunk produces all years of the output
+        chunks = chunk_planner.plan_chunks({"time": len(years), "y": scaling_factor_by.shape[0], "x": scaling_factor_by.shape[1]},
+                                           n_arrays=3, full_dims=["time"])
+        scaling_factor_by = dask_array.from_array(scaling_factor_by, chunks=(chunks["y"], chunks["x"]))
+    region_ids = xr_IAM_regions_grid_downscaling["region_number"].transpose("y", "x").data
+    if isinstance(region_ids, dask_array.Array):
+        region_ids = region_ids.rechunk(scaling_factor_by.chunks)
+    else:
+        region_ids = dask_cluster.shared_array(np.asarray(region_ids), chunks=scaling_factor_by.chunks)
+
+    # the (year, region) IAM table is one chunk, shared by all (y, x) chunks
+    np_em_per_gdp_ppp = dask_array.blockwise(_em_per_gdp_block, "tyx",
+                                             scaling_factor_by, "yx",
+                                             region_ids, "yx",
+                                             dask_cluster.shared_array(table, chunks=table.shape), "ur",
+                                             new_axes={"t": len(years)},
+                                             concatenate=True,
+                                             weights=weights,
+                                             dtype="float64",
+                                             meta=np.empty((0, 0, 0), dtype="float64"))
+
+    xr_em_per_gdp_ppp = xr.DataArray(np_em_per_gdp_ppp,
+                                     coords={"time": years, "y": y_coords, "x": x_coords},
+                                     dims=["time", "y", "x"])
 
     # to dataset
     xr_em_per_gdp_ppp = xr_em_per_gdp_ppp.to_dataset(name=varname_em_per_gdp_ppp)
@@ -537,8 +690,117 @@ def downscale_em_per_gdp(xr_scaling_factor_by:xr.DataArray, varname_em_per_gdp_p
 
     return xr_em_per_gdp_ppp
 
+def _em_per_gdp_scenarios_block(em_per_gdp_by:np.ndarray, region_ids:np.ndarray,
+                                divisors:np.ndarray, tables:np.ndarray, weights:np.ndarray) -> np.ndarray:
+    # one (y, x) chunk for a block of scenarios: divisors is (scenario, region), tables is (scenario, year, region)
+    values = np.empty((tables.shape[0], tables.shape[1]) + em_per_gdp_by.shape, dtype="float64")
+    for s in range(tables.shape[0]):
+        scaling_factor_by = _scaling_factor_by_block(em_per_gdp_by, region_ids, divisors[s])
+        values[s] = _em_per_gdp_block(scaling_factor_by, region_ids, tables[s], weights)
+    return values
+
+def downscale_em_per_gdp_scenarios(xr_em_per_gdp_ppp_by_downscaling:xr.DataArray, varname_em_per_gdp_ppp:str,
+                                   xr_IAM_regions_grid_downscaling:xr.Dataset,
+                                   dict_df_IAM_projection_em_per_GDP_PPP:dict,
+                                   years_downscaling, base_year, convergence_year,
+                                   log: logging.Logger=local_log) -> xr.Dataset:
+    '''
+    Scenario-batched version of calc_scaling_factors_EM_per_GDP and downscale_em_per_gdp.
+    The base-year grid intensity is scenario independent, only the IAM tables differ per scenario:
+    a (scenario, region) divisor table for the base-year scaling factors and a (scenario, year, region)
+    intensity table. One pass over the (y, x) chunks produces the lazy (scenario, time, y, x) intensity cube.
+    dict_df_IAM_projection_em_per_GDP_PPP: {scenario: DataFrame (columns: region_number, year, value, unit)}
+    '''
+    scenarios = list(dict_df_IAM_projection_em_per_GDP_PPP.keys())
+    years = list(years_downscaling)
+
+    vals = xr_IAM_regions_grid_downscaling["region_number"].transpose("y", "x").data
+    if isinstance(vals, dask_array.Array):
+        regions = dask_array.unique(vals[(vals > 0) & dask_array.isfinite(vals)]).compute()
+    else:
+        regions = np.unique(vals[(vals > 0) & np.isfinite(vals)])
+
+    divisors = np.stack([_regional_lookup_table(df, [base_year], regions)[0] for df in dict_df_IAM_projection_em_per_GDP_PPP.values()])
+    tables = np.stack([_regional_lookup_table(df, years, regions) for df in dict_df_IAM_projection_em_per_GDP_PPP.values()])
+    weights = np.clip((np.asarray(years, dtype="float64") - base_year) / (convergence_year - base_year), 0.0, 1.0)
+    missing = np.isnan(divisors[:, regions.astype("int64")])
+    if missing.any():
+        raise ValueError(f"No IAM emissions per GDP (PPP) in {base_year} for scenarios/regions {[(scenarios[s], regions[r]) for s, r in zip(*np.nonzero(missing))]}")
+    log.info(f"Downscaling emissions per GDP (PPP) for {len(scenarios)} scenarios, {len(years)} years and {len(regions)} regions in one pass")
+
+    em_per_gdp_by = xr_em_per_gdp_ppp_by_downscaling.transpose("y", "x").data
+    if not isinstance(em_per_gdp_by, dask_array.Array):
+        em_per_gdp_by = dask_array.from_array(em_per_gdp_by,
+                                              chunks=chunk_planner.spatial_chunks(xr_em_per_gdp_ppp_by_downscaling, n_arrays=3, log=log))
+    if isinstance(vals, dask_array.Array):
+        region_ids = vals.rechunk(em_per_gdp_by.chunks)
+    else:
+        region_ids = dask_cluster.shared_array(np.asarray(vals), chunks=em_per_gdp_by.chunks)
+
+    # one scenario per output chunk, the (y, x) chunks of the base-year grid are shared by all scenarios
+    divisors = dask_cluster.shared_array(divisors, chunks=(1, divisors.shape[1]))
+    tables = dask_cluster.shared_array(tables, chunks=(1, len(years), tables.shape[2]))
+    np_em_per_gdp_ppp = dask_array.blockwise(_em_per_gdp_scenarios_block, "styx",
+                                             em_per_gdp_by, "yx",
+                                             region_ids, "yx",
+                                             divisors, "sr",
+                                             tables, "str",
+                                             concatenate=True,
+                                             weights=weights,
+                                             dtype="float64",
+                                             meta=np.empty((0, 0, 0, 0), dtype="float64"))
+
+    xr_em_per_gdp_ppp = xr.DataArray(np_em_per_gdp_ppp,
+                                     coords={"scenario": scenarios, "time": years,
+                                             "y": xr_em_per_gdp_ppp_by_downscaling.y, "x": xr_em_per_gdp_ppp_by_downscaling.x},
+                                     dims=["scenario", "time", "y", "x"])
+    xr_em_per_gdp_ppp = xr_em_per_gdp_ppp.to_dataset(name=varname_em_per_gdp_ppp)
+    xr_em_per_gdp_ppp = xr_em_per_gdp_ppp.rio.write_crs(xr_em_per_gdp_ppp_by_downscaling.rio.crs)
+    xr_em_per_gdp_ppp = xr_em_per_gdp_ppp.rio.write_transform(xr_em_per_gdp_ppp_by_downscaling.rio.transform())
+    xr_em_per_gdp_ppp[varname_em_per_gdp_ppp].attrs["unit"] = next(iter(dict_df_IAM_projection_em_per_GDP_PPP.values()))['unit'].iloc[0]
+
+    return xr_em_per_gdp_ppp
+
 #************************** EM  *******************************************
 
+def _kaya_block(population:np.ndarray, gdp_per_pop:np.ndarray, em_per_gdp:np.ndarray) -> np.ndarray:
+    # EM = POP x GDP/POP x EM/GDP for one aligned chunk
+    return population * gdp_per_pop * em_per_gdp
+
+def calc_kaya_emissions(xr_population:xr.Dataset, varname_POP:str,
+                        xr_gdp_per_pop:xr.Dataset, varname_gdp_per_pop:str,
+                        xr_em_per_gdp:xr.Dataset, varname_em_per_gdp:str,
+                        varname_EM:str, unit_EM:str,
+                        log: logging.Logger=local_log) -> xr.Dataset:
+    '''
+    Lazy Kaya product EM = POP x GDP/POP x EM/GDP.
+    The three grids are aligned (inner join, as in xarray arithmetic) and chunked identically, each output
+    chunk is computed by one fused task from the matching input chunks. Nothing is evaluated here,
+    writing the result with to_netcdf streams it to disk chunk by chunk.
+    '''
+    da_population, da_gdp_per_pop, da_em_per_gdp = xr.align(xr_population[varname_POP],
+                                                             xr_gdp_per_pop[varname_gdp_per_pop],
+                                                             xr_em_per_gdp[varname_em_per_gdp],
+                                                             join="inner")
+    # (time, y, x) grids or (time, land_cell) packed cubes (see land_cells), the intensity can have
+    # a leading scenario dimension (broadcast against population and GDP per capita)
+    spatial_dims = [dim for dim in da_population.dims if dim != "time"]
+    inputs = [da.transpose(..., "time", *spatial_dims) for da in (da_population, da_gdp_per_pop, da_em_per_gdp)]
+    if "land_cell" not in spatial_dims:
+        # packed cubes keep the chunks of the land index; one plan for the three inputs so their chunks match
+        chunks_kaya = chunk_planner.chunks_for(inputs[2], n_arrays=4, log=log)
+        inputs = [da.chunk({dim: chunks_kaya[dim] for dim in da.dims}) for da in inputs]
+    log.info(f"Kaya product over {len(inputs[0].time)} years, chunks {dict(inputs[0].chunksizes)}")
+
+    da_em = xr.apply_ufunc(_kaya_block, *inputs,
+                           dask="parallelized",
+                           output_dtypes=[np.result_type(*[da.dtype for da in inputs])],
+                           keep_attrs=False)
+    xr_em = da_em.transpose(..., "time", *spatial_dims).to_dataset(name=varname_EM)
+    xr_em[varname_EM].attrs["unit"] = unit_EM
+
+    return xr_em
+
 def calc_urban_regional_emissions(xr_grid:xr.Dataset, varname:str,
                                   xr_urban_classification:xr.Dataset,
                                   years_downscaling:list,
@@ -573,31 +835,64 @@ def calc_regional_values(xr_grid:xr.Dataset, varname:str,
                             years_downscaling:list,
                             log: logging.Logger=local_log) -> Tuple[pd.DataFrame, xr.Dataset]:
 
-    # prepare region ids once, outside the loop
-    region_ids = xr_IAM_regions_grid_downscaling["region_number"].values.ravel().astype(int)
-    n_regions = int(region_ids.max()) + 1
-
-    # calculate regional sums one time step at a time using np.bincount
+    # calculate regional sums for all time steps in one pass over the chunks of the grid
     log.info("Determine regional sums for grid data in calc_regional_values...")
-    regional_sums = []
-    for year in years_downscaling:
-        log.info(f"  {year}")
-        values = xr_grid[varname].sel(time=year).values  # triggers compute for this slice only
-        sums = np.bincount(
-            region_ids,
-            weights=np.nan_to_num(values.ravel(), nan=0.0),
-            minlength=n_regions)
-        regional_sums.append(sums)
-
-    regional_sums_array = np.stack(regional_sums, axis=0)  # shape (time, n_regions)
-
-    xr_regional_sums = xr.Dataset({
-        varname: xr.DataArray(
-            regional_sums_array,
-            dims=["time", "region_number"],
-            coords={"time": years_downscaling,
-                    "region_number": np.arange(n_regions)})})
+    xr_regional_sums = calc_regional_sums_chunked(xr_grid[varname].sel(time=years_downscaling),
+                                                  xr_IAM_regions_grid_downscaling["region_number"],
+                                                  log=log).to_dataset(name=varname)
+    df_regional_sums_compare = compare_regional_values(xr_regional_sums, varname, df_IAM, years_downscaling, log)
+
+    return df_regional_sums_compare, xr_regional_sums
 
+def write_and_calc_regional_values(xr_grid:xr.Dataset, varname:str, file_path:Path,
+                                   xr_region_numbers:xr.DataArray,
+                                   df_IAM:pd.DataFrame,
+                                   years_downscaling:list,
+                                   log: logging.Logger=local_log) -> Tuple[pd.DataFrame, xr.Dataset]:
+    '''
+    Write a lazy grid (netcdf or zarr, see grid_store) and accumulate its regional sums in the same pass.
+    The write and the chunked regional reduction share the dask graph of the grid, so every chunk is
+    computed once, written and reduced; verifying against the IAM totals costs no extra pass over the data.
+    Returns the same as calc_regional_values.
+    '''
+    results = write_and_calc_regional_values_batch({None: xr_grid}, varname, {None: file_path},
+                                                   xr_region_numbers, {None: df_IAM}, years_downscaling, log)
+    return results[None]
+
+def write_and_calc_regional_values_batch(dict_xr_grid:dict, varname:str, dict_file_path:dict,
+                                         xr_region_numbers:xr.DataArray,
+                                         dict_df_IAM:dict,
+                                         years_downscaling:list,
+                                         log: logging.Logger=local_log) -> dict:
+    '''
+    write_and_calc_regional_values for several grids (e.g. one per scenario, keyed alike in all dicts) in one dask.compute,
+    so grids that share inputs are evaluated in a single pass over their chunks.
+    Returns {key: (df_compare, xr_regional_sums)}.
+    '''
+    keys = list(dict_xr_grid.keys())
+    delayed_writes = []
+    sums_lazy = []
+    for key in keys:
+        log.info(f"Writing {dict_file_path[key]} and determining regional sums in the same pass...")
+        delayed_writes.append(grid_store.save_dataset(dict_xr_grid[key], dict_file_path[key], compute=False, log=log))
+        sums_lazy.append(calc_regional_sums_chunked(dict_xr_grid[key][varname].sel(time=years_downscaling),
+                                                    xr_region_numbers, compute=False, log=log))
+    computed = dask.compute(*delayed_writes, *[da.data for da in sums_lazy])
+    results = {}
+    for key, xr_regional_sums_lazy, np_regional_sums in zip(keys, sums_lazy, computed[len(keys):]):
+        xr_regional_sums = xr_regional_sums_lazy.copy(data=np_regional_sums).to_dataset(name=varname)
+        df_regional_sums_compare = compare_regional_values(xr_regional_sums, varname, dict_df_IAM[key], years_downscaling, log)
+        results[key] = (df_regional_sums_compare, xr_regional_sums)
+
+    return results
+
+def compare_regional_values(xr_regional_sums:xr.Dataset, varname:str,
+                            df_IAM:pd.DataFrame,
+                            years_downscaling:list,
+                            log: logging.Logger=local_log) -> pd.DataFrame:
+    '''
+    Compare regional sums of the grid (time, region_number) with the IAM regional values.
+    '''
     log.info(varname)
     xr_regional_sums_check = xr_regional_sums.rename({varname: f"{varname}_grid"})
     log.info(f"Unique region numbers in regional summations: {np.unique(xr_regional_sums.region_number.values)}")
@@ -625,15 +920,14 @@ def calc_regional_values(xr_grid:xr.Dataset, varname:str,
     df_regional_sums_compare["indicator_grid_xr_million"] = df_regional_sums_compare[varname_grid_summed] * 10**-6
     df_regional_sums_compare["indicator_df_million"] = df_regional_sums_compare[varname_grid_IAM] * 10**-6
 
-    return df_regional_sums_compare, xr_regional_sums
+    return df_regional_sums_compare
 
 def calculate_harmonisation_factors_emissions(xr_em: xr.Dataset, varname_EM:str,
                                               xr_regional_sums:xr.Dataset,
                                               xr_IAM_regions_grid_downscaling:xr.Dataset,
                                               df_IAM_EM:pd.DataFrame,
                                               years_downscaling:list) -> xr.DataArray:
-    # Calculate correction factors and redistribute se_indicator (for emissions, only base year)
-    nr_regions = df_IAM_EM["region_number"].nunique()
+    # Calculate correction factors per (time, region_number) (for emissions, only base year)
 
     print("Calculate correction factors and redistribute se_indicator...")
     # Prepare harmonised (target) se_indicator values from IAM projections
@@ -657,44 +951,12 @@ def calculate_harmonisation_factors_emissions(xr_em: xr.Dataset, varname_EM:str,
                                         .where(regional_sums_not_harmonised != 0, other=1)
                                         .fillna(0))
 
-    # Map to spatial grid using numpy
-    region_ids = xr_IAM_regions_grid_downscaling.region_number.values
-    print(f"Unique region numbers in IAM regions grid: {np.unique(region_ids)}")
-
-    # Process x time steps at a time instead of all or one
-    print("Processing correction factors in blocks...")
-    block_size = 4
-    correction_factors_chunks = []
-
-    for i in range(0, len(xr_correction_factors_regional.time), block_size):
-        # Calculate actual block size (last block might be smaller)
-        actual_block_size = min(block_size, len(xr_correction_factors_regional.time) - i)
-        print(f"Processing block {i // block_size + 1} of {(len(xr_correction_factors_regional.time) + block_size - 1) // block_size}...")
-
-        time_slice = slice(i, i + actual_block_size)
-
-        # Use actual_block_size instead of block_size
-        lookup = np.zeros((actual_block_size, nr_regions + 1), dtype='float32')
-        lookup[:, xr_correction_factors_regional.region_number.values.astype(int)] = \
-            xr_correction_factors_regional.isel(time=time_slice).values
-
-        correction_factors_chunks.append(lookup[:, region_ids])
-
-    # Concatenate all chunks AFTER the loop
-    print("Concatenating correction factor chunks...")
-    correction_factors_array = np.concatenate(correction_factors_chunks, axis=0)
-
-    # Create the final DataArray with the full concatenated array
-    print("Creating final DataArray for correction factors...")
-    xr_em_correction_factors = xr.DataArray(
-        correction_factors_array,
-        coords={'time': xr_correction_factors_regional.time,
-                'y': xr_em.y,
-                'x': xr_em.x},
-        dims=['time', 'y', 'x']
-    )
+    # The factors only vary per (time, region), they are gathered onto the grid when applied
+    xr_correction_factors_regional = xr_correction_factors_regional.transpose("time", "region_number")
+    xr_correction_factors_regional.name = "correction_factor"
+    print(f"Unique region numbers in correction factors: {xr_correction_factors_regional.region_number.values}")
 
-    return xr_em_correction_factors
+    return xr_correction_factors_regional
 
 def apply_harmonisation_factors_emissions(xr_correction_factors:xr.DataArray,
                                           xr_em:xr.Dataset, varname:str,
@@ -702,42 +964,24 @@ def apply_harmonisation_factors_emissions(xr_correction_factors:xr.DataArray,
                                           model: str, scenario: str) -> xr.Dataset:
 
     # Apply correction factor
-    nr_regions = len(np.unique(xr_IAM_regions_grid_downscaling["region_number"].values)) - 1  # Exclude ocean (0)
-
-    # Merge grid se_indicator and correction factors into one Dataset
-    # 1) Make sure time coords match (important!)
-    if not np.array_equal(xr_em.time.values, xr_correction_factors.time.values):
-        print("Aligning time coordinates between se_indicator grid and correction factors...")
-        xr_correction_factors = xr_correction_factors.interp(time=xr_em.time)
-    # 2) (optional) mask ocean so zeros don’t skew colors
-    xr_correction_factors_masked = xr_correction_factors.where(xr_IAM_regions_grid_downscaling.region_number > 0)
-    # 3) Put the factors into the se_indicator Dataset
-    if isinstance(xr_em, xr.Dataset):
-        xr_grid_correction = xr_em.assign(correction_factor=xr_correction_factors_masked)
-    else:
-        # if xr_SE_grid is a DataArray named 'se_indicator'
-        xr_grid_correction = xr.Dataset(
-            data_vars=dict(
-                se_indicator=xr_SE_grid,
-                correction_factor=xr_correction_factors_masked
-            )
-        )
-    # add region number to Dataset
-    # 2-D region numbers (y, x), int and aligned to SE grid
-    region2d = xr_IAM_regions_grid_downscaling.region_number.astype("int8")
+    region2d = xr_IAM_regions_grid_downscaling["region_number"]
+    nr_regions = int(region2d.max()) # highest land region number (0=ocean)
 
-    # attach as a coordinate; stays time-invariant
-    xr_grid_correction = xr_grid_correction.assign_coords(region_number=(("y", "x"), region2d.values))
+    # Multiply with the (time, region) correction factors, gathered chunk by chunk via the region raster;
+    # ocean cells are masked (NaN)
+    xr_grid_correction = xr_em.copy()
+    xr_grid_correction[varname] = apply_regional_factors(xr_em[varname], xr_correction_factors, region2d)
+
+    # add region number to Dataset
+    # 2-D region numbers (y, x) (or 1-D over land_cell for packed cubes), int and aligned to the grid;
+    # attach as a coordinate, stays time-invariant
+    xr_grid_correction = xr_grid_correction.assign_coords(region_number=(region2d.dims, region2d.astype("int8").data))
 
     # optional: helpful attrs
     xr_grid_correction.coords["region_number"].attrs.update(
         long_name=f"{model} {scenario} region number (0=ocean, 1–{nr_regions}=land regions)"
     )
 
-    # Apply correction factor to se_indicator variable
-    #varname_corrected = f"{varname}_corrected"
-    xr_grid_correction[varname] = xr_grid_correction[varname] * xr_grid_correction["correction_factor"]
-
     return xr_grid_correction
 
 
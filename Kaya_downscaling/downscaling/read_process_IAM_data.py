@@ -1,5 +1,6 @@
-import json
 import logging
+import os
+import threading
 from pathlib import Path
 
 import numpy as np
@@ -11,13 +12,15 @@ import xarray as xr
 
 from typing import Tuple, Optional
 
-from tools.functions_logging import init_logging
-from tools.process_GDP import use_gdpuc
+from tools.functions_logging import deferred_logging
 from tools.general_functions import PRINT_COLORS, apply_root_json
 from downscaling.read_process_grid_data import print_info_rasterio
+import downscaling.intermediate_cache as intermediate_cache
+import downscaling.chunk_planner as chunk_planner
 import downscaling.settings_models as settings_models
+import downscaling.settings_downscaling as settings
 
-local_log, dummy_log = init_logging("log", "log/reading_data")
+local_log, dummy_log = deferred_logging("log", "log/reading_data")
 
 model_unit_conversions = {"IMAGE": {"Emissions|CO2": 1e6,  # Mt to t
                                     "GDP|MER": 1e9,        # billion to 1
@@ -42,7 +45,7 @@ def get_IAM_region_info(model="IMAGE"):
 
     return filename_region_grid, file_IAM_model_region_numbers
 
-def read_grid_info_IAM_regions(project_dir:Path, model:str, filename_region_grid:str, file_IAM_model_region_numbers:str, chunk:int, log: logging.Logger=local_log) -> Tuple[xr.Dataset, dict]:
+def read_grid_info_IAM_regions(project_dir:Path, model:str, filename_region_grid:str, file_IAM_model_region_numbers:str, chunk:int|None=None, log: logging.Logger=local_log) -> Tuple[xr.Dataset, dict]:
     '''
     Input: netcdf file with region definitions; depending on model it includes region numbers, if not, they should be created
     Output: xarray dataset with region codes (same as IAMC template) and region numbers (type int) as data variables
@@ -69,7 +72,8 @@ def read_grid_info_IAM_regions(project_dir:Path, model:str, filename_region_grid
                 xr_IAM_regions_processed = xr_IAM_regions_processed.rename({"GREG": "region_number"})
                 xr_IAM_regions_processed = xr_IAM_regions_processed.isel(time=0, drop=True)
                 xr_IAM_regions_processed = xr_IAM_regions_processed.rename({"longitude": "x", "latitude": "y"})
-                xr_IAM_regions_processed = xr_IAM_regions_processed.chunk({'y': chunk, 'x': chunk})
+                # chunk: tile size, None: chunks of the chunk planner
+                xr_IAM_regions_processed = xr_IAM_regions_processed.chunk({'y': chunk, 'x': chunk} if chunk is not None else chunk_planner.chunks_for(xr_IAM_regions_processed))
 
                 # Change Greenland (region 27) to region 11 (Canada)
                 xr_IAM_regions_processed['region_number'] = xr_IAM_regions_processed['region_number'].where(xr_IAM_regions_processed['region_number']!=27, 11)
@@ -92,15 +96,62 @@ def read_grid_info_IAM_regions(project_dir:Path, model:str, filename_region_grid
 
     return xr_IAM_regions_processed, region_mapping
 
-def read_IAM_regions_data(project_dir: Path, model:str, scenario:str, regions_mapping:dict, region_World:str="World") -> pd.DataFrame:
-    # Scenario name should be the name of the IAMC template Excel file
+# Cache of the IAM workbooks
+# Parsing an IAMC workbook with pd.read_excel (openpyxl) takes longer than all regional computations, so the data sheet
+# of every workbook is converted once to a long, typed Parquet table (Model, Scenario, Region, Variable, Unit as
+# strings, Year as integer, Value as float) in iam_cache_settings["dir"]. The table is registered in the manifest of
+# the intermediate cache (see intermediate_cache.py) with a key of the size, modification time and sha256 of the
+# workbook, so a changed workbook is converted again. Variables and regions are selected while reading the table.
 
-    # Read IAM data
-    excel_path = project_dir / f"data/input/models/{model}/SSP/{scenario}.xlsx"
+def _read_IAM_excel(excel_path:Path) -> pd.DataFrame:
     df_IAM = pd.read_excel(excel_path, sheet_name="data")
-    df_IAM = df_IAM[df_IAM["Region"]!="World"]
     df_IAM = df_IAM.melt(id_vars=["Model", "Scenario", "Region", "Variable", "Unit"], var_name="Year", value_name="Value")
+    df_IAM["Year"] = df_IAM["Year"].astype("int32")
+    df_IAM["Value"] = df_IAM["Value"].astype(float)
+    return df_IAM
+
+def read_IAM_workbook(excel_path:Path, dir_cache:Path, variables:list|None=None, regions:list|None=None,
+                      log: logging.Logger=local_log) -> pd.DataFrame:
+    '''
+    Long table (Model, Scenario, Region, Variable, Unit, Year, Value) of the data sheet of an IAMC workbook, only
+    the variables and regions if given. Read from its Parquet table in dir_cache, which is made when it is missing
+    or the workbook changed (see iam_cache_settings).
+    '''
+    excel_path = Path(excel_path)
+    filters = []
+    if variables is not None:
+        filters.append(("Variable", "in", list(variables)))
+    if regions is not None:
+        filters.append(("Region", "in", list(regions)))
+    if not settings.iam_cache_settings["enabled"]:
+        df_IAM = _read_IAM_excel(excel_path)
+        for column, _, values in filters:
+            df_IAM = df_IAM[df_IAM[column].isin(values)]
+        df_IAM = df_IAM.reset_index(drop=True)
+    else:
+        file_cache = Path(dir_cache) / f"{excel_path.stem}.parquet"
+        key = intermediate_cache.cache_key("IAM_workbook", inputs=[excel_path],
+                                           params={"sha256": intermediate_cache.file_digest(excel_path)}, code=[_read_IAM_excel])
+        if not intermediate_cache.is_valid(file_cache, key, log):
+            log.info(f"Converting IAM workbook {excel_path} to {file_cache}")
+            file_cache.parent.mkdir(parents=True, exist_ok=True)
+            # one temporary file per process and thread, runs in parallel (see batch_runs.py) can convert the same workbook
+            file_tmp = file_cache.with_suffix(f".{os.getpid()}_{threading.get_ident()}.tmp")
+            _read_IAM_excel(excel_path).to_parquet(file_tmp, index=False)
+            os.replace(file_tmp, file_cache)
+            intermediate_cache.register(file_cache, key, "IAM_workbook", log)
+        df_IAM = pd.read_parquet(file_cache, filters=filters or None)
     df_IAM["Year"] = df_IAM["Year"].astype(int)
+    return df_IAM
+
+def read_IAM_regions_data(project_dir: Path, model:str, scenario:str, regions_mapping:dict, region_World:str="World",
+                          variables:list|None=None, log: logging.Logger=local_log) -> pd.DataFrame:
+    # Scenario name should be the name of the IAMC template Excel file
+
+    # Read IAM data (only the variables if given)
+    excel_path = project_dir / f"data/input/models/{model}/SSP/{scenario}.xlsx"
+    df_IAM = read_IAM_workbook(excel_path, project_dir / settings.iam_cache_settings["dir"] / model, variables, log=log)
+    df_IAM = df_IAM[df_IAM["Region"]!="World"]
 
     # Process GDP
     df_IAM = process_GDP(model, df_IAM, "GDP|PPP")
@@ -131,7 +182,7 @@ def read_process_IAM_data(project_dir:Path, scenario:str, model:str, file_IAM_mo
     regions, regions_mapping = get_regions(project_dir, model, file_IAM_model_region_numbers)
 
     # Read IAM data
-    df_IAM = read_IAM_regions_data(project_dir, model, scenario, regions_mapping, region_World="World")
+    df_IAM = read_IAM_regions_data(project_dir, model, scenario, regions_mapping, region_World="World", variables=vars_downscaling)
     df_IAM = df_IAM[df_IAM["Variable"].isin(vars_downscaling)].reset_index(drop=True)
     df_IAM.columns = [col.lower() for col in df_IAM.columns]
 
@@ -146,78 +197,65 @@ def extrapolate_IAM_values_to_convergence_year(dir_procesed: Path, df:pd.DataFra
     # Method 2: zero growth rate
     # Method 3: growth rate to reach almost zero in convergence year
     # Method 4: absolute growth rate from last two time steps
+    # All models, scenarios, variables and regions in df are extrapolated at once: the values are pivoted to one row per
+    # (model, scenario, variable, unit, region) and one column per year, and the growth rates and the new years are
+    # computed on the whole table.
 
     log.info(f"Extrapolating IAM values to convergence year {convergence_year} using method {method}...")
+    if method not in [1, 2, 3, 4]:
+        raise ValueError("Invalid method. Choose 1, 2, 3 or 4.")
 
     df.columns = [col.lower() for col in df.columns]
-    varname = df["variable"].unique()[0]
+    years = np.sort(df["year"].unique())
+    max_year = years[-1]
+    second_max_year = years[-2]
 
-    max_year = df["year"].max()
-    second_max_year = df["year"].unique()[-2]
+    # one row per (model, scenario, variable, unit, region), one column per year
+    keys = ["model", "scenario", "variable", "unit", "region_number"]
+    df_wide = df.groupby(keys + ["year"], sort=False)["value"].first().unstack("year")
+    region_codes = df.groupby("region_number", sort=False)["region_code"].first()
 
-    model = df["model"].unique()[0]
-    scenario = df["scenario"].unique()[0]
-    variable = df["variable"].unique()[0]
-    unit = df["unit"].unique()[0]
-
-    # Get growth rates for each region
+    # Get growth rates for each row (numpy, so divide by zero and invalid values warn as for single values)
     timestep = 10  # your timestep
-    rel_growth_rates = {}
-    abs_growth_rate = {}
-    for region in df["region_number"].unique():
-        last_value = df[(df["region_number"] == region) & (df["year"] == max_year)]["value"].iloc[0]
-        second_last_value = df[(df["region_number"] == region) & (df["year"] == second_max_year)]["value"].iloc[0]
-
-        # Calculate percentage change
-        match method:
-            case 1:
-                # Method 1
-                rel_growth_rates[region] = (last_value / second_last_value)**(1/timestep) - 1
-            case 2:
-                # Method 2:
-                rel_growth_rates[region] = 0
-            case 3:
-                # Method 3:
-                period = convergence_year - max_year
-                if (last_value < 0):
-                    rel_growth_rates[region] = 0
-                else:
-                    rel_growth_rates[region] = (0.1/last_value)**(1/timestep)-1 # not solvebale for zero values
-            case 4:
-                # Method 4:
-                abs_growth_rate[region] = (last_value-second_last_value) / timestep
-            case _:
-                raise ValueError("Invalid method. Choose 1, 2, or 3.")
-                df_extended = pd.DataFrame()
-                exit()
+    last_value = df_wide[max_year].to_numpy()
+    second_last_value = df_wide[second_max_year].to_numpy()
+    rel_growth_rates = np.zeros(len(df_wide))
+    match method:
+        case 1:
+            # Method 1
+            rel_growth_rates = (last_value / second_last_value)**(1/timestep) - 1
+        case 3:
+            # Method 3: (not solvable for zero values, zero growth for negative values)
+            positive = last_value >= 0
+            rel_growth_rates[positive] = (0.1/last_value[positive])**(1/timestep) - 1
+        case 4:
+            # Method 4:
+            abs_growth_rate = (last_value - second_last_value) / timestep
 
     # check
-    varname_save = varname.replace("&", "and").replace("|", "_").replace(".", " ")
-    #Path(project_dir, "data/check").mkdir(parents=True, exist_ok=True)
-    csv_path = dir_procesed / f"growth_rates_iam_image_{varname_save}.csv"
-    pd.DataFrame(list(rel_growth_rates.items()), columns=["region", "growth_rate"]).to_csv(csv_path, index=False, sep=";")
-
-    # Generate new rows
-    new_rows = []
-
-    for year in range(max_year + timestep, convergence_year + 1, timestep):
-        for region_number in df["region_number"].unique():
-            region_number = df[df["region_number"]==region_number]["region_number"].unique()[0]
-            region_code = df[df["region_number"]==region_number]["region_code"].unique()[0]
-
-            last_value = df[df["region_number"] == region_number]["value"].iloc[-1]
-
-            # Apply compound growth
-            if method in [1, 2, 3]:
-                new_value = last_value * ((1 + rel_growth_rates[region_number]) ** (year-max_year))
-            else: # method 4
-                new_value = last_value + abs_growth_rate[region_number] * (year - max_year)
-
-            new_rows.append({"model": model, "scenario":scenario, "region_code": region_code, "region_number": region_number, "year": year, "variable": variable, "value": new_value, "unit": unit})
+    df_growth_rates = df_wide.index.to_frame(index=False)[["model", "scenario", "variable", "region_number"]].rename(columns={"region_number": "region"})
+    df_growth_rates["growth_rate"] = rel_growth_rates
+    for varname, df_growth_rates_var in df_growth_rates.groupby("variable", sort=False):
+        varname_save = varname.replace("&", "and").replace("|", "_").replace(".", " ")
+        csv_path = dir_procesed / f"growth_rates_iam_image_{varname_save}.csv"
+        (df_growth_rates_var.drop(columns="variable") if method != 4 else df_growth_rates_var.iloc[:0]).to_csv(csv_path, index=False, sep=";")
+
+    # Generate new years, compound growth (methods 1-3) or absolute growth (method 4) from the last year
+    years_new = np.arange(max_year + timestep, convergence_year + 1, timestep)
+    periods = (years_new - max_year)[np.newaxis, :]
+    if method in [1, 2, 3]:
+        values_new = last_value[:, np.newaxis] * (1 + rel_growth_rates[:, np.newaxis])**periods
+    else: # method 4
+        values_new = last_value[:, np.newaxis] + abs_growth_rate[:, np.newaxis] * periods
+    df_new = (pd.DataFrame(values_new, index=df_wide.index, columns=pd.Index(years_new, name="year"))
+              .reset_index()
+              .melt(id_vars=keys, var_name="year", value_name="value"))
+    df_new["year"] = df_new["year"].astype(df["year"].dtype)
+    df_new["region_code"] = df_new["region_number"].map(region_codes)
 
     # Combine original and new data
-    df_extended = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
-    df_extended = df_extended.sort_values(by=["region_number", "year"]).reset_index(drop=True)
+    df_extended = pd.concat([df, df_new[["model", "scenario", "region_code", "region_number", "year", "variable", "value", "unit"]]], ignore_index=True)
+    df_extended = df_extended.sort_values(by=["model", "scenario", "variable", "region_number", "year"]).reset_index(drop=True)
 
     df_extended["value"] *= conversion_factor
 
@@ -234,27 +272,15 @@ def process_GDP(model:str, df:pd.DataFrame, var:str) -> pd.DataFrame:
     factor_year_from = model_cfg["factor_year_from"]
     factor_year_to = model_cfg["factor_year_to"]
 
-    # R_SCRIPT_PATH = r"C:\Program Files\R\R-4.1.1\bin\Rscript.exe"
-    with open("downscaling/settings_data_locations.json", "r") as f:
-        data = json.load(f)
-        R_SCRIPT_PATH = data["general"]["R_SCRIPT_PATH"]
-
 
     # Update GDP|PPP to $2005 dollars
+    # the model regions have no GDPuc factors of their own, they are converted with the model constant factor_GDP_PPP
+    # (country data can be converted with tools/process_GDP.convert_GDP and the exported GDPuc factors)
     df_IAM = df.copy()
     mask_update_gdp_ppp = (df["Variable"] == "GDP|PPP") #& (df["Unit"] == "billion USD_2010/yr")
     df_IAM.loc[mask_update_gdp_ppp, "Value"] /= factor_GDP_PPP
     df_IAM.loc[mask_update_gdp_ppp, "Unit"] = df_IAM.loc[mask_update_gdp_ppp, "Unit"].str.replace(f"{factor_year_from}", f"{factor_year_to}")
 
-    # TO DO --> add region/country mapping and calculate conversion with GDPuc
-    # df_test = pd.DataFrame({
-    #     'country': ['USA', 'CAN', 'MEX', 'FRA', 'DEU'],
-    #     'year': [2000, 2000, 2000, 2000, 2000],
-    #     'value': [10000, 8000, 5000, 7000, 6000]
-    # })
-    # result = use_gdpuc(df_test,  R_SCRIPT_PATH, "constant 2010 Int$PPP", "constant 2005 Int$PPP")
-    # print(f"GDPuc conversion result:\n{result}")
-
     return df_IAM
 
 # **************************EM*******************************************
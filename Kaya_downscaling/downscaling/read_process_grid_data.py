@@ -12,13 +12,8 @@ from typing import Tuple, Optional
 import numpy as np
 import pandas as pd
 
-from dask.diagnostics.progress import ProgressBar
 import gc
 
-from matplotlib import pyplot as plt
-from matplotlib import use as plt_use
-import seaborn as sns
-
 from osgeo import gdal
 import rasterio
 import rasterio.plot
@@ -37,19 +32,17 @@ import rioxarray as rxr
 from pathlib import Path
 
 import tqdm
-from tools.functions_logging import init_logging
+from tools.functions_logging import deferred_logging
 from tools.general_functions import PRINT_COLORS, apply_root_json
 from .settings_downscaling_cities import NL_bbox, lon_MidAtlantic, lat_MidAtlantic, lon_Amsterdam, lat_Amsterdam
 from downscaling.settings_resolution import DATASETS
+import downscaling.grid_store as grid_store
+import downscaling.chunk_planner as chunk_planner
 
 gdal.UseExceptions()
 
-progress_bar = ProgressBar()
-progress_bar.register()
-
-chunks = 512  # chunk size for dask operations
 
-local_log, dummy_log = init_logging("log", "log/reading_data/local")
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
 
 def process_urban_classification_data(project_dir: Path, log: logging.Logger=local_log) -> None:
     # Combine geopandas dataframe with csv dataframe on GDAM_ID
@@ -72,7 +65,7 @@ def process_urban_classification_data(project_dir: Path, log: logging.Logger=loc
     merged_gdf = gdf.merge(df_ts, left_on="GDAM_ID", right_on="GDAM_id", how="left")
     merged_gdf.to_parquet(merged_output_path)
 
-def compare_two_raster_files(project_dir:Path, src1:DatasetReader, src2: DatasetReader, rtol=1e-5, atol=1e-8, save_not_close_map=False, chunk_size = 1024, log: logging.Logger=local_log) -> dict:
+def compare_two_raster_files(project_dir:Path, src1:DatasetReader, src2: DatasetReader, rtol=1e-5, atol=1e-8, save_not_close_map=False, chunk_size:int|None=None, log: logging.Logger=local_log) -> dict:
 
     metadata_match = {
         "crs_match": src1.crs == src2.crs,
@@ -119,8 +112,10 @@ def compare_two_raster_files(project_dir:Path, src1:DatasetReader, src2: Dataset
     raster2.rio.write_crs(src2.crs, inplace=True)
 
     # Chunk the arrays for memory-efficient processing
-    raster1 = raster1.chunk({"x": chunk_size, "y": chunk_size})
-    raster2 = raster2.chunk({"x": chunk_size, "y": chunk_size})
+    # chunk_size: tile size, None: chunks of the chunk planner (both rasters and their comparison per chunk)
+    chunks = {"x": chunk_size, "y": chunk_size} if chunk_size is not None else chunk_planner.chunks_for(raster1, n_arrays=3, log=log)
+    raster1 = raster1.chunk(chunks)
+    raster2 = raster2.chunk(chunks)
 
     # Check if arrays are close (memory-efficient for chunked data)
     # are_close = (xr.apply_ufunc(np.isclose, raster1, raster2, kwargs={"rtol": rtol, "atol": atol, "equal_nan": True}, dask="allowed")
@@ -221,9 +216,9 @@ def read_in_tiff_to_rio(data_dir: Path, glob_pattern: str, search_pattern: str,
             #if year >= base_year:
             years.append(year)
 
-            da = rxr.open_rasterio(f, chunks={"x": "auto", "y": "auto"})
+            da = rxr.open_rasterio(f)
             da = da.squeeze(drop=True)
-            da = da.chunk("auto")
+            da = da.chunk(chunk_planner.chunks_for(da, n_arrays=2))
             da = ensure_rio_dimension_order(da)
 
             # Store metadata from first file
@@ -484,7 +479,7 @@ def check_nan(da: xr.DataArray, log: logging.Logger=local_log):
 def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool, save: bool, save_type: str, chunks_size_save: int,
                             varname:str, filepath: Path, aggregation_methods: dict[str, str], log: logging.Logger=local_log) -> xr.Dataset:
         # set_chunks_method is "optimal" or "auto"
-        # save_type is "netcdf" or "zar", "both" or "none"
+        # save_type is "netcdf" or "zarr", "both" or "none"; the zarr store is written next to filepath (.zarr)
 
         current_dir = Path().cwd()
         log.info(f"Current directory: {current_dir}")
@@ -494,11 +489,11 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
         if factor == 1:
                 log.info("Factor is 1, directly saving to netcdf, without coarsening")
                 ds_coarsened = ds_rxr
-                ds_coarsened = ds_coarsened.chunk({"time": -1, "y": "auto", "x":  "auto"})
+                ds_coarsened = ds_coarsened.chunk(chunk_planner.chunks_for(ds_coarsened, n_arrays=2, full_dims=["time"]))
                 if zero_to_nan:
                     ds_coarsened[varname] = ds_coarsened[varname].where(ds_coarsened[varname] != 0, np.nan)
                 if save:
-                    ds_coarsened.to_netcdf(filepath)
+                    grid_store.save_dataset(ds_coarsened, grid_store.store_path(filepath, "zarr") if save_type == "zarr" else filepath, log=log)
         else:
             # 0. init
             #da_rxr = ds_rxr[varname]
@@ -529,7 +524,7 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                         log.info(f"Unknown aggregation_method: {aggregation_method}")
                         exit()
                     ds_coarsened = da_coarse.to_dataset(name=varname)
-                    ds_coarsened = ds_coarsened.chunk({"time": -1, "y": "auto", "x": "auto"})
+                    ds_coarsened = ds_coarsened.chunk(chunk_planner.chunks_for(ds_coarsened, n_arrays=2, full_dims=["time"]))
 
                     # 3. Update transform
                     log.info(f"3. Update transform")
@@ -589,7 +584,7 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
 
                     # Ensure chunking for memory efficiency
                     if not hasattr(da.data, 'chunks'):
-                        da = da.chunk({"time": -1, "y": 500, "x": 500})
+                        da = da.chunk(chunk_planner.chunks_for(da, n_arrays=3, full_dims=["time"]))
 
                     # Reproject handles the transform automatically
                     da_coarsened = da.rio.reproject(dst_crs=crs, resolution=(new_res_x, new_res_y), resampling=resampling_method)
@@ -609,7 +604,7 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                     if rel_diff > 0.01:
                         log.warning(f"Coarsening changed the global sum by {rel_diff:.2%}")
                     ds_coarsened = da_coarsened.to_dataset(name=varname)
-                    ds_coarsened = ds_coarsened.chunk({"time": -1, "y": "auto", "x": "auto"})
+                    ds_coarsened = ds_coarsened.chunk(chunk_planner.chunks_for(ds_coarsened, n_arrays=2, full_dims=["time"]))
 
                     # Transform is already set by reproject - just log it
                     log.info(f"3. Transform (automatically set by reproject)")
@@ -644,7 +639,7 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                 crs = ds_rxr.rio.crs
                 da_upsampled = da.rio.reproject(dst_crs=crs,resolution=(new_res_x, new_res_y),resampling=resampling_method)
                 ds_coarsened = da_upsampled.to_dataset(name=varname)
-                ds_coarsened = ds_coarsened.chunk({"time": -1, "y": "auto", "x": "auto"})
+                ds_coarsened = ds_coarsened.chunk(chunk_planner.chunks_for(ds_coarsened, n_arrays=2, full_dims=["time"]))
 
                 # 3. Transform is already set by reproject - just log it
                 log.info(f"3. Transform (automatically set by reproject)")
@@ -710,13 +705,12 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                 if save_zarr:
                     chunks_zarr = chunks_size_save
                     ds_coarsened_zarr = ds_coarsened.chunk({"time": -1, "y": chunks_zarr, "x": chunks_zarr})
-                    log.info(f"\tSaving to zarr: {filepath}.zarr")
-                    zarr_file = filepath / ".zarr"
-                    ds_coarsened_zarr.to_zarr(
-                        zarr_file,
-                        mode="w",
-                        compute=True,                 # triggers compute
-                        encoding={f"{varname}": {"dtype": "float32"}} ) # smaller + faster
+                    zarr_file = grid_store.store_path(filepath, "zarr")
+                    log.info(f"\tSaving to zarr: {zarr_file}")
+                    # chunks are written in parallel, consolidated metadata for fast reopening
+                    grid_store.save_dataset(ds_coarsened_zarr, zarr_file,
+                                            encoding={f"{varname}": {"dtype": "float32"}},  # smaller + faster
+                                            log=log)
 
                 # 6.2. netcdf
                 log.info(f"5.2 Save to netcdf")
@@ -744,18 +738,6 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                         log.info(f"\t  - {key}: {value}")
                     #--------------------------------
 
-                    # determine chunc size
-                    # Get actual dimensions
-                    actual_shape = ds_coarsened_netcdf[varname].shape
-                    n_time = actual_shape[0] if len(actual_shape) > 2 else 1
-                    n_y = actual_shape[-2]
-                    n_x = actual_shape[-1]
-                    # Calculate safe chunk sizes (don't exceed dimension size)
-                    chunks_netcdf = chunks_size_save
-                    chunk_time = -1
-                    chunk_y = min(chunks_netcdf, n_y)
-                    chunk_x = min(chunks_netcdf, n_x)
-
                     # Define encoding for NetCDF variable
                     #  xarray writes missing data via _FillValue when saving. In fact, by default xarray sets _FillValue = NaN for floats,
                     # but you should override this explicitly for a consistent numeric nodata.
@@ -766,15 +748,12 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                             del ds_coarsened_netcdf[varname].attrs["_FillValue"]
                         # Add to encoding as _FillValue
                         #encoding[varname]["_FillValue"] = nodata_value
+                    # codec and chunksizes follow the encoding policy of grid_store (storage_settings)
                     encoding={
                         #"spatial_ref": {"dtype": "int32"},
                         f"{varname}": {
-                            #"chunksizes": (1, chunks_netcdf, chunks_netcdf),  # NetCDF internal chunks to match
                             "dtype": "float32",
-                            "zlib": True,
-                            "complevel": 3,
                             "_FillValue": nodata_value,
-                            "chunksizes": (n_time, chunk_y, chunk_x)
                             }
                         }
                     # Add spatial_ref to encoding
@@ -804,7 +783,7 @@ def coarsen_save_rio_xarray(ds_rxr: xr.Dataset, factor: float, zero_to_nan:bool,
                                         k: v for k, v in ds_coarsened_netcdf[coord].encoding.items()
                                         if k in essential_keys}
                     # Save to netcdf
-                    ds_coarsened_netcdf.to_netcdf(filepath, mode="w", encoding=encoding)
+                    grid_store.save_dataset(ds_coarsened_netcdf, filepath, encoding=encoding, log=log)
                     log.info(f"\tFile saved to: {filepath}")
 
                     #--------------------------------
@@ -1895,7 +1874,7 @@ def pre_process_data_emissions(varname:str="Emissions|CO2|Excl. shipping, aviati
                     glob_pattern_CO2 = f"EDGAR_{version}_GHG_CO2_????_TOTALS_emi.nc"
                     search_pattern_CO2 = f"EDGAR_{version}_GHG_CO2_(\\d{{4}})_TOTALS_emi\\.nc"
                     xr_emissions_CO2 = _read_in_nc(data_dir_original_source, glob_pattern_CO2, search_pattern_CO2, varname_EDGAR, varname_CO2, log)
-                    xr_emissions_CO2.to_netcdf(data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_TOTALS_emi.nc")
+                    grid_store.save_dataset(xr_emissions_CO2, data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_TOTALS_emi.nc", log=log)
 
                     # 1b. Total CO2 Shipping
                     # EDGAR_{version}_GHG_CO2_1970_TNR_Ship_emi.nc
@@ -1905,7 +1884,7 @@ def pre_process_data_emissions(varname:str="Emissions|CO2|Excl. shipping, aviati
                     # read in nc files
                     #warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
                     xr_emissions_CO2_shipping = _read_in_nc(data_dir_original_source, glob_pattern_CO2_shipping, search_pattern_CO2_shipping, varname_EDGAR, varname_CO2_shipping, log)
-                    xr_emissions_CO2_shipping.to_netcdf(data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_TNR_Ship_emi.nc")
+                    grid_store.save_dataset(xr_emissions_CO2_shipping, data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_TNR_Ship_emi.nc", log=log)
 
                     # 1c.Total Aviation
                     # Aviation climbing&descent
@@ -1938,16 +1917,16 @@ def pre_process_data_emissions(varname:str="Emissions|CO2|Excl. shipping, aviati
                                                                 xr_emissions_CO2_aviation_LTO[varname_CO2_aviation_LTO] #+
                                                                 # data_emissions_CO2_aviation_SPS_rxr["emissions_CO2_aviation_SPS"] # exclude, as it only has data until 2003
                                                                 })
-                    xr_emissions_CO2_aviation.to_netcdf(data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_TNR_Aviation_emi.nc")
+                    grid_store.save_dataset(xr_emissions_CO2_aviation, data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_TNR_Aviation_emi.nc", log=log)
                     xr_emissions_CO2_excl_bunkers = xr.Dataset({varname: xr_emissions_CO2[varname_CO2] - xr_emissions_CO2_shipping[varname_CO2_shipping] - xr_emissions_CO2_aviation[varname_CO2_aviation]})
-                    xr_emissions_CO2_excl_bunkers.to_netcdf(data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_excl_bunkers_emi.nc")
+                    grid_store.save_dataset(xr_emissions_CO2_excl_bunkers, data_dir_processed_source / f"EDGAR_{version}_GHG_CO2_1970_2020_excl_bunkers_emi.nc", log=log)
 
                     # save processed data
                     filename_EM_EDGAR_processed = f"Emissions_CO2_Excl_shipping_aviation_AFOLU.nc"
                     ds_file_path = data_dir_processed_source / filename_EM_EDGAR_processed
                     arc_seconds, arc_minutes, arc_degrees = calculate_resolution(xr_emissions_CO2_excl_bunkers[varname])
                     log.info(f"Resolution of annual data: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.2f} arc degrees")
-                    xr_emissions_CO2_excl_bunkers.to_netcdf(ds_file_path)
+                    grid_store.save_dataset(xr_emissions_CO2_excl_bunkers, ds_file_path, log=log)
 
         case "CEDS_CMIP7":
             match version:
@@ -1964,6 +1943,11 @@ def pre_process_data_emissions(varname:str="Emissions|CO2|Excl. shipping, aviati
                     glob_pattern = "CO2-em-anthro_input4MIPs_emissions_*.nc"
                     files = sorted(Path(data_dir_original_source).glob(glob_pattern))
 
+                    # zarr: the years are appended to one store, netcdf: one file per year
+                    file_store = grid_store.store_path(data_dir_processed_source / "CO2-em-anthro_annual_excl_bunkers.nc", "zarr")
+                    if grid_store.storage_format() == "zarr":
+                        grid_store.remove(file_store)
+
                     #varname = "Emissions|CO2|Excl. shipping, aviation, AFOLU"
                     for i, file in enumerate(files):
                         print(f"Processing {file.name}...")
@@ -1994,7 +1978,10 @@ def pre_process_data_emissions(varname:str="Emissions|CO2|Excl. shipping, aviati
                             da_file_path = data_dir_processed_source / f"CO2-em-anthro_annual_excl_bunkers_{year:}.nc"
                             arc_seconds, arc_minutes, arc_degrees = calculate_resolution(da_annual_excl_bunkers)
                             print(f"Resolution of annual data: {arc_seconds:.1f} arc seconds, {arc_minutes:.1f} arc minutes, {arc_degrees:.2f} arc degrees")
-                            da_annual_excl_bunkers.to_netcdf(da_file_path)
+                            if grid_store.storage_format() == "zarr":
+                                grid_store.append_dataset(da_annual_excl_bunkers.to_dataset(), file_store, log=log)
+                            else:
+                                grid_store.save_dataset(da_annual_excl_bunkers.to_dataset(), da_file_path, log=log)
 
                             df_total = pd.DataFrame(summary_data)
                             if not df_total.empty:
@@ -2020,6 +2007,15 @@ def pre_process_data_emissions(varname:str="Emissions|CO2|Excl. shipping, aviati
                     shutil.copy(f, run_tiff_path)
                     log.info(f"Copied {f} to {run_tiff_path}")
 
+def source_files_socioeconomic(varname="Population", source:str="2UP", version="GHSL_2024_M3", SSP_base="SSP2", log: logging.Logger=local_log) -> list:
+    '''
+    The grid files read by read_process_grid_data_socioeconomic (sorted), e.g. for the key of the cached read step.
+    '''
+    data_dir, _, _, glob_pattern, _, _, _ = get_parameters_SE(process_data=False, varname=varname, source=source, version=version, SSP_base=SSP_base, log=log)
+    if not glob_pattern:
+        return []
+    return sorted(data_dir.glob(glob_pattern))
+
 def read_process_grid_data_socioeconomic(dir_processed:Path, varname="Population", source:str="2UP", version="GHSL_2024_M3", SSP_base="SSP2",
                                          coarse_factor:float=1, unit:str="", save: bool=False, check: bool=False, log: logging.Logger=local_log) -> Tuple[xr.Dataset, Path]:
     '''
@@ -2100,12 +2096,13 @@ def read_process_grid_data_socioeconomic(dir_processed:Path, varname="Population
                                                 factor=coarse_factor,
                                                 zero_to_nan=True,
                                                 save=save,
-                                                save_type="netcdf",
-                                                chunks_size_save=chunks,
+                                                save_type=grid_store.storage_format(),
+                                                chunks_size_save=grid_store.storage_chunks()["y"],
                                                 varname=varname,
                                                 filepath=rxr_filepath,
                                                 aggregation_methods={varname: "sum"},
                                                 log=log)
+    rxr_filepath = grid_store.store_path(rxr_filepath)
     log.info(f"\n\n************after coarsening***************************************************************************")
     log.info(f"After coarsening:")
     #log.info(f"_FillValue: {PRINT_COLORS["yellow"]}{rxr_SE_coarsened[varname].encoding.get('_FillValue')}{PRINT_COLORS["end"]}")
@@ -2157,6 +2154,27 @@ def _clean_dataset_for_netcdf(ds: xr.Dataset) -> tuple[xr.Dataset, dict]:
 
     return ds, encoding
 
+def source_files_EM(source:str="EDGAR", version="2024") -> list:
+    '''
+    The grid files read by read_process_grid_data_EM (sorted), e.g. for the key of the cached read step.
+    '''
+    with open("downscaling/settings_data_locations.json", "r") as f:
+        data_files = json.load(f)
+    data_files = apply_root_json(data_files, data_files["data_root"])
+    data_run = data_files["grid"]["run"]
+
+    match (source, version):
+        case ("EDGAR", "2024"):
+            return [Path(data_run["dir_emissions_EDGAR_2024_run"]) / "Emissions_CO2_Excl_shipping_aviation_AFOLU.nc"]
+        case ("CEDS_CMIP7", "2025_04_18"):
+            data_dir_EM = Path(data_run["dir_emissions_CEDS_CMIP7_v2025_run"])
+            file_store = data_dir_EM / "CO2-em-anthro_annual_excl_bunkers.zarr"
+            if grid_store.exists(file_store):
+                return [file_store]
+            return sorted(data_dir_EM.glob("CO2-em-anthro_annual_excl_bunkers_????.nc"))
+        case _:
+            return []
+
 def read_process_grid_data_EM(dir_processed:Path, varname="Emissions_CO2_Excl_shipping_aviation_AFOLU", unit="tonnes CO2/year", source:str="EDGAR", version="2024",
                               base_year=2020, coarse_factor:float=1, save:bool=False, check:bool=False, log: logging.Logger=local_log) -> Tuple[xr.Dataset, Path]:
     # Read CO2 emissions data
@@ -2189,7 +2207,8 @@ def read_process_grid_data_EM(dir_processed:Path, varname="Emissions_CO2_Excl_sh
             match version:
                 case "2024":
                     data_dir_EM = Path(data_run["dir_emissions_EDGAR_2024_run"])
-                    ds_emissions_CO2_excl_bunkers = xr.open_dataset(data_dir_EM / f"Emissions_CO2_Excl_shipping_aviation_AFOLU.nc", chunks={"x": "auto", "y": "auto"})
+                    ds_emissions_CO2_excl_bunkers = xr.open_dataset(data_dir_EM / f"Emissions_CO2_Excl_shipping_aviation_AFOLU.nc")
+                    ds_emissions_CO2_excl_bunkers = ds_emissions_CO2_excl_bunkers.chunk(chunk_planner.chunks_for(ds_emissions_CO2_excl_bunkers, n_arrays=2))
 
                     # change georeferencing of dataset
                     # The function rxr.open_rasterio() is designed for reading raster formats like GeoTIFF.
@@ -2223,12 +2242,13 @@ def read_process_grid_data_EM(dir_processed:Path, varname="Emissions_CO2_Excl_sh
                                                                                       factor=coarse_factor,
                                                                                       save=save,
                                                                                       zero_to_nan=True,
-                                                                                      save_type="netcdf",
-                                                                                      chunks_size_save=chunks,
+                                                                                      save_type=grid_store.storage_format(),
+                                                                                      chunks_size_save=grid_store.storage_chunks()["y"],
                                                                                       varname=varname,
                                                                                       filepath=rxr_filepath,
                                                                                       aggregation_methods={varname: "sum"},
                                                                                       log=log)
+                    rxr_filepath = grid_store.store_path(rxr_filepath)
                     ds_emissions_CO2_excl_bunkers_coarsened[varname].attrs["unit"] = unit
                     if check:
                         # count number of cells for the year 2020: total, zero, positive, negative and nan values
@@ -2247,23 +2267,33 @@ def read_process_grid_data_EM(dir_processed:Path, varname="Emissions_CO2_Excl_sh
                     search_pattern = f"CO2-em-anthro_annual_excl_bunkers_(\\d{{4}}).nc"
 
 
-                    files = sorted(data_dir_EM.glob(glob_pattern))
-                    log.info(f"Found {len(files)} files matching {glob_pattern}")
-
-                    data = []
-                    years = []
-
-                    for i, f in enumerate(files):
-                        #ds_emissions_CO2_excl_bunkers_coarsened = read_in_tiff_to_rio(data_dir_EM, glob_pattern, search_pattern, varname, year_check, log)
-                        #da_file = data_dir_EM / f"CO2-em-anthro_annual_excl_bunkers_{base_year}.nc"
-                        da_data = xr.open_dataarray(f)
+                    # the years appended to one zarr store, or one netcdf file per year
+                    file_store = data_dir_EM / "CO2-em-anthro_annual_excl_bunkers.zarr"
+                    if grid_store.exists(file_store):
+                        log.info(f"Reading the years of {file_store}")
+                        ds_store = grid_store.open_dataset(file_store)
+                        da_data = ds_store[list(ds_store.data_vars)[0]]
                         da_data.attrs["unit"] = unit
-                        year = pd.Timestamp(da_data.time.values[0]).year
-                        da_data = da_data.assign_coords(time=[year])
-                        data.append(da_data)
-                        years.append(year)
-                    ds_emissions_CO2_excl_bunkers_coarsened = xr.concat(data, dim="time")
-                    ds_emissions_CO2_excl_bunkers_coarsened = ds_emissions_CO2_excl_bunkers_coarsened.assign_coords(time=years)
+                        years = pd.DatetimeIndex(da_data.time.values).year.tolist()
+                        ds_emissions_CO2_excl_bunkers_coarsened = da_data.assign_coords(time=years)
+                    else:
+                        files = sorted(data_dir_EM.glob(glob_pattern))
+                        log.info(f"Found {len(files)} files matching {glob_pattern}")
+
+                        data = []
+                        years = []
+
+                        for i, f in enumerate(files):
+                            #ds_emissions_CO2_excl_bunkers_coarsened = read_in_tiff_to_rio(data_dir_EM, glob_pattern, search_pattern, varname, year_check, log)
+                            #da_file = data_dir_EM / f"CO2-em-anthro_annual_excl_bunkers_{base_year}.nc"
+                            da_data = xr.open_dataarray(f)
+                            da_data.attrs["unit"] = unit
+                            year = pd.Timestamp(da_data.time.values[0]).year
+                            da_data = da_data.assign_coords(time=[year])
+                            data.append(da_data)
+                            years.append(year)
+                        ds_emissions_CO2_excl_bunkers_coarsened = xr.concat(data, dim="time")
+                        ds_emissions_CO2_excl_bunkers_coarsened = ds_emissions_CO2_excl_bunkers_coarsened.assign_coords(time=years)
                     ds_emissions_CO2_excl_bunkers_coarsened = ds_emissions_CO2_excl_bunkers_coarsened.rename({k: v for k, v in {"lat": "y", "lon": "x"}.items() if k in ds_emissions_CO2_excl_bunkers_coarsened.dims})
                     ds_emissions_CO2_excl_bunkers_coarsened = ds_emissions_CO2_excl_bunkers_coarsened.to_dataset(name=varname)
         case _:
@@ -2276,18 +2306,18 @@ def read_process_grid_data_EM(dir_processed:Path, varname="Emissions_CO2_Excl_sh
 def read_processed_grid_data(data_dir: Path, file: Optional[Path], varname: str,
                              SSP_base: str, source: str, version: str, coarse_factor: int|float) -> xr.Dataset | None:
 
-        # check files
+        # check files, in the configured storage format (see grid_store) or else in the other one
         varname_read = varname.replace("|", "_")
         print(f"Checking input files in read_processed_IPAT_grid_data for {varname_read}...")
         if file is None:
-            file = data_dir / f"{varname_read}_{source}_{version}_{SSP_base}_cf_{coarse_factor}.nc"
-            if not file.exists():
+            file = grid_store.find(data_dir / f"{varname_read}_{source}_{version}_{SSP_base}_cf_{coarse_factor}.nc")
+            if not grid_store.exists(file):
                 raise FileNotFoundError(f"{varname_read} file not found: {file}")
         print(f"Using file: {file}")
 
         # read in data if not already read in
         print(f"Reading {varname_read} data from file...")
-        with xr.open_dataset(file, decode_coords="all") as rxr_IPAT_factor:
+        with grid_store.open_dataset(file, decode_coords="all") as rxr_IPAT_factor:
             print(f"Type: {type(rxr_IPAT_factor)}")
 
         return rxr_IPAT_factor
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import psutil
+from tabulate import tabulate
+
+from tools.functions_logging import deferred_logging
+from tools.general_functions import PRINT_COLORS
+
+import downscaling.memory_monitor as memory_monitor
+import downscaling.settings_downscaling as settings
+
+local_log, dummy_log = deferred_logging("log", "log/reading_data/local")
+
+# Structured timing report of a run
+# Every pipeline step (see pipeline.run_pipeline) and every phase of downscale_SE_data adds a record to the report of
+# its run: wall time, CPU time, bytes read and written, cells of the outputs per second and whether the step was a
+# cache hit (loaded from its files), a cache miss (a step with cached files that had to run) or not cached.
+# At the end of a run the report is written as JSON (report_settings["dir"]) and printed as a summary table.
+# CPU time and I/O are counters of the process: steps that run concurrently in the pipeline see each other's work,
+# and chunks computed by the workers of a dask cluster (see dask_cluster.py) are not counted. The sum of the wall
+# times can be larger than the wall time of the run for the same reason.
+# With memory_settings["enabled"] the records also hold the peak memory of the step and its largest output arrays, and a
+# warning is logged when a step exceeds its memory budget (see memory_monitor.py).
+
+_lock = threading.Lock()
+
+def new_report(run:str, **metadata) -> dict:
+    '''
+    Empty report of a run; metadata (profile, scenario, ...) is written with it.
+    '''
+    return {"run": run, "started": datetime.now().isoformat(timespec="seconds"), "host": socket.gethostname(),
+            "pid": os.getpid(), **metadata, "steps": [], "_t0": time.time()}
+
+def _counters() -> dict:
+    process = psutil.Process()
+    cpu = process.cpu_times()
+    counters = {"wall": time.time(), "cpu": cpu.user + cpu.system, "read": None, "written": None}
+    # io_counters is not available on every platform (e.g. macOS)
+    if hasattr(process, "io_counters"):
+        try:
+            io = process.io_counters()
+            counters["read"], counters["written"] = io.read_bytes, io.write_bytes
+        except (psutil.AccessDenied, NotImplementedError):
+            pass
+    return counters
+
+def cells(outputs) -> int | None:
+    '''
+    Cells of the largest xarray DataArray or Dataset in the outputs of a step (dict or object), None if there is none.
+    '''
+    values = outputs.values() if isinstance(outputs, dict) else [outputs]
+    sizes = []
+    for value in values:
+        if hasattr(value, "sizes") and hasattr(value, "dims"):
+            n_cells = 1
+            for size in dict(value.sizes).values():
+                n_cells *= size
+            sizes.append(n_cells)
+    return max(sizes) if sizes else None
+
+def start_step(name:str, action:str="run", cache:str="n/a") -> dict:
+    '''
+    Start the record of a step; action "run" or "load", cache "hit", "miss" or "n/a".
+    '''
+    record = {"step": name, "action": action, "cache": cache, "_start": _counters()}
+    if settings.memory_settings["enabled"]:
+        record["_memory"] = memory_monitor.start(name)
+    return record
+
+def end_step(report:dict|None, record:dict, outputs=None, n_cells:int|None=None, log: logging.Logger=local_log) -> dict:
+    '''
+    Finish the record of a step and add it to the report (if any); the cells are those of the outputs unless given.
+    '''
+    start = record.pop("_start")
+    end = _counters()
+    record["wall_s"] = end["wall"] - start["wall"]
+    record["cpu_s"] = end["cpu"] - start["cpu"]
+    for counter in ["read", "written"]:
+        record[f"{counter}_bytes"] = end[counter] - start[counter] if start[counter] is not None else None
+    record["cells"] = n_cells if n_cells is not None else cells(outputs) if outputs is not None else None
+    record["cells_per_s"] = record["cells"] / record["wall_s"] if record["cells"] and record["wall_s"] > 0 else None
+    if "_memory" in record:
+        record.update(memory_monitor.stop(record.pop("_memory")))
+        record["largest_output_arrays"] = memory_monitor.largest_output_arrays(outputs) if outputs is not None else []
+        record["within_budget"] = memory_monitor.check_budget(record["step"], record, log)
+    if report is not None:
+        with _lock:
+            report["steps"].append(record)
+    return record
+
+def totals(report:dict) -> dict:
+    '''
+    Wall time of the run and the sums of CPU time and bytes over its steps.
+    '''
+    steps = report["steps"]
+    def total(column):
+        values = [step[column] for step in steps if step[column] is not None]
+        return sum(values) if values else None
+    return {"wall_s": time.time() - report["_t0"], "cpu_s": total("cpu_s"),
+            "read_bytes": total("read_bytes"), "written_bytes": total("written_bytes"),
+            "cache_hits": sum(step["cache"] == "hit" for step in steps), "cache_misses": sum(step["cache"] == "miss" for step in steps),
+            "peak_rss_GB": max((step["peak_rss_GB"] for step in steps if "peak_rss_GB" in step), default=None)}
+
+def summary_table(report:dict) -> str:
+    '''
+    Steps of the report as a table, the slowest first, with their share of the wall time of the run.
+    '''
+    run_wall = (report["totals"] if "totals" in report else totals(report))["wall_s"]
+    memory = any("peak_rss_GB" in step for step in report["steps"])
+    rows = []
+    for step in sorted(report["steps"], key=lambda step: step["wall_s"], reverse=True):
+        row = [step["step"], step["action"], step["cache"], step["wall_s"] / 60, 100 * step["wall_s"] / run_wall if run_wall else None,
+               step["cpu_s"] / 60,
+               step["read_bytes"] / 1e9 if step["read_bytes"] is not None else None,
+               step["written_bytes"] / 1e9 if step["written_bytes"] is not None else None,
+               step["cells_per_s"] / 1e6 if step["cells_per_s"] is not None else None]
+        if memory:
+            row += [step.get("peak_rss_GB"), step.get("peak_worker_GB"), "" if step.get("within_budget", True) else "over budget"]
+        rows.append(row)
+    headers = ["step", "action", "cache", "wall (min)", "wall (%)", "CPU (min)", "read (GB)", "written (GB)", "M cells/s"]
+    if memory:
+        headers += ["peak RSS (GB)", "peak worker (GB)", "budget"]
+    return tabulate(rows, headers=headers, tablefmt="simple", floatfmt=",.2f", missingval="-")
+
+def read_report(report_file:Path) -> dict:
+    '''
+    Read a report written by write_report.
+    '''
+    with open(report_file, "r") as f:
+        return json.load(f)
+
+def write_report(report:dict, project_dir:Path, log: logging.Logger=local_log) -> Path:
+    '''
+    Write the report as JSON to report_settings["dir"] in the project directory and log the summary table.
+    Returns the path of the report.
+    '''
+    report["totals"] = totals(report)
+    report["finished"] = datetime.now().isoformat(timespec="seconds")
+    dir_reports = Path(project_dir) / settings.report_settings["dir"]
+    dir_reports.mkdir(parents=True, exist_ok=True)
+    report_file = dir_reports / f"run_report_{report['run']}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(report_file, "w") as f:
+        json.dump({key: value for key, value in report.items() if not key.startswith("_")}, f, indent=2)
+
+    run_totals = report["totals"]
+    log.info(f"\n{PRINT_COLORS['purple']}Run report {report['run']}: {run_totals['wall_s'] / 60:,.1f} mins, "
+             f"{run_totals['cache_hits']} cache hits, {run_totals['cache_misses']} cache misses{PRINT_COLORS['end']}\n{summary_table(report)}")
+    log.info(f"Run report written to {report_file}")
+    return report_file
@@ -64,6 +64,8 @@ SOURCE_PROFILES = {
 # ---------------------------------------------------------------------------
 # Process flags
 # ---------------------------------------------------------------------------
+# read/process flags force a step to rerun; when False the step reuses its intermediate file
+# if the cache (see cache_settings) finds it up to date with its inputs, settings and code
 process_flags = {
     "read_process_IAM": False,
     "read_process_POP": False,
@@ -73,12 +75,149 @@ process_flags = {
     "process_GDP_per_POP": False,
     "process_df_EM_per_GDP": False,
     "process_grid_EM_per_GDP": False,
+    "save_IPAT_factors_intermediate": True, # write GDP per capita and EM per GDP (PPP) grids; if False they are only used lazily in the Kaya product
+    "verify_harmonised_in_write": True, # accumulate post-harmonisation regional sums while the harmonised grid is written
+    "land_packed": False, # process Kaya product, regional sums and harmonisation on land cells only (time, land_cell)
     "save_tiffs_intermediate": True,
     "save_tiffs_results": True,
     "process_urban_classification": True,
     "process_SE": True
 }
 
+# ---------------------------------------------------------------------------
+# Cache of intermediate files (see intermediate_cache.py)
+# ---------------------------------------------------------------------------
+cache_settings = {
+    "enabled": True,       # False: reuse an intermediate file whenever it exists (no check of inputs, settings and code)
+    "max_size_GB": 500,    # per processed directory, least recently used intermediates are removed first
+    "lock_timeout_s": 120, # a manifest lock older than this is left over from a crashed run and is taken over
+}
+
+# ---------------------------------------------------------------------------
+# Storage of the processed grids and intermediates (see grid_store.py)
+# ---------------------------------------------------------------------------
+storage_settings = {
+    "format": "netcdf",    # "netcdf" (.nc) or "zarr" (.zarr, chunks written in parallel)
+    # chunks of the stored grids per dimension (netcdf chunksizes, zarr chunks), aligned with the chunks used to read
+    # them (chunk_planner.py rounds its tiles to whole stored chunks), so a chunk-wise read touches whole stored chunks
+    "chunks": {"time": 1, "y": 1024, "x": 1024, "land_cell": 1048576},
+    # encoding policy of all writes (see grid_store.encoding_policy), one of encoding_policies
+    "encoding": "zlib",
+}
+# codec, compression level, byte shuffle and dtype per policy (dtype None: keep float64, float32 halves the size but
+# rounds to ~7 significant digits); zstd and lz4 need a netCDF-C with these filters (HDF5 plugins, blosc for lz4),
+# python main.py --compare_encodings <file> reports size and read/write speed per policy
+encoding_policies = {
+    "none": {"codec": None, "complevel": 0, "shuffle": False, "dtype": None},
+    "zlib": {"codec": "zlib", "complevel": 4, "shuffle": True, "dtype": None},
+    "zlib_float32": {"codec": "zlib", "complevel": 4, "shuffle": True, "dtype": "float32"},
+    "zstd": {"codec": "zstd", "complevel": 3, "shuffle": True, "dtype": None},
+    "lz4": {"codec": "lz4", "complevel": 5, "shuffle": True, "dtype": None},
+}
+
+# ---------------------------------------------------------------------------
+# Chunk layouts from a memory budget (see chunk_planner.py)
+# ---------------------------------------------------------------------------
+chunk_settings = {
+    "memory_budget_GB": None,   # None: the memory limits of the cluster workers, or 80% of the memory of the machine
+    "workers": None,            # None: threads of the cluster workers or of the threaded scheduler
+    "chunks_in_flight": 4,      # chunks per worker in memory at the same time (read ahead, output, queued tasks)
+    "min_chunk": 256,           # minimal tile side (cells), smaller tiles spend their time on task overhead
+    "max_chunk": 8192,          # maximal tile side (cells)
+    "calibrate": False,         # measure overhead and minimal tile with a short run of the chunk kernels before the first plan
+}
+
+# ---------------------------------------------------------------------------
+# Pipeline of the downscaling steps (see pipeline.py)
+# ---------------------------------------------------------------------------
+pipeline_settings = {
+    "max_workers": 3,      # steps that do not depend on each other (e.g. reading population, GDP and emissions) run concurrently,
+                           # each with 1/max_workers of the dask threads and of the memory budget (chunk_planner.shared_by)
+}
+
+# ---------------------------------------------------------------------------
+# Parallel batches of runs (see batch_runs.py)
+# ---------------------------------------------------------------------------
+batch_settings = {
+    "max_processes": None,       # None: number of cores
+    "memory_budget_GB": None,    # None: 80% of the memory of the machine
+    "memory_per_run_GB": None,   # None: estimated from the resolution of the profile (urban aggregation: from the emissions cube on disk)
+    "grids_in_memory": 12,       # (y, x) float64 grids held in memory by a run (estimate)
+    "chunks_in_memory": 64,      # (y, x) chunks of the streamed cubes held in memory by a run (estimate)
+}
+
+# ---------------------------------------------------------------------------
+# Local dask cluster, main.py --cluster local:N (see dask_cluster.py)
+# ---------------------------------------------------------------------------
+cluster_settings = {
+    "threads_per_worker": 2,
+    "memory_limit": "auto",        # per worker, "auto": memory of the machine divided over the workers, or e.g. "16GB"
+    "memory_target": 0.6,          # fractions of the memory limit: spill to disk at target/spill,
+    "memory_spill": 0.7,           # pause the worker at pause and restart it at terminate
+    "memory_pause": 0.8,
+    "memory_terminate": 0.95,
+    "local_directory": None,       # directory for spilled data, None: temporary directory
+    "dashboard_address": ":8787",
+    "performance_report": True,    # write a dask performance report (html) to log/dask
+}
+
+# ---------------------------------------------------------------------------
+# Benchmarks on synthetic data, main.py --benchmark (see benchmarks.py)
+# ---------------------------------------------------------------------------
+benchmark_settings = {
+    "resolutions_arcmin": [6, 1, 0.5],
+    "benchmarks": ["calc_regional_values", "downscale_em_per_gdp", "harmonisation", "coarsen_save_rio_xarray",
+                   "aggregate_urban_emissions", "downscale_emissions"],
+    "n_regions": 26,                     # land regions of the synthetic IMAGE region raster
+    "years_grid": [2020, 2050, 2100],    # years of the synthetic population and GDP grids
+    "urban_areas": 2000,                 # urban and rural polygons of the synthetic urban classification
+    "seed": 2020,
+    "dir": "data/benchmarks",            # synthetic projects (generated once per resolution), relative to the project directory
+    "history_file": "data/benchmarks/benchmark_history.jsonl",   # one JSON record per benchmark run
+}
+
+# ---------------------------------------------------------------------------
+# Run reports with the time, I/O and throughput per step (see run_report.py)
+# ---------------------------------------------------------------------------
+report_settings = {
+    "dir": "log/run_reports",      # JSON report per run, relative to the project directory
+}
+
+# ---------------------------------------------------------------------------
+# Peak memory per step in the run reports (see memory_monitor.py)
+# ---------------------------------------------------------------------------
+memory_settings = {
+    "enabled": False,              # sample the memory of the process (and of the dask workers) during every step
+    "interval_s": 0.5,             # seconds between samples
+    "largest_output_arrays": 3,    # largest arrays returned by a step recorded per step (not its temporaries)
+    "default_budget_GB": None,     # warn when a step exceeds it, None: memory budget of the chunk planner (chunk_settings)
+    "step_budget_GB": {},          # budgets of single steps, e.g. {"kaya_emissions": 40}
+}
+
+# ---------------------------------------------------------------------------
+# Diagnostics of the dask compute calls, main.py --dask_diagnostics (see dask_diagnostics.py)
+# ---------------------------------------------------------------------------
+diagnostics_settings = {
+    "enabled": False,
+    "small_compute_s": 0.5,          # computes shorter than this are small
+    "many_small_computes": 20,       # flag a call site with at least this many small computes
+    "huge_graph_tasks": 1_000_000,   # flag a graph with at least this many tasks
+    "overhead_fraction": 0.5,        # flag a call site that spends at least this fraction of its wall time on scheduling
+    "min_wall_s": 10,                # ... if it takes at least this long in total
+    "resource_interval_s": 1.0,      # seconds between the CPU and memory samples of the performance report
+    "task_profile": False,           # add the task stream (one record per task) to the performance report
+    "max_task_records": 1_000_000,   # ... for at most this many tasks, the records are held in memory until the end
+    "table_rows": 20,                # call sites in the logged summary
+}
+
+# ---------------------------------------------------------------------------
+# Cache of the IAM scenario workbooks as Parquet tables (see read_process_IAM_data.read_IAM_workbook)
+# ---------------------------------------------------------------------------
+iam_cache_settings = {
+    "enabled": True,                     # False: read the Excel workbook on every run
+    "dir": "data/processed/IAM_cache",   # one table per workbook (in a directory per model), relative to the project directory
+}
+
 check_flags = {
     "check_POP_data": False,
     "check_GDP_data": False,
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Linear interpolation of grids between source years (keyframes)
+# A target year between two source years t0 < year < t1 is the blend of the two bracketing slices,
+#   grid(year) = (1 - w) * grid(t0) + w * grid(t1),  w = (year - t0) / (t1 - t0)
+# and a target year that is a source year is that slice. The weights follow from the years alone, so the result
+# is a lazy (dask) cube in which every target year reads at most two source slices; written with
+# grid_store.save_dataset the blended chunks are computed and streamed to the file in one pass.
+# Target years outside the source years are NaN (as xarray's interp). The time coordinate holds years (numbers).
+# The regional IAM tables are aligned with the downscaling years by interp_table: the long table is pivoted to one
+# row per region and variable and one column per year, and the missing years of all rows are filled in one numpy pass
+# (interp_rows) with the semantics of pandas' interpolate("linear", limit_area="inside"): the years are equally spaced
+# points and years before the first or after the last value of a row stay NaN.
+
+def keyframe_weights(source_years, target_years) -> list:
+    '''
+    (year, t0, t1, w) per target year: the bracketing source years and the weight of t1.
+    For a source year t0 = t1 = year and w = 0; outside the source years t0 = t1 = None and w = nan.
+    '''
+    source_years = np.sort(np.asarray(source_years))
+    weights = []
+    for year in target_years:
+        i = np.searchsorted(source_years, year)
+        if i < len(source_years) and source_years[i] == year:
+            weights.append((year, source_years[i].item(), source_years[i].item(), 0.0))
+        elif i == 0 or i == len(source_years):
+            weights.append((year, None, None, np.nan))
+        else:
+            t0, t1 = source_years[i - 1].item(), source_years[i].item()
+            weights.append((year, t0, t1, float((year - t0) / (t1 - t0))))
+    return weights
+
+def _interp_dataarray(da:xr.DataArray, weights:list, dim:str) -> xr.DataArray:
+    slices = []
+    for year, t0, t1, w in weights:
+        if t0 is None:
+            da_year = xr.full_like(da.isel({dim: 0}, drop=True), np.nan)
+        elif t0 == t1:
+            da_year = da.sel({dim: t0}, drop=True)
+        else:
+            da_year = da.sel({dim: t0}, drop=True) * (1 - w) + da.sel({dim: t1}, drop=True) * w
+        slices.append(da_year.expand_dims({dim: [year]}))
+    return xr.concat(slices, dim=dim)
+
+def _keep_float_dtype(da:xr.DataArray, dtype) -> xr.DataArray:
+    # floating point grids keep their precision (e.g. float32), blends of integer grids stay float as with xarray's interp
+    return da.astype(dtype, copy=False) if np.issubdtype(dtype, np.floating) else da
+
+def interp_years(obj:xr.Dataset|xr.DataArray, years:list, dim:str="time") -> xr.Dataset|xr.DataArray:
+    '''
+    Linear interpolation of a DataArray or Dataset to the years (see keyframe_weights), lazy for dask-backed data.
+    Data variables without dim are kept as they are; attributes, encoding and floating point dtypes are kept
+    (integer variables become float).
+    '''
+    weights = keyframe_weights(obj[dim].values, years)
+    with xr.set_options(keep_attrs=True):
+        if isinstance(obj, xr.DataArray):
+            return _keep_float_dtype(_interp_dataarray(obj, weights, dim), obj.dtype)
+        result = obj.drop_dims(dim).assign_coords({dim: list(years)})
+        for name, da in obj.data_vars.items():
+            if dim in da.dims:
+                result[name] = _keep_float_dtype(_interp_dataarray(da, weights, dim), da.dtype).transpose(*da.dims)
+                # the integer dtype of the source file would truncate the blends when written
+                result[name].encoding = {key: value for key, value in da.encoding.items()
+                                         if key != "dtype" or np.issubdtype(da.dtype, np.floating)}
+    return result
+
+def interp_rows(values:np.ndarray) -> np.ndarray:
+    '''
+    Fill the NaNs of every row of a 2D array linearly between the values around them (by position);
+    NaNs before the first or after the last value of a row stay NaN.
+    '''
+    n_columns = values.shape[1]
+    positions = np.arange(n_columns)
+    valid = ~np.isnan(values)
+    preceding = np.maximum.accumulate(np.where(valid, positions, -1), axis=1)
+    following = np.minimum.accumulate(np.where(valid, positions, n_columns)[:, ::-1], axis=1)[:, ::-1]
+    rows, columns = np.nonzero(~valid & (preceding >= 0) & (following < n_columns))
+    i0, i1 = preceding[rows, columns], following[rows, columns]
+    v0, v1 = values[rows, i0], values[rows, i1]
+    result = values.copy()
+    result[rows, columns] = v0 + (v1 - v0) / (i1 - i0) * (columns - i0)
+    return result
+
+def interp_table(df:pd.DataFrame, id_cols:list, years:list, year_col:str="year", value_col:str="value") -> pd.DataFrame:
+    '''
+    Long table reindexed to the years per group of id_cols, missing years interpolated by interp_rows; as
+    groupby(id_cols).apply(reindex(years) and interpolate("linear", limit_area="inside")), for all groups at once.
+    Returns the columns id_cols, year_col and value_col, sorted by the groups and then in the order of years.
+    '''
+    df_wide = (df.dropna(subset=id_cols)
+                 .pivot(index=id_cols, columns=year_col, values=value_col)
+                 .reindex(columns=years))
+    values = interp_rows(df_wide.to_numpy(dtype=float))
+    df_long = df_wide.index.repeat(len(years)).to_frame(index=False)
+    df_long[year_col] = np.tile(np.asarray(years), len(df_wide))
+    df_long[value_col] = values.ravel()
+    return df_long
@@ -1,22 +1,31 @@
+from __future__ import annotations
+
 import sys
 import os
 import argparse
+import contextlib
 from pathlib import Path
 
-import numpy as np
-import pandas as pd
-
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import matplotlib.pyplot as plt
-
-import geopandas as gpd
-import xarray as xr
-
-import downscaling.downscaling as downscaling
-import downscaling.IAM_spatial_model_maps as IAM_maps
-import downscaling.read_process_grid_data as process_grid_data
-from tools.general_functions import PRINT_COLORS
+import downscaling.settings_downscaling as settings
+from tools.general_functions import PRINT_COLORS, lazy_import
+
+# every command only imports the stacks it uses, so main.py --help starts without numpy, xarray, dask or the GIS stack
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+ccrs = lazy_import("cartopy.crs")
+cfeature = lazy_import("cartopy.feature")
+plt = lazy_import("matplotlib.pyplot")
+xr = lazy_import("xarray")
+
+downscaling = lazy_import("downscaling.downscaling")
+batch_runs = lazy_import("downscaling.batch_runs")
+benchmarks = lazy_import("downscaling.benchmarks")
+dask_cluster = lazy_import("downscaling.dask_cluster")
+grid_store = lazy_import("downscaling.grid_store")
+run_report = lazy_import("downscaling.run_report")
+IAM_maps = lazy_import("downscaling.IAM_spatial_model_maps")
+process_grid_data = lazy_import("downscaling.read_process_grid_data")
+process_GDP = lazy_import("tools.process_GDP")
 
 """
 Configure GDAL and PROJ data directories for the active Python environment.
@@ -185,40 +194,10 @@ def run_aggregration_to_urban(SSP_base: str = "SSP2", rounds: dict[str, str] | N
     if rounds is None:
         print(f"{PRINT_COLORS['yellow']}No rounds specified, using default rounds{PRINT_COLORS['end']}")
     else:
-        # read in urban classification
-        dir_urban = project_dir / Path("data/processed/DLL")
-        print(f"{PRINT_COLORS["green"]}Reading urban classification data from: {dir_urban / 'urban_classification_years.parquet'}{PRINT_COLORS["end"]}")
-        path_urban = dir_urban / "urban_classification_years.parquet"
-        gdf_urban = gpd.read_parquet(path_urban)
-
-        for i, r in enumerate(rounds.items()):
-            print(f"Processing {r[0]} ({i+1}/{len(rounds)})...")
-            # read in grid emissions
-            varname_EM = "Emissions_CO2_Excl_shipping_aviation_AFOLU"
-            file_EM = f"Emissions_CO2_Excl_shipping_aviation_AFOLU_harmonised_{SSP_base}.nc"
-            scenario_EM = "IMAGE_ELV-SSP2-CP"
-            dir_processed = project_dir / Path("data/processed")
-            path_EM = dir_processed / r[1] / scenario_EM / file_EM
-
-            print(f"Reading emissions data from: {path_EM}")
-            xr_EM = xr.open_dataset(path_EM, engine="netcdf4")
-            print(f"{xr_EM[varname_EM].attrs['unit']}")
-            print(xr_EM)
-
-            xr_em_urban, df_em_urban, df_em_rural = downscaling.aggregate_urban_emissions(xr_emissions=xr_EM, gdf_urban_classification=gdf_urban,
-                                                                             emissions_varname=varname_EM,
-                                                                             region_varname="region_number",
-                                                                             final_year=2050)
-
-
-            dir_urban_classification = project_dir / Path("data/output")
-            df_em_urban.to_csv(dir_urban_classification / f"Emissions_urban_classification_{scenario_EM}_{r[0]}.csv", index=False, sep=";")
-            df_em_rural.to_csv(dir_urban_classification / f"Emissions_rural_classification_{scenario_EM}_{r[0]}.csv", index=False, sep=";")
-            print(f"Saved aggregated emissions for {r[0]} to output directory.")
-
-            print(xr_em_urban)
-            print("-------------------------------------")
-            print(df_em_urban.head())
+        # rounds are aggregated in parallel, the urban classification is read once per process
+        print(f"Processing {len(rounds)} rounds: {", ".join(rounds)}")
+        batch_runs.aggregate_urban_rounds(project_dir, rounds, SSP_base)
+        print("Saved aggregated emissions of all rounds to output directory.")
 
 if __name__ == "__main__":
     '''
@@ -232,6 +211,21 @@ if __name__ == "__main__":
     -Compare to raster files
     pixi run python main.py --compare
 
+    -Compare encoding policies (size, write and read speed) for a processed grid
+    pixi run python main.py --compare_encodings data/processed/<profile>/<sources>/IMAGE/Population_processed_2UP_GHSL_2024_M3_SSP2_cf_1.nc
+
+    -Benchmarks on synthetic data (all resolutions of benchmark_settings, or 6 and 1 arc minutes) and comparison of the last runs
+    pixi run python main.py --benchmark
+    pixi run python main.py --benchmark 6,1
+    pixi run python main.py --benchmark_history
+
+    -Summary table of a run report (time, I/O and throughput per step, written at the end of every downscaling run)
+    pixi run python main.py --run_report log/run_reports/run_report_emissions_default_IMAGE_SSP2_net_20250101_120000.json
+
+    -Export the GDPuc conversion factors between constant GDP units once (needs R with GDPuc, see tools/process_GDP.py)
+    pixi run python main.py --export_gdpuc_factors "constant 2005 Int$PPP,constant 2010 Int$PPP,constant 2017 Int$PPP"
+    pixi run python main.py --check_gdpuc "constant 2010 Int$PPP,constant 2005 Int$PPP"
+
     -Downscaling emissions to grid level
     **********************************************
     INPUT PROFILE
@@ -250,6 +244,12 @@ if __name__ == "__main__":
     pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile %profile% --emissions net
     pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile first_round --emissions net
     pixi run python main.py --downscale_emissions --scenario ELV-SSP2-1150F --model IMAGE --profile  %profile% --emissions net
+    pixi run python main.py --downscale_emissions --scenarios ELV-SSP2-CP,ELV-SSP2-1150F --model IMAGE --profile %profile% --emissions net
+    pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile %profile% --emissions net --target kaya_emissions
+    pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile %profile% --emissions net --cluster local:4
+    pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile %profile% --emissions net --track_memory
+    pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile %profile% --emissions net --dask_diagnostics
+    pixi run python main.py --run_matrix --scenarios ELV-SSP2-CP,ELV-SSP2-1150F --profiles fourth_round,fifth_round --model IMAGE --emissions net,gross
 
     --Downscale GROSS EMISSIONS
     pixi run python main.py --downscale_emissions --scenario ELV-SSP2-CP --model IMAGE --profile %profile% --emissions gross
@@ -285,6 +285,13 @@ if __name__ == "__main__":
     parser.add_argument("--downscale_gdp_ppp", action="store_true", help="downscale GDP (PPP)")
     parser.add_argument("--downscale_emissions", action="store_true", help="downscale emissions")
     parser.add_argument("--scenario", type=str, help="Scenario to downscale for (e.g. ELV-SSP2-CP)")
+    parser.add_argument("--scenarios", type=str, help="Comma-separated scenarios to downscale emissions for in one batch (e.g. ELV-SSP2-CP,ELV-SSP2-1150F)")
+    parser.add_argument("--profiles", type=str, help="Comma-separated profiles for a matrix of runs with --run_matrix (e.g. fourth_round,fifth_round)")
+    parser.add_argument("--run_matrix", action="store_true", help="Run all combinations of --scenarios, --profiles and --emissions (e.g. net,gross) in parallel")
+    parser.add_argument("--cluster", type=str, help="Run the computations on a local dask cluster with N worker processes (e.g. local:4)")
+    parser.add_argument("--track_memory", action="store_true", help="Record the peak memory per step in the run report and warn when a step exceeds its budget (memory_settings)")
+    parser.add_argument("--dask_diagnostics", action="store_true", help="Record task counts, graph sizes and scheduler overhead per dask compute call and write a performance report (diagnostics_settings)")
+    parser.add_argument("--target", type=str, help="Comma-separated pipeline steps of the emissions downscaling to run with the steps they need (e.g. kaya_emissions)")
     parser.add_argument("--model", type=str, help="Model from which scenario input is used (e.g. IMAGE, REMIND")
     parser.add_argument("--profile", type=str, help="Settings for input files")
     parser.add_argument("--emissions", type=str, help="net" or "gross")
@@ -296,59 +303,120 @@ if __name__ == "__main__":
 
     parser.add_argument("--compare", action="store_true", help="Compare two raster files")
 
+    parser.add_argument("--compare_encodings", type=str, help="Report size and write/read speed of a netcdf or zarr grid for every encoding policy")
+
+    parser.add_argument("--benchmark", type=str, nargs="?", const="all",
+                        help="Benchmark the downscaling on synthetic data, optionally for comma-separated resolutions in arc minutes (e.g. 6,1)")
+    parser.add_argument("--benchmark_history", action="store_true", help="Compare the last benchmark runs (seconds per benchmark and commit)")
+
+    parser.add_argument("--run_report", type=str, help="Print the summary table of a run report (JSON in log/run_reports)")
+
+    parser.add_argument("--export_gdpuc_factors", type=str, help="Export the GDPuc factors between comma-separated constant GDP units to data/input/GDPuc (needs R)")
+    parser.add_argument("--check_gdpuc", type=str, help="Compare convert_GDP with GDPuc in R for a sample of countries and years, for 'unit_in,unit_out' (needs R)")
+
     parser.add_argument("--run_urban_aggregation", action="store_true", help="Run urban aggregation")
 
     arguments = parser.parse_args()
     print(f"Arguments provided: {arguments}")
-    if hasattr(arguments, 'process') and arguments.process is not None:
-        if arguments.ssp_baseline is None:
-            parser.error("--processing requires a SSP baseline scenario to be specified with --ssp_base")
-        # Pre-process population, GDP and emissions datasets
-        downscaling.process_datasets(project_dir, arguments.ssp_baseline)
-        # Create raster for IMAGE regions based on GADM shapefile and IMAGE region numbers
-        IAM_maps.create_GADM_region_raster(project_dir, "IMAGE", float(arguments.resolution), True)
-        # process DLL data on urban areas (combine geopandas dataframe with csv dataframe on GDAM_ID)
-        process_grid_data.process_urban_classification_data(project_dir)
-    if hasattr(arguments, 'downscale_population') and arguments.downscale_population is True:
-        if arguments.scenario is None or arguments.profile is None:
-            parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
-        downscaling.downscale_SE_data(project_dir, "Population", arguments.scenario, arguments.model, False, arguments.profile)
-    if hasattr(arguments, 'downscale_gdp_ppp') and arguments.downscale_gdp_ppp is True:
-        if arguments.scenario is None or arguments.profile is None:
-            parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
-        downscaling.downscale_SE_data(project_dir, "GDP|PPP", arguments.scenario, arguments.model, True, arguments.profile)
-    if hasattr(arguments, 'downscale_emissions') and arguments.downscale_emissions is True:
-        if arguments.scenario is None or arguments.profile is None or arguments.emissions is None:
-            parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
-        if arguments.emissions not in ["net", "gross"]:
-            parser.error("--emissions requires a value of 'net' or 'gross'")
-        elif arguments.emissions == "net":
-            net_emissions = True
-        else:
-            net_emissions = False
-        downscaling.downscale_emissions(project_dir, arguments.scenario, arguments.model, arguments.profile, net_emissions)
-    if hasattr(arguments, 'plot') and arguments.plot is True:
-        if arguments.scenario is None or arguments.profile is None:
-            parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
-        if arguments.emissions not in ["net", "gross"]:
-            parser.error("--emissions requires a value of 'net' or 'gross'")
-        elif arguments.emissions == "net":
-            net_emissions = True
-        else:
-            net_emissions = False
-        if arguments.global_min is None or arguments.global_max is None:
-            downscaling.plot_results(arguments.scenario, "IMAGE", arguments.profile, net_emissions, None, None)
-        else:
-            downscaling.plot_results(arguments.scenario, "IMAGE", arguments.profile, net_emissions, float(arguments.global_min), float(arguments.global_max))
-    if hasattr(arguments, 'upload') and arguments.upload is True:
-        if arguments.scenario is None or arguments.profile is None:
-            parser.error("--upload requires a scenario to be specified and/or --profile requires a profile to be specified")
-        downscaling.upload_to_GEE(arguments.scenario, "IMAGE", arguments.profile)
-    if hasattr(arguments, 'compare') and arguments.compare is True:
-        downscaling.compare_two_raster_files()
-    if hasattr(arguments, 'run_urban_aggregation') and arguments.run_urban_aggregation is True:
-        run_aggregration_to_urban("SSP2", rounds)
-        combine_emissions_output(project_dir / "data" / "output")
+    if arguments.cluster is not None:
+        try:
+            dask_cluster.parse_cluster(arguments.cluster)
+        except ValueError as e:
+            parser.error(str(e))
+    if arguments.track_memory:
+        settings.memory_settings["enabled"] = True
+    if arguments.dask_diagnostics:
+        settings.diagnostics_settings["enabled"] = True
+    # local dask cluster (--cluster local:N) or threaded scheduler with progress bar for the commands that compute
+    label = "_".join(str(value) for value in [arguments.scenario or arguments.scenarios, arguments.profile or arguments.profiles] if value)
+    computing = any([arguments.process, arguments.downscale_population, arguments.downscale_gdp_ppp, arguments.run_matrix,
+                     arguments.downscale_emissions, arguments.plot, arguments.compare_encodings, arguments.benchmark,
+                     arguments.run_urban_aggregation])
+    with dask_cluster.compute_context(arguments.cluster, project_dir, label or "main") if computing else contextlib.nullcontext():
+        if hasattr(arguments, 'process') and arguments.process is not None:
+            if arguments.ssp_baseline is None:
+                parser.error("--processing requires a SSP baseline scenario to be specified with --ssp_base")
+            # Pre-process population, GDP and emissions datasets
+            downscaling.process_datasets(project_dir, arguments.ssp_baseline)
+            # Create raster for IMAGE regions based on GADM shapefile and IMAGE region numbers
+            IAM_maps.create_GADM_region_raster(project_dir, "IMAGE", float(arguments.resolution), True)
+            # process DLL data on urban areas (combine geopandas dataframe with csv dataframe on GDAM_ID)
+            process_grid_data.process_urban_classification_data(project_dir)
+        if hasattr(arguments, 'downscale_population') and arguments.downscale_population is True:
+            if arguments.scenario is None or arguments.profile is None:
+                parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
+            downscaling.downscale_SE_data(project_dir, "Population", arguments.scenario, arguments.model, False, arguments.profile)
+        if hasattr(arguments, 'downscale_gdp_ppp') and arguments.downscale_gdp_ppp is True:
+            if arguments.scenario is None or arguments.profile is None:
+                parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
+            downscaling.downscale_SE_data(project_dir, "GDP|PPP", arguments.scenario, arguments.model, True, arguments.profile)
+        if hasattr(arguments, 'run_matrix') and arguments.run_matrix is True:
+            if arguments.scenarios is None or arguments.profiles is None or arguments.emissions is None:
+                parser.error("--run_matrix requires --scenarios, --profiles and --emissions to be specified")
+            # all (scenario, profile, emissions) runs in a process pool sized to the memory budget (batch_settings)
+            batch_runs.downscale_emissions_matrix(project_dir,
+                                                  [scenario.strip() for scenario in arguments.scenarios.split(",") if scenario.strip()],
+                                                  [profile.strip() for profile in arguments.profiles.split(",") if profile.strip()],
+                                                  [gross_net.strip() for gross_net in arguments.emissions.split(",") if gross_net.strip()],
+                                                  arguments.model or "IMAGE")
+        elif hasattr(arguments, 'downscale_emissions') and arguments.downscale_emissions is True:
+            if (arguments.scenario is None and arguments.scenarios is None) or arguments.profile is None or arguments.emissions is None:
+                parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
+            if arguments.emissions not in ["net", "gross"]:
+                parser.error("--emissions requires a value of 'net' or 'gross'")
+            elif arguments.emissions == "net":
+                net_emissions = True
+            else:
+                net_emissions = False
+            if arguments.scenarios is not None:
+                # scenario-independent grids are read and processed once for all scenarios
+                scenarios = [scenario.strip() for scenario in arguments.scenarios.split(",") if scenario.strip()]
+                downscaling.downscale_emissions_scenarios(project_dir, scenarios, arguments.model, arguments.profile, net_emissions)
+            else:
+                targets = [target.strip() for target in arguments.target.split(",") if target.strip()] if arguments.target is not None else None
+                downscaling.downscale_emissions(project_dir, arguments.scenario, arguments.model, arguments.profile, net_emissions, targets)
+        if hasattr(arguments, 'plot') and arguments.plot is True:
+            if arguments.scenario is None or arguments.profile is None:
+                parser.error("--scenario requires a scenario to be specified and/or --profile requires a profile to be specified")
+            if arguments.emissions not in ["net", "gross"]:
+                parser.error("--emissions requires a value of 'net' or 'gross'")
+            elif arguments.emissions == "net":
+                net_emissions = True
+            else:
+                net_emissions = False
+            if arguments.global_min is None or arguments.global_max is None:
+                downscaling.plot_results(arguments.scenario, "IMAGE", arguments.profile, net_emissions, None, None)
+            else:
+                downscaling.plot_results(arguments.scenario, "IMAGE", arguments.profile, net_emissions, float(arguments.global_min), float(arguments.global_max))
+        if hasattr(arguments, 'upload') and arguments.upload is True:
+            if arguments.scenario is None or arguments.profile is None:
+                parser.error("--upload requires a scenario to be specified and/or --profile requires a profile to be specified")
+            downscaling.upload_to_GEE(arguments.scenario, "IMAGE", arguments.profile)
+        if hasattr(arguments, 'compare') and arguments.compare is True:
+            downscaling.compare_two_raster_files()
+        if hasattr(arguments, 'compare_encodings') and arguments.compare_encodings is not None:
+            grid_store.compare_encoding_policies(Path(arguments.compare_encodings))
+        if hasattr(arguments, 'benchmark') and arguments.benchmark is not None:
+            resolutions = None if arguments.benchmark == "all" else [float(resolution) for resolution in arguments.benchmark.split(",") if resolution.strip()]
+            benchmarks.run_benchmarks(project_dir, resolutions)
+        if hasattr(arguments, 'benchmark_history') and arguments.benchmark_history is True:
+            benchmarks.benchmark_history_table(project_dir)
+        if hasattr(arguments, 'run_report') and arguments.run_report is not None:
+            print(run_report.summary_table(run_report.read_report(Path(arguments.run_report))))
+        if hasattr(arguments, 'export_gdpuc_factors') and arguments.export_gdpuc_factors is not None:
+            import json
+            with open(project_dir / "downscaling" / "settings_data_locations.json", "r") as f:
+                R_SCRIPT_PATH = json.load(f)["general"]["R_SCRIPT_PATH"]
+            process_GDP.export_gdpuc_factors(R_SCRIPT_PATH, [unit.strip() for unit in arguments.export_gdpuc_factors.split(",") if unit.strip()])
+        if hasattr(arguments, 'check_gdpuc') and arguments.check_gdpuc is not None:
+            import json
+            with open(project_dir / "downscaling" / "settings_data_locations.json", "r") as f:
+                R_SCRIPT_PATH = json.load(f)["general"]["R_SCRIPT_PATH"]
+            unit_in, unit_out = [unit.strip() for unit in arguments.check_gdpuc.split(",")]
+            process_GDP.check_convert_GDP(R_SCRIPT_PATH, unit_in, unit_out)
+        if hasattr(arguments, 'run_urban_aggregation') and arguments.run_urban_aggregation is True:
+            run_aggregration_to_urban("SSP2", rounds)
+            combine_emissions_output(project_dir / "data" / "output")
     # if no arguments, print message
     if not any(vars(arguments).values()):
         print("No arguments provided. Use -h or --help for more information.")
@@ -153,3 +153,42 @@ def init_logging(log_prefix="app", log_dir="log", console_level=logging.INFO,
     results_logger.propagate = False
 
     return debug_logger, results_logger
+
+
+class DeferredInitFilter(logging.Filter):
+    """Logger filter that sets up the log files with init_logging when the
+    first record is logged (unless a command has done so already) and then
+    removes itself."""
+
+    def __init__(self, log_prefix, log_dir):
+        super().__init__()
+        self.log_prefix = log_prefix
+        self.log_dir = log_dir
+
+    def filter(self, record):
+        for logger in [logging.getLogger("debug"), logging.getLogger("results")]:
+            logger.removeFilter(self)
+        if not logging.getLogger("debug").handlers:
+            init_logging(self.log_prefix, self.log_dir)
+        return True
+
+
+def deferred_logging(log_prefix="app", log_dir="log"):
+    """
+    Module-level alternative to init_logging: returns the debug and results
+    loggers without creating log files. If no logging has been set up when
+    the first message is logged, init_logging(log_prefix, log_dir) is called
+    then; a command that calls init_logging itself comes first, so importing
+    a module neither prints nor creates files.
+
+    Returns:
+        tuple: (debug_logger, results_logger)
+    """
+    debug_logger = logging.getLogger("debug")
+    results_logger = logging.getLogger("results")
+    if not debug_logger.handlers and not any(isinstance(f, DeferredInitFilter) for f in debug_logger.filters):
+        deferred_filter = DeferredInitFilter(log_prefix, log_dir)
+        for logger in [debug_logger, results_logger]:
+            logger.setLevel(logging.DEBUG)
+            logger.addFilter(deferred_filter)
+    return debug_logger, results_logger
@@ -1,3 +1,4 @@
+import importlib
 import math
 from datetime import datetime
 from time import time
@@ -54,3 +55,22 @@ def apply_root_json(obj, root) -> Any:
     if isinstance(obj, str) and obj.startswith("{data_root}/"):
         return root.rstrip("/") + "/" + obj[len("{data_root}/"):]
     return obj
+
+# heavy packages (plotting, GIS, Tk) are only imported when a command uses them
+class LazyModule:
+    """Module that is imported on first attribute access (see lazy_import)."""
+
+    def __init__(self, name:str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module is not None else ''}>"
+
+def lazy_import(name:str) -> LazyModule:
+    return LazyModule(name)
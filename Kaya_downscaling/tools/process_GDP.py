@@ -159,3 +159,117 @@ def use_gdpuc(data:pd.DataFrame, R_SCRIPT_PATH:str,
                 path.unlink()
 
 
+# Native conversion with a table of GDPuc factors
+# Every call of use_gdpuc starts Rscript (seconds) and needs R with GDPuc on the machine. For conversions between
+# constant units ("constant YYYY Int$PPP", "constant YYYY US$MER", "constant YYYY LCU") the conversion factor of a
+# country does not depend on the value or the year of the data, so the factors are exported once from GDPuc
+# (export_gdpuc_factors, main.py --export_gdpuc_factors) to a table (unit_in, unit_out, iso3c, factor, version) with
+# 17 significant digits, and convert_GDP applies them in Python: one vectorised multiplication per DataFrame or
+# xarray object. GDPuc multiplies by its factors step by step, so results agree with the R path up to the rounding
+# of the last bit. The version column holds the GDPuc version and source of the factors.
+# check_convert_GDP converts a sample of countries and years with both paths and reports the differences, run it
+# (main.py --check_gdpuc) after an export or an update of GDPuc.
+
+FILE_GDPUC_FACTORS = Path(__file__).parent.parent / "data" / "input" / "GDPuc" / "gdpuc_factors.csv"
+
+def export_gdpuc_factors(R_SCRIPT_PATH:str, units:list, iso3c:list|None=None, source:str="wb_wdi",
+                         file_factors:Path=FILE_GDPUC_FACTORS) -> pd.DataFrame:
+    """Export the GDPuc factors between every pair of the constant units per country (default: all countries of source)"""
+    if not install_r_package('GDPuc', R_SCRIPT_PATH):
+        raise Exception("Failed to install GDPuc package, first install this package in R manually with the command: install.packages('GDPuc').")
+
+    file_factors = Path(file_factors)
+    file_factors.parent.mkdir(parents=True, exist_ok=True)
+    units_r = ", ".join(f'"{unit}"' for unit in units)
+    iso3c_r = f'c({", ".join(f"{code!r}" for code in iso3c)})' if iso3c is not None else f'unique(get("{source}", envir=asNamespace("GDPuc"))$iso3c)'
+    r_code = f'''
+    library(GDPuc)
+    units <- c({units_r})
+    iso3c <- {iso3c_r}
+    rows <- list()
+    for (unit_in in units) {{
+        for (unit_out in setdiff(units, unit_in)) {{
+            result <- convertGDP(data.frame(iso3c=iso3c, year=2020, value=1), unit_in=unit_in, unit_out=unit_out, source="{source}")
+            rows[[length(rows) + 1]] <- data.frame(unit_in=unit_in, unit_out=unit_out, iso3c=result$iso3c,
+                                                   factor=sprintf("%.17g", result$value))
+        }}
+    }}
+    factors <- do.call(rbind, rows)
+    factors$version <- paste("GDPuc", packageVersion("GDPuc"), "{source}")
+    write.csv(factors, "{file_factors.as_posix()}", row.names=FALSE)
+    cat("Export completed\\n")
+    '''
+    result = run_r_script(r_code, R_SCRIPT_PATH)
+    if result.returncode != 0 or not file_factors.exists():
+        raise Exception(f"Export of the GDPuc factors failed:\n{result.stdout}\n{result.stderr}")
+
+    # countries without data in the source have no factor
+    factors = pd.read_csv(file_factors, na_values=["NA"]).dropna(subset=["factor"])
+    factors.to_csv(file_factors, index=False)
+    print(f"GDPuc factors ({factors['version'].iloc[0]}) for {factors['iso3c'].nunique()} countries written to {file_factors}")
+    return factors
+
+def read_gdpuc_factors(file_factors:Path=FILE_GDPUC_FACTORS) -> pd.DataFrame:
+    """Read the table of GDPuc factors written by export_gdpuc_factors"""
+    if not Path(file_factors).exists():
+        raise FileNotFoundError(f"No GDPuc factor table at {file_factors}, export it once with export_gdpuc_factors (main.py --export_gdpuc_factors)")
+    return pd.read_csv(file_factors, dtype={"factor": float})
+
+def convert_GDP(data, unit_in:str, unit_out:str, factors:pd.DataFrame|None=None,
+                iso3c_col:str="iso3c", value_col:str="value"):
+    """
+    Convert GDP from unit_in to unit_out with the GDPuc factors of the countries, in one vectorised multiplication:
+    a DataFrame with columns iso3c_col and value_col, or an xarray DataArray or Dataset with a dimension iso3c_col
+    """
+    if unit_in == unit_out:
+        return data.copy()
+    factors = read_gdpuc_factors() if factors is None else factors
+    factors = factors[(factors["unit_in"] == unit_in) & (factors["unit_out"] == unit_out)].set_index("iso3c")["factor"]
+    if factors.empty:
+        raise ValueError(f"No GDPuc factors from '{unit_in}' to '{unit_out}', export them with export_gdpuc_factors")
+
+    if isinstance(data, pd.DataFrame):
+        factor = data[iso3c_col].map(factors)
+        countries = data[iso3c_col]
+    else:
+        import xarray as xr
+        countries = pd.Series(data[iso3c_col].values)
+        factor = xr.DataArray(countries.map(factors).to_numpy(), coords={iso3c_col: data[iso3c_col].values}, dims=iso3c_col)
+    missing = countries[pd.isna(countries.map(factors))].unique()
+    if len(missing) > 0:
+        raise ValueError(f"No GDPuc factors from '{unit_in}' to '{unit_out}' for {list(missing)}")
+
+    if isinstance(data, pd.DataFrame):
+        result = data.copy()
+        result[value_col] = data[value_col] * factor.to_numpy()
+        return result
+    with xr.set_options(keep_attrs=True):
+        return data * factor
+
+def check_convert_GDP(R_SCRIPT_PATH:str, unit_in:str, unit_out:str, iso3c:list|None=None, years:list|None=None,
+                      n_countries:int=10, factors:pd.DataFrame|None=None, rtol:float=1e-9) -> pd.DataFrame:
+    """
+    Convert a sample of countries (default n_countries of the factor table) and years with convert_GDP and with
+    GDPuc in R (use_gdpuc) and compare: returns the values of both paths and their relative difference per row
+    """
+    factors = read_gdpuc_factors() if factors is None else factors
+    if iso3c is None:
+        countries = factors.loc[(factors["unit_in"] == unit_in) & (factors["unit_out"] == unit_out), "iso3c"].drop_duplicates()
+        iso3c = countries.sample(min(n_countries, len(countries)), random_state=0).sort_values().tolist()
+    years = [2005, 2010, 2015, 2020] if years is None else years
+    data = pd.DataFrame([(code, year, 1000.0) for code in iso3c for year in years], columns=["iso3c", "year", "value"])
+
+    result = data.rename(columns={"value": "value_in"})
+    result["value_native"] = convert_GDP(data, unit_in, unit_out, factors)["value"].to_numpy()
+    result_R = use_gdpuc(data, R_SCRIPT_PATH, unit_in, unit_out).rename(columns={"value": "value_R"})
+    result = result.merge(result_R[["iso3c", "year", "value_R"]], on=["iso3c", "year"], how="left")
+    result["rel_diff"] = (result["value_native"] - result["value_R"]).abs() / result["value_R"].abs()
+    result["agree"] = result["rel_diff"] <= rtol
+
+    print(f"convert_GDP and GDPuc from '{unit_in}' to '{unit_out}' for {len(iso3c)} countries and {len(years)} years:")
+    print(result.to_string(index=False))
+    if result["agree"].all():
+        print(f"All {len(result)} conversions agree (relative difference <= {rtol:g}, factors {factors['version'].iloc[0]})")
+    else:
+        print(f"{(~result['agree']).sum()} of {len(result)} conversions differ by more than {rtol:g}, export the factors again with export_gdpuc_factors")
+    return result